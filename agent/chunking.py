@@ -0,0 +1,219 @@
+# agent/chunking.py
+
+import re
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from agent.tokenizer import count_tokens
+from config import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNK_MIN_TOKENS, CHUNK_TITLE_COLUMNS
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?;])\s+")
+
+
+# ---------- ROW TEXT ---------- #
+def is_empty(value) -> bool:
+    """Empty spreadsheet cell: None, NaN / NaT or blank text"""
+    if value is None or value != value:
+        return True
+    return isinstance(value, str) and not value.strip()
+
+
+def row_fields(row, columns: Optional[List[str]] = None) -> List[Tuple[str, Any]]:
+    """(column, value) pairs of a pandas row, empty cells skipped, only columns if given"""
+    items = row.items() if columns is None else ((column, row[column]) for column in columns)
+    return [(str(column), value) for column, value in items if not is_empty(value)]
+
+
+def fields_to_text(fields: List[Tuple[str, Any]]) -> str:
+    return "\n".join(f"{column}: {value}" for column, value in fields)
+
+
+def _title_fields(fields: List[Tuple[str, Any]], title_columns: List[str]) -> List[Tuple[str, Any]]:
+    """Title columns of the row, the first column when the sheet has none of them"""
+    titles = [(column, value) for column, value in fields if column in title_columns]
+    return titles or fields[:1]
+
+
+# ---------- SPLITTING ---------- #
+def _segments(text: str, max_tokens: int) -> Iterator[Tuple[str, int]]:
+    """
+    Pieces of text no longer than max_tokens: whole lines, then sentences of long lines,
+    then groups of whole words for a single sentence that is still too long.
+    """
+    for line in text.split("\n"):
+        tokens = count_tokens(line)
+        if tokens <= max_tokens:
+            yield line, tokens
+            continue
+        for sentence in _SENTENCE_RE.split(line):
+            sentence_tokens = count_tokens(sentence)
+            if sentence_tokens <= max_tokens:
+                yield sentence, sentence_tokens
+                continue
+            words: List[str] = []
+            words_tokens = 0
+            for word in sentence.split(" "):
+                word_tokens = count_tokens(f" {word}")
+                if words and words_tokens + word_tokens > max_tokens:
+                    yield " ".join(words), words_tokens
+                    words, words_tokens = [], 0
+                words.append(word)
+                words_tokens += word_tokens
+            if words:
+                yield " ".join(words), words_tokens
+
+
+def split_text(text: str, max_tokens: int, overlap_tokens: int) -> List[str]:
+    """Pack segments into chunks of at most max_tokens, consecutive chunks share up to overlap_tokens"""
+    chunks = []
+    current: List[Tuple[str, int]] = []
+    current_tokens = 0
+    for segment, tokens in _segments(text, max_tokens):
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n".join(s for s, _ in current))
+            # Carry the tail of the previous chunk over as the overlap
+            tail: List[Tuple[str, int]] = []
+            tail_tokens = 0
+            for s, n in reversed(current):
+                if tail_tokens + n > overlap_tokens or tail_tokens + n + tokens > max_tokens:
+                    break
+                tail.insert(0, (s, n))
+                tail_tokens += n
+            current, current_tokens = tail, tail_tokens
+        current.append((segment, tokens))
+        current_tokens += tokens
+    if current:
+        chunks.append("\n".join(s for s, _ in current))
+    return chunks
+
+
+# ---------- SHEET CHUNKING ---------- #
+def chunk_sheet(
+    df,
+    metadata: dict,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+    min_tokens: int = CHUNK_MIN_TOKENS,
+    title_columns: Optional[List[str]] = None,
+    content_columns: Optional[List[str]] = None,
+    row_metadata: Optional[Callable[[Any], dict]] = None
+) -> List[Document]:
+    """
+    Turn the rows of a sheet into Documents ready for embedding.
+
+    Rows longer than max_tokens are split into overlapping chunks, each chunk starts with
+    the title columns of its row. Consecutive rows shorter than min_tokens are merged when
+    their row metadata is the same. Only content_columns (all columns by default) make the
+    text, empty cells and empty rows are skipped; row_metadata(row) adds per-row metadata
+    (filters). Lineage is kept in metadata: row_id ("filename:sheet:row", the row number
+    as in Excel, rows of a merged document joined by "|"), chunk_index and chunk_count.
+    """
+    title_columns = CHUNK_TITLE_COLUMNS if title_columns is None else title_columns
+    prefix = f"{metadata.get('filename', '')}:{metadata.get('sheet', '')}"
+    docs: List[Document] = []
+    pending: List[Tuple[str, str]] = []  # tiny rows waiting to be merged: (row_id, text)
+    pending_tokens = 0
+    pending_metadata: dict = {}
+
+    def flush_pending():
+        nonlocal pending, pending_tokens
+        if pending:
+            docs.append(Document(
+                page_content="\n\n".join(text for _, text in pending),
+                metadata={**metadata, **pending_metadata, "row_id": "|".join(row_id for row_id, _ in pending),
+                          "chunk_index": 0, "chunk_count": 1}
+            ))
+        pending, pending_tokens = [], 0
+
+    for position, (_, row) in enumerate(df.iterrows()):
+        row_id = f"{prefix}:{position + 2}"  # +1 for the header row, +1 for 1-based numbering
+        fields = row_fields(row, content_columns)
+        if not fields:
+            continue
+        extra = row_metadata(row) if row_metadata else {}
+        text = fields_to_text(fields)
+        tokens = count_tokens(text)
+
+        if tokens < min_tokens:
+            if pending and extra != pending_metadata:
+                flush_pending()
+            pending.append((row_id, text))
+            pending_tokens += tokens
+            pending_metadata = extra
+            if pending_tokens >= min_tokens:
+                flush_pending()
+            continue
+        flush_pending()
+
+        if tokens <= max_tokens:
+            docs.append(Document(
+                page_content=text,
+                metadata={**metadata, **extra, "row_id": row_id, "chunk_index": 0, "chunk_count": 1}
+            ))
+            continue
+
+        titles = _title_fields(fields, title_columns)
+        header = fields_to_text(titles)
+        body = fields_to_text([field for field in fields if field not in titles])
+        body_budget = max(max_tokens - count_tokens(header), max_tokens // 2)
+        parts = split_text(body, body_budget, min(overlap_tokens, body_budget // 2))
+        for index, part in enumerate(parts):
+            docs.append(Document(
+                page_content=f"{header}\n{part}",
+                metadata={**metadata, **extra, "row_id": row_id, "chunk_index": index,
+                          "chunk_count": len(parts), "title": header}
+            ))
+    flush_pending()
+    return docs
+
+
+# ---------- CHUNKS BACK TO ROWS ---------- #
+def _join_chunk_bodies(bodies: List[str]) -> str:
+    """Concatenate consecutive chunk bodies dropping the overlapping lines"""
+    lines = bodies[0].split("\n")
+    for body in bodies[1:]:
+        next_lines = body.split("\n")
+        overlap = next(
+            (n for n in range(min(len(lines), len(next_lines)), 0, -1) if lines[-n:] == next_lines[:n]),
+            0
+        )
+        lines.extend(next_lines[overlap:])
+    return "\n".join(lines)
+
+
+def merge_row_chunks(hits: List[Tuple[Document, float]]) -> List[Tuple[Document, float]]:
+    """
+    De-duplicate retrieved chunks back to rows: chunks of the same row become one document
+    (in chunk order, header once) at the rank of its best chunk.
+    """
+    groups = {}
+    for doc, score in hits:
+        key = (doc.metadata or {}).get("row_id") or doc.id or (doc.metadata.get("source"), doc.page_content)
+        groups.setdefault(key, []).append((doc, score))
+
+    merged = []
+    for chunks in groups.values():
+        if len(chunks) == 1:
+            merged.append(chunks[0])
+            continue
+        chunks.sort(key=lambda item: item[0].metadata.get("chunk_index", 0))
+        first = chunks[0][0]
+        header = first.metadata.get("title")
+        bodies = []
+        for doc, _ in chunks:
+            content = doc.page_content or ""
+            if header and content.startswith(f"{header}\n"):
+                content = content[len(header) + 1:]
+            bodies.append(content)
+        body = _join_chunk_bodies(bodies)
+        merged.append((
+            Document(page_content=f"{header}\n{body}" if header else body, metadata=first.metadata, id=first.id),
+            max(score for _, score in chunks)
+        ))
+    return merged
@@ -2,16 +2,27 @@
 
 from agent.prompts import IDENTIFICATION_PROMPT, NEEDS_RAG_PROMPT, RAG_PROMPT, CONSULTATION_PROMPT, SUMMARIZE_CONVERSATION_PROMPT
 from agent.state import ConsultationState
+from agent.context_packer import fit_to_budget
 from agent.tools import rag_search
-from config import OPENAI_API_KEY
+from agent.name_extractor import extract_identity
+from agent.metrics import current_trace_id, record_error, record_llm_usage, timed_node, trace_run
+from agent.history import HistoryManager, SUMMARY_PREFIX, is_dialog_message
+from agent.tokenizer import count_tokens
+from config import (
+    OPENAI_API_KEY, OPENAI_BASE_URL, SUMMARY_TRIGGER_TOKENS, SUMMARY_KEEP_MESSAGES, SUMMARY_WORKERS, SUMMARY_PENDING_TTL
+)
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, SystemMessagePromptTemplate, HumanMessagePromptTemplate
 from langchain_core.messages import AIMessage, HumanMessage, ToolMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
 from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, StateGraph
 from langgraph.prebuilt import ToolNode
 import logs.logging_config
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 logger = logging.getLogger(__name__)
@@ -27,29 +38,114 @@ class ConsultationAgent:
         Initialization of the agent.
         """
         # Create LLM
-        self.llm = ChatOpenAI(model="gpt-4.1", temperature=0.2, api_key=OPENAI_API_KEY)
+        self.llm = ChatOpenAI(model="gpt-4.1", temperature=0.2, api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
 
         # Set up the state storage
         self.checkpointer = MemorySaver()
 
         # Tools
         self.tools = [rag_search]
+        self.tool_node = ToolNode(self.tools)
+
+        # Prompts and chains are compiled once: the system part of every prompt stays
+        # byte-identical across users and turns, so the provider can cache the prefix
+        self._build_chains()
+
+        # Prompt cache statistics from the usage metadata of the responses
+        self._usage_lock = threading.Lock()
+        self.usage_stats = {"calls": 0, "input_tokens": 0, "cached_tokens": 0}
+
+        # Bounded chat history for the prompts
+        self.history = HistoryManager()
+
+        # Background rolling summary of long conversations, per session at most one job at a time
+        self._summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="summary")
+        self._summary_lock = threading.Lock()
+        self._pending_summaries = {}
 
         # Build graph
         self.graph = self._build_graph()
 
+    def _build_chains(self) -> None:
+        """
+        Compile the prompt templates and chains of all nodes.
+        Per-user data (name, gender, query, retrieved texts) goes only into the last message.
+        """
+        identification_prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(IDENTIFICATION_PROMPT),
+            MessagesPlaceholder("chat_history"),
+            HumanMessagePromptTemplate.from_template(
+                "Ответ пользователя: '{user_query}'\n\n"
+            )
+        ])
+        self.identification_chain = identification_prompt | self.llm
+
+        needs_rag_prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(NEEDS_RAG_PROMPT),
+            HumanMessagePromptTemplate.from_template("{query}")
+        ])
+        self.needs_rag_chain = needs_rag_prompt | self.llm
+
+        rag_prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(RAG_PROMPT),
+            MessagesPlaceholder("chat_history"),
+            HumanMessagePromptTemplate.from_template("Выполни поиск по запросу пользователя")
+        ])
+        # Force the model to use the tool
+        model_with_tools = self.llm.bind_tools(
+            self.tools,
+            tool_choice={"type": "function", "function": {"name": "rag_search"}}
+        )
+        self.rag_chain = rag_prompt | model_with_tools
+
+        consultation_prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(CONSULTATION_PROMPT),
+            MessagesPlaceholder("chat_history"),
+            HumanMessagePromptTemplate.from_template(
+                "Данные клиента: имя - {client_name}, пол - {gender}\n\n" +
+                "Запрос пользователя: '{user_query}'\n\n" +
+                "Релевантная информация:\n{retrieved_texts}\n\n" +
+                "Сформулируй финальный ответ пользователю на основе этой информации."
+            )
+        ])
+        self.consultation_chain = consultation_prompt | self.llm
+
+    def _record_usage(self, node: str, response) -> None:
+        """Log the share of prompt tokens served from the provider prompt cache"""
+        usage = getattr(response, "usage_metadata", None)
+        record_llm_usage(node.lower(), usage)
+        if not usage:
+            return
+        input_tokens = usage.get("input_tokens", 0)
+        cached_tokens = (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+        with self._usage_lock:
+            self.usage_stats["calls"] += 1
+            self.usage_stats["input_tokens"] += input_tokens
+            self.usage_stats["cached_tokens"] += cached_tokens
+            total_ratio = self.usage_stats["cached_tokens"] / max(self.usage_stats["input_tokens"], 1)
+        logger.info(
+            f"[CONSULTATION_AGENT][{node}][trace={current_trace_id()}] Токены запроса: {input_tokens}, из кэша: {cached_tokens} "
+            f"({cached_tokens / max(input_tokens, 1):.0%}), всего из кэша: {total_ratio:.0%}"
+        )
+
+    def get_usage_stats(self) -> dict:
+        """Prompt cache statistics since the start of the process"""
+        with self._usage_lock:
+            stats = dict(self.usage_stats)
+        stats["cached_ratio"] = stats["cached_tokens"] / stats["input_tokens"] if stats["input_tokens"] else 0.0
+        return stats
+
     def _build_graph(self) -> StateGraph:
         """
         Create and compile a dialog graph (StateGraph) using LangGraph.
         """
         workflow = StateGraph(ConsultationState)
 
-        workflow.add_node("get_user_info", self._get_user_info)
-        workflow.add_node("needs_rag", self._needs_rag_node)
-        workflow.add_node("llm_response", self._llm_response_node)        
-        workflow.add_node("tool", ToolNode(self.tools))
-        workflow.add_node("check_reset", self._check_reset_node)
-        workflow.add_node("reset_state", self._reset_state_with_summary)
+        # Every node is timed, see agent/metrics.py
+        workflow.add_node("get_user_info", timed_node("get_user_info", self._get_user_info))
+        workflow.add_node("needs_rag", timed_node("needs_rag", self._needs_rag_node))
+        workflow.add_node("llm_response", timed_node("llm_response", self._llm_response_node))
+        workflow.add_node("tool", timed_node("tool", self._tool_node))
 
         # Начинаем с узла уточнения
         workflow.set_entry_point("get_user_info")
@@ -72,25 +168,18 @@ class ConsultationAgent:
             self._route_after_agent,
             {
                 "use_tool": "tool",              
-                "no_tool": "check_reset"
+                "no_tool": END
             }
         )
 
         workflow.add_edge("tool", "llm_response")
 
-        # After check_reset, either reset or end
-        workflow.add_conditional_edges(
-            "check_reset",
-            self._should_reset_conversation,
-            {
-                "reset_state": "reset_state",
-                "finish": END
-            }
-        )
-        workflow.add_edge("reset_state", END)
-
         return workflow.compile(checkpointer=self.checkpointer)
 
+    def _tool_node(self, state: ConsultationState, config: RunnableConfig):
+        """Execute the tool calls of the last AI message (rag_search)"""
+        return self.tool_node.invoke(state, config)
+
     def _get_user_info(self, state: ConsultationState) -> ConsultationState:
 
         try:
@@ -107,28 +196,25 @@ class ConsultationAgent:
 
                 user_query = messages[-1].content
 
-                chat_history = [
-                    msg for msg in messages
-                    if isinstance(msg, (AIMessage, HumanMessage)) and not msg.additional_kwargs.get("tool_calls")
-                ]
-
-                identification_prompt = ChatPromptTemplate.from_messages([
-                    SystemMessagePromptTemplate.from_template(IDENTIFICATION_PROMPT),
-                    MessagesPlaceholder("chat_history"),
-                    HumanMessagePromptTemplate.from_template(
-                        "Ответ пользователя: '{user_query}'\n\n"
-                    )
-                ])
-                
-                # Use the usual model (without tools)
-                model = self.llm
-                chain = identification_prompt | model
-                
+                # Names from the gazetteer and plain greetings are resolved without the LLM
+                identity = extract_identity(user_query)
+                if identity is not None:
+                    logger.info(f"[CONSULTATION_AGENT][GET_USER_INFO] Локальное распознавание: {identity}")
+                    if identity["client_name"] is not None:
+                        state["client_name"] = identity["client_name"]
+                        state["gender"] = identity["gender"]
+                    if identity["response"]:
+                        state["messages"].append(AIMessage(content=identity["response"]))
+                    return state
+
+                chat_history = self.history.chat_history(messages)
+
                 # Invoke model to generate final response
-                response = chain.invoke({
+                response = self.identification_chain.invoke({
                     "chat_history": chat_history,
                     "user_query": user_query or "последний запрос",
                 })
+                self._record_usage("GET_USER_INFO", response)
 
                 # Пытаемся извлечь JSON
                 import json
@@ -172,6 +258,7 @@ class ConsultationAgent:
             
         except Exception as e:
             logger.error(f"[CONSULTATION_AGENT] Ошибка при уточнении запроса: {e}")
+            record_error("get_user_info")
             state["messages"].append(AIMessage(content="Извините, возникла ошибка. Попробуйте позже."))
 
         return state
@@ -214,15 +301,9 @@ class ConsultationAgent:
             last_message = messages[-1]
             user_query = last_message.content
             
-            # Create needs_rag_prompt
-            needs_rag_prompt = ChatPromptTemplate.from_messages([
-                SystemMessagePromptTemplate.from_template(NEEDS_RAG_PROMPT),
-                HumanMessagePromptTemplate.from_template("{query}")
-            ])
-            
             # Get classification
-            chain = needs_rag_prompt | self.llm
-            response = chain.invoke({"query": user_query})
+            response = self.needs_rag_chain.invoke({"query": user_query})
+            self._record_usage("NEEDS_RAG", response)
             
             if "YES" in response.content:
                 state["need_rag"] = True
@@ -231,6 +312,7 @@ class ConsultationAgent:
             
         except Exception as e:
             logger.error(f"[CONSULTATION_AGENT] Error in routing: {e}")
+            record_error("needs_rag")
             state["needs_rag"] = True
   
 
@@ -262,40 +344,19 @@ class ConsultationAgent:
 
 
                 # Get chat history
-                chat_history = [
-                    msg for msg in messages
-                    if isinstance(msg, (AIMessage, HumanMessage)) and not msg.additional_kwargs.get("tool_calls")
-                ]
-
-                # Rag prompt with tools
-                rag_prompt = ChatPromptTemplate.from_messages([
-                    SystemMessagePromptTemplate.from_template(RAG_PROMPT),
-                    MessagesPlaceholder("chat_history"),
-                    HumanMessagePromptTemplate.from_template("Выполни поиск по запросу пользователя")  
-                ])
-
-                # Force the model to use the tool
-                model_with_tools = self.llm.bind_tools(
-                    self.tools,
-                    tool_choice={"type": "function", "function": {"name": "rag_search"}}
-                    )
-                chain = rag_prompt | model_with_tools
-                
+                chat_history = self.history.chat_history(messages)
+
                 # Invoke model - return tool calls
-                response = chain.invoke({
+                response = self.rag_chain.invoke({
                     "chat_history": chat_history
                 })
+                self._record_usage("RAG", response)
                 state["messages"].append(response)
 
             # Case 2: Processing tool response
             if (isinstance(last_message, ToolMessage) and need_rag == True) or (isinstance(last_message, HumanMessage) and need_rag == False):
                 # Get chat history (excluding tool messages and tool calls)
-                chat_history = [
-                    msg for msg in messages
-                    if isinstance(msg, (AIMessage, HumanMessage)) and not (
-                        isinstance(msg, AIMessage) and msg.additional_kwargs.get("tool_calls")
-                    )
-                ]
+                chat_history = self.history.chat_history(messages)
 
                 gender = state.get("gender", None)
                 client_name = state.get("client_name", None)
@@ -308,37 +369,29 @@ class ConsultationAgent:
                         
                 # Get tool search result
                 if isinstance(last_message, ToolMessage):
-                    retrieved_info = last_message.content
+                    # rag_search already packs its result, the guard covers any other tool output
+                    retrieved_info = fit_to_budget(last_message.content)
                 else:
                     retrieved_info = "Для данного запроса не требовался поиск в базе знаний."
                 
-                # Prompt for a final response
-                consultation_prompt = ChatPromptTemplate.from_messages([
-                    SystemMessagePromptTemplate.from_template(CONSULTATION_PROMPT),
-                    MessagesPlaceholder("chat_history"),
-                    HumanMessagePromptTemplate.from_template(
-                        "Запрос пользователя: '{user_query}'\n\n" +
-                        "Релевантная информация:\n{retrieved_texts}\n\n" +
-                        "Сформулируй финальный ответ пользователю на основе этой информации."
-                    )
-                ])
-                
-                # Use the usual model (without tools)
-                model = self.llm
-                chain = consultation_prompt | model
-                
                 # Invoke model to generate final response
-                response = chain.invoke({
+                response = self.consultation_chain.invoke({
                     "chat_history": chat_history,
                     "retrieved_texts": retrieved_info,
                     "user_query": user_query or "последний запрос",
                     "gender": gender or "неизвестен",
                     "client_name": client_name or "клиент"
                 })
+                self._record_usage("LLM_RESPONSE", response)
                 state["messages"].append(response)
 
+                # The retrieved texts are in the answer now, keep only a marker in the history
+                if isinstance(last_message, ToolMessage):
+                    self.history.compact_tool_message(state["messages"], last_message)
+
         except Exception as e:
             logger.error(f"[CONSULTATION_AGENT] Ошибка при запросе к LLM: {e}")
+            record_error("llm_response")
             state["messages"].append(AIMessage(content="Извините, возникла ошибка. Попробуйте позже."))
 
         return state
@@ -364,28 +417,25 @@ class ConsultationAgent:
         else:
             return "no_tool"
         
-    def _should_reset_conversation(self, state: ConsultationState) -> bool:
-        """Determine if we should reset the conversation state"""
-        messages = state.get("messages", [])
-        final_ai_messages = [
-            msg for msg in messages 
-            if isinstance(msg, AIMessage) and not msg.additional_kwargs.get("tool_calls")
-            ]
-        return "reset_state" if len(final_ai_messages) >= 10 else "finish"
-    
-    # ---------- CHECK RESET NODE ----------
-    def _check_reset_node(self, state: ConsultationState) -> ConsultationState:
-        """Node that passes through state without modifying it"""
-        return state
-
-    def _summarize_conversation(self, state: ConsultationState) -> HumanMessage:
-        """Summarize the conversation and add the summary to the messages."""
+    # ---------- ROLLING SUMMARY ----------
+    @staticmethod
+    def _dialog_messages(messages: list) -> list:
+        """User messages and final assistant answers (no tool calls and tool results)"""
+        return [msg for msg in messages if is_dialog_message(msg)]
 
+    def _summarize_conversation(self, messages: list):
+        """
+        Fold the messages into a summary. A previous summary among them is extended, not re-created.
+        Returns None on error, so the history stays as it is.
+        """
         conversation_for_summary = []
-        for msg in state["messages"]:
+        for msg in self._dialog_messages(messages):
             if isinstance(msg, HumanMessage):
-                conversation_for_summary.append(f"Пользователь: {msg.content}")
-            elif isinstance(msg, AIMessage) and not msg.additional_kwargs.get("tool_calls"):
+                if msg.content.startswith(SUMMARY_PREFIX):
+                    conversation_for_summary.append(msg.content)
+                else:
+                    conversation_for_summary.append(f"Пользователь: {msg.content}")
+            else:
                 conversation_for_summary.append(f"Ассистент: {msg.content}")
         
         prompt = [
@@ -395,45 +445,82 @@ class ConsultationAgent:
 
         try:
             summary_response = self.llm.invoke(prompt)
+            self._record_usage("SUMMARIZE", summary_response)
 
-            return HumanMessage(content=summary_response.content)
+            summary = summary_response.content.strip().strip('"')
+            # The prefix marks the summary for add_messages_custom
+            if not summary.startswith(SUMMARY_PREFIX):
+                summary = f"{SUMMARY_PREFIX} {summary}"
+            return HumanMessage(content=summary)
 
         except Exception as e:
             logger.error(f"[CONSULTATION_AGENT] Ошибка при суммаризации: {e}")
-            return HumanMessage(content="Извините, произошла ошибка при суммаризации.")
+            record_error("summarize")
+            return None
 
-    def _reset_state_with_summary(self, state: ConsultationState) -> ConsultationState:
-        # Save the session_id for updating the checkpointer
-        session_id = state.get("session_id")
+    def _schedule_summary(self, session_id: str, messages: list) -> None:
+        """
+        Start folding the oldest turns into the running summary in the background
+        when the dialog is over SUMMARY_TRIGGER_TOKENS. The user does not wait for it.
+        """
+        self._drop_expired_summaries()
+        dialog = self._dialog_messages(messages)
+        if len(dialog) <= SUMMARY_KEEP_MESSAGES:
+            return
+        with self._summary_lock:
+            if session_id in self._pending_summaries:
+                return
+        if sum(count_tokens(msg.content) for msg in dialog) < SUMMARY_TRIGGER_TOKENS:
+            return
+
+        # The kept tail starts with a user message, tool calls stay with their results
+        keep_from = dialog[-SUMMARY_KEEP_MESSAGES]
+        cut = next(i for i, msg in enumerate(messages) if msg is keep_from)
+        while cut < len(messages) and not isinstance(messages[cut], HumanMessage):
+            cut += 1
+        to_fold = messages[:cut]
+        if not to_fold or any(msg.id is None for msg in to_fold):
+            return
+
+        pending = {"folded_ids": {msg.id for msg in to_fold}, "done_at": None}
+        pending["future"] = self._summary_executor.submit(self._summarize_conversation, list(to_fold))
+        pending["future"].add_done_callback(lambda _: pending.update(done_at=time.monotonic()))
+        with self._summary_lock:
+            self._pending_summaries[session_id] = pending
+        logger.info(f"[CONSULTATION_AGENT][SUMMARY] Сессия {session_id}: в резюме сворачивается {len(to_fold)} сообщений")
+
+    def _drop_expired_summaries(self) -> None:
+        """Forget summaries finished over SUMMARY_PENDING_TTL seconds ago: their sessions did not come back"""
+        expired_before = time.monotonic() - SUMMARY_PENDING_TTL
+        with self._summary_lock:
+            expired = [
+                session_id for session_id, pending in self._pending_summaries.items()
+                if pending["done_at"] is not None and pending["done_at"] < expired_before
+            ]
+            for session_id in expired:
+                del self._pending_summaries[session_id]
+        if expired:
+            logger.info(f"[CONSULTATION_AGENT][SUMMARY] Удалено неприменённых резюме: {len(expired)}")
+
+    def _apply_pending_summary(self, session_id: str, state: ConsultationState) -> ConsultationState:
+        """Replace the folded messages with the summary once the background job is done"""
+        with self._summary_lock:
+            pending = self._pending_summaries.get(session_id)
+            if not pending or not pending["future"].done():
+                return state
+            del self._pending_summaries[session_id]
 
+        summary = pending["future"].result()
         messages = state.get("messages", [])
-        for msg in reversed(messages):
-            if isinstance(msg, AIMessage) and msg.content:
-                # Skip messages with tool calls
-                has_tool_calls = (hasattr(msg, 'additional_kwargs') and 
-                                'tool_calls' in msg.additional_kwargs and 
-                                msg.additional_kwargs['tool_calls'])
-                if not has_tool_calls:
-                    final_ai_message = msg
-                    break        
-
-        # Create a summary of the dialog before resetting
-        conversation_summary = self._summarize_conversation(state)
-
-        client_name = state.get("client_name", None)
-        gender = state.get("gender", None)
-
-        # Create a completely new state object
-        new_state = {
-            "session_id": session_id,
-            "need_rag": True,
-            "client_name": client_name,
-            "gender": gender,
-            "messages": [conversation_summary, final_ai_message]
-        }
-        return new_state
+        if summary is None or not pending["folded_ids"] <= {msg.id for msg in messages}:
+            # Summarization failed or the history was replaced in the meantime
+            return state
+
+        kept = [msg for msg in messages if msg.id not in pending["folded_ids"]]
+        logger.info(f"[CONSULTATION_AGENT][SUMMARY] Сессия {session_id}: резюме применено, осталось {len(kept)} сообщений")
+        # A summary as the first message replaces the whole history (add_messages_custom)
+        return {**state, "messages": [summary] + kept}
 
-        
     # ---------- RUN ----------
     def run(self, session_id: str, state: ConsultationState = None) -> ConsultationState:
         """
@@ -468,15 +555,27 @@ class ConsultationAgent:
                     "messages": []
                 }         
 
+        state = self._apply_pending_summary(session_id, state)
+
+        # The session id is the trace id of the run (TalkMe user_id, Telegram user id)
+        with trace_run(str(session_id)):
+            return self._invoke_graph(session_id, state)
+
+    def _invoke_graph(self, session_id: str, state: ConsultationState) -> ConsultationState:
         try:
             updated_state = self.graph.invoke(
                 state,
                 {"configurable": {"thread_id": session_id, "recursion_limit": 10}}
             )
+            try:
+                self._schedule_summary(session_id, updated_state.get("messages", []))
+            except Exception as e:
+                logger.error(f"[CONSULTATION_AGENT][SUMMARY] Не удалось запустить суммаризацию: {e}")
             # print("---------Updated_state---------")
             # print(updated_state)
             return updated_state
         except Exception as e:
             logger.error(f"[CONSULTATION_AGENT][RUN] Error in run method: {str(e)}")
+            record_error("run")
             state["messages"].append(AIMessage(content="Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз."))
             return state
\ No newline at end of file
@@ -0,0 +1,98 @@
+# agent/context_packer.py
+
+from typing import Dict, List, Tuple
+
+from langchain_core.documents import Document
+
+from agent.chunking import merge_row_chunks
+from agent.tokenizer import count_tokens, truncate_to_tokens
+from config import RAG_CONTEXT_TOKEN_BUDGET
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+TRUNCATION_MARK = "\n[...]"
+
+
+def _doc_key(doc: Document):
+    return (doc.metadata or {}).get("row_id") or doc.id or (doc.metadata.get("source"), doc.page_content)
+
+
+def format_document(doc: Document) -> str:
+    return f"[Source: {doc.metadata.get('source', 'N/A')}]\n{doc.page_content or 'Пустой документ'}"
+
+
+def rank_hits(hits_by_subquery: Dict[str, List[Tuple[Document, float]]]) -> List[Tuple[Document, float]]:
+    """
+    One ranked list for all subqueries without duplicates, interleaved by rank: the best hit of
+    every subquery, then the second ones, and so on. Scores are not compared across subqueries:
+    exact matches (1.0), fused (RRF, ~0.02) and vector scores are on different scales, so a tight
+    budget is shared between the subqueries instead of going to the one with the largest scale.
+    """
+    # Several chunks of one long row are shown as that row once
+    ranked_rows = [merge_row_chunks(subquery_hits) for subquery_hits in hits_by_subquery.values()]
+    seen = set()
+    ranked = []
+    for rank in range(max((len(rows) for rows in ranked_rows), default=0)):
+        for rows in ranked_rows:
+            if rank >= len(rows):
+                continue
+            doc, score = rows[rank]
+            key = _doc_key(doc)
+            if key not in seen:
+                seen.add(key)
+                ranked.append((doc, score))
+    return ranked
+
+
+def pack_context(
+    hits_by_subquery: Dict[str, List[Tuple[Document, float]]],
+    token_budget: int = RAG_CONTEXT_TOKEN_BUDGET
+) -> Tuple[str, int]:
+    """
+    Retrieved context for CONSULTATION_PROMPT: de-duplicated hits of all subqueries,
+    ranked by score and trimmed to token_budget. Subqueries without hits are reported
+    so the model does not make the answer up.
+
+    Returns:
+        tuple: context text and the number of documents in it
+    """
+    parts = []
+    used_tokens = 0
+    dropped = 0
+    for doc, _ in rank_hits(hits_by_subquery):
+        if doc.page_content is None:
+            continue
+        text = format_document(doc)
+        tokens = count_tokens(text)
+        if used_tokens + tokens > token_budget:
+            # Only the top document is cut, lower ranked ones are dropped whole
+            if not parts:
+                text = truncate_to_tokens(text, token_budget - count_tokens(TRUNCATION_MARK)) + TRUNCATION_MARK
+                parts.append(text)
+                used_tokens += count_tokens(text)
+            else:
+                dropped += 1
+            continue
+        parts.append(text)
+        used_tokens += tokens
+
+    missing = [subquery for subquery, subquery_hits in hits_by_subquery.items() if not subquery_hits]
+    parts.extend(f"Нет информации по запросу: {subquery}" for subquery in missing)
+
+    documents_count = len(parts) - len(missing)
+    logger.info(
+        f"[CONTEXT_PACKER] Контекст: {documents_count} документов, {used_tokens}/{token_budget} токенов"
+        + (f", отброшено {dropped}" if dropped else "")
+    )
+    return "\n\n".join(parts), documents_count
+
+
+def fit_to_budget(text: str, token_budget: int = RAG_CONTEXT_TOKEN_BUDGET) -> str:
+    """Guard for context that did not go through pack_context"""
+    if count_tokens(text) <= token_budget:
+        return text
+    logger.warning(f"[CONTEXT_PACKER] Контекст превышает бюджет {token_budget} токенов и будет обрезан")
+    return truncate_to_tokens(text, token_budget - count_tokens(TRUNCATION_MARK)) + TRUNCATION_MARK
@@ -0,0 +1,165 @@
+# agent/embeddings.py
+
+import os
+import threading
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from config import (
+    OPENAI_API_KEY, OPENAI_BASE_URL, EMBEDDING_BACKEND, LOCAL_EMBEDDING_MODEL, LOCAL_EMBEDDING_ONNX_FILE,
+    LOCAL_EMBEDDING_BATCH_SIZE, LOCAL_EMBEDDING_MAX_LENGTH, LOCAL_EMBEDDING_THREADS,
+    LOCAL_EMBEDDING_QUERY_PREFIX, LOCAL_EMBEDDING_DOCUMENT_PREFIX
+)
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_model_file(model_name: str, filename: str) -> str:
+    """Model file from a local directory or from the Hugging Face cache"""
+    if os.path.isdir(model_name):
+        return os.path.join(model_name, filename)
+    from huggingface_hub import hf_hub_download
+    return hf_hub_download(repo_id=model_name, filename=filename)
+
+
+def load_onnx_model(model_name: str, onnx_file: str, max_length: int, num_threads: int):
+    """
+    Tokenizer (truncating, padding) and CPU onnxruntime session of a transformer exported to ONNX.
+
+    Returns:
+        tuple: tokenizer, session, names of the session inputs
+    """
+    import onnxruntime as ort
+    from tokenizers import Tokenizer
+
+    tokenizer = Tokenizer.from_file(resolve_model_file(model_name, "tokenizer.json"))
+    tokenizer.enable_truncation(max_length=max_length)
+    if tokenizer.padding is None:
+        pad_token = next(
+            (token for token in ("<pad>", "[PAD]") if tokenizer.token_to_id(token) is not None),
+            None
+        )
+        pad_id = tokenizer.token_to_id(pad_token) if pad_token else 0
+        tokenizer.enable_padding(pad_id=pad_id, pad_token=pad_token or "[PAD]")
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = ort.InferenceSession(
+        resolve_model_file(model_name, onnx_file),
+        sess_options=options,
+        providers=["CPUExecutionProvider"]
+    )
+    return tokenizer, session, {model_input.name for model_input in session.get_inputs()}
+
+
+class LocalOnnxEmbeddings(Embeddings):
+    """
+    Sentence-transformers class embedding model executed locally on CPU with onnxruntime.
+    No network is needed once the model files are on disk, texts are embedded in batches
+    and every batch is spread across all cores by the onnxruntime intra-op thread pool.
+    """
+
+    def __init__(
+        self,
+        model_name: str = LOCAL_EMBEDDING_MODEL,
+        onnx_file: str = LOCAL_EMBEDDING_ONNX_FILE,
+        batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE,
+        max_length: int = LOCAL_EMBEDDING_MAX_LENGTH,
+        num_threads: int = LOCAL_EMBEDDING_THREADS,
+        query_prefix: str = LOCAL_EMBEDDING_QUERY_PREFIX,
+        document_prefix: str = LOCAL_EMBEDDING_DOCUMENT_PREFIX
+    ):
+        self.model_name = model_name
+        self.onnx_file = onnx_file
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.query_prefix = query_prefix
+        self.document_prefix = document_prefix
+        self._session = None
+        self._tokenizer = None
+        self._input_names = set()
+        self._load_lock = threading.Lock()
+
+    def _load(self) -> None:
+        if self._session is not None:
+            return
+        with self._load_lock:
+            if self._session is not None:
+                return
+            tokenizer, session, input_names = load_onnx_model(self.model_name, self.onnx_file, self.max_length, self.num_threads)
+            self._tokenizer = tokenizer
+            self._input_names = input_names
+            self._session = session
+            logger.info(f"[EMBEDDINGS] Загружена локальная модель {self.model_name} ({self.onnx_file}), потоков: {self.num_threads}")
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self._tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        inputs = {name: value for name, value in inputs.items() if name in self._input_names}
+
+        output = self._session.run(None, inputs)[0]
+        if output.ndim == 3:
+            # Mean pooling over the real (not padded) tokens
+            mask = attention_mask[:, :, None].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        return (output / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+    def embed_array(self, texts: List[str], prefix: str = "") -> np.ndarray:
+        """Embed texts into a float32 matrix with L2-normalized rows"""
+        self._load()
+        texts = [f"{prefix}{text}" for text in texts]
+        # Sorting by length keeps padding inside every batch minimal
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        result = None
+        for start in range(0, len(order), self.batch_size):
+            batch_idx = order[start:start + self.batch_size]
+            vectors = self._embed_batch([texts[i] for i in batch_idx])
+            if result is None:
+                result = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            result[batch_idx] = vectors
+        return result if result is not None else np.empty((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts, self.document_prefix).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_array([text], self.query_prefix)[0].tolist()
+
+
+def embed_queries(model: Embeddings, queries: List[str]) -> np.ndarray:
+    """Embed several search queries at once (a single request for OpenAI)"""
+    if not queries:
+        return np.empty((0, 0), dtype=np.float32)
+    if isinstance(model, LocalOnnxEmbeddings):
+        return model.embed_array(queries, model.query_prefix)
+    # OpenAI embeds queries and documents the same way, embed_documents sends one request
+    return np.asarray(model.embed_documents(queries), dtype=np.float32)
+
+
+@lru_cache(maxsize=None)
+def get_embedding_model(backend: str = EMBEDDING_BACKEND) -> Embeddings:
+    """
+    Embedding model selected by config.EMBEDDING_BACKEND ("openai" or "local").
+    The instance is shared by the process, so the local model is loaded only once.
+    """
+    if backend == "local":
+        return LocalOnnxEmbeddings()
+    if backend == "openai":
+        return OpenAIEmbeddings(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+    raise ValueError(f"Неизвестный EMBEDDING_BACKEND: {backend}")
@@ -0,0 +1,70 @@
+# agent/facet_router.py
+
+import re
+from typing import List, Optional, Tuple
+
+from agent.lexical_index import LexicalIndex, normalize_text, tokenize
+from config import RAG_FACET_K, RAG_DEFAULT_FACETS, RAG_FACET_FILTER_KEYS, RAG_FACET_ROUTE_CANDIDATES, RAG_TOP_K
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Facets searched only when the query asks about them (the default facets are always searched)
+FACET_TRIGGERS = {
+    "equipment": re.compile(r"аппарат|оборудован|устройств|прибор"),
+    "directions": re.compile(
+        r"направлен|(какие|каких) (у вас )?(есть )?услуг|чем (вы )?занимает|перечень услуг|список услуг|что (вы )?предлагает"
+    ),
+    "groups": re.compile(
+        r"категори|групп|вид(ы|ов)? (услуг|процедур)|(какие|каких) (у вас )?(есть )?процедур|что (у вас )?(есть|подойдет|поможет|посоветует)"
+    ),
+}
+
+# (facet, k, Chroma-style where filter) of one facet-scoped search
+FacetSearch = Tuple[str, int, dict]
+
+
+def _value_filter(query_terms: set, lexical_index: LexicalIndex, facet: str) -> Optional[dict]:
+    """{key: value} for a filter value of the facet named in the query (all its terms present)"""
+    for key in RAG_FACET_FILTER_KEYS:
+        for value in lexical_index.metadata_values(key, facet):
+            terms = set(tokenize(str(value)))
+            if terms and terms <= query_terms:
+                return {key: value}
+    return None
+
+
+def route(query: str, lexical_index: Optional[LexicalIndex] = None) -> List[FacetSearch]:
+    """
+    Facet-scoped searches for a subquery: the default facets, those the query triggers and the
+    facets of its best BM25 hits, each with its k from RAG_FACET_K, filtered by the facet and by a
+    filter value the query names. Facets missing from the index are skipped. An empty list means
+    the index has no facets (built before the ingestion schema tagged them) and the search is not scoped.
+    """
+    facet_counts = lexical_index.metadata_values("facet") if lexical_index is not None and len(lexical_index) else None
+    if facet_counts is not None and not facet_counts:
+        return []
+
+    text = normalize_text(query)
+    facets = list(RAG_DEFAULT_FACETS)
+    facets += [facet for facet, trigger in FACET_TRIGGERS.items() if facet not in facets and trigger.search(text)]
+    if facet_counts is not None:
+        for doc, _ in lexical_index.search(query, RAG_FACET_ROUTE_CANDIDATES):
+            facet = doc.metadata.get("facet")
+            if facet and facet not in facets:
+                facets.append(facet)
+    query_terms = set(tokenize(query))
+
+    searches = []
+    for facet in facets:
+        if facet_counts is not None and facet not in facet_counts:
+            continue
+        where = {"facet": facet}
+        value_filter = _value_filter(query_terms, lexical_index, facet) if facet_counts is not None else None
+        if value_filter:
+            where = {"$and": [where, value_filter]}
+        searches.append((facet, RAG_FACET_K.get(facet, RAG_TOP_K), where))
+    logger.info(f"[FACET_ROUTER] '{query}' -> {[(facet, k) for facet, k, _ in searches]}")
+    return searches
@@ -0,0 +1,121 @@
+# agent/history.py
+
+import threading
+from collections import OrderedDict
+from typing import List
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+
+from agent.tokenizer import count_tokens
+from config import MAX_HISTORY_LENGTH, HISTORY_TOKEN_BUDGET
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Start of a conversation summary message, see add_messages_custom
+SUMMARY_PREFIX = "Предыдущий диалог:"
+# Content of a ToolMessage whose retrieved texts were already used for an answer
+CONSUMED_TOOL_CONTENT = "[результаты поиска использованы в ответе]"
+
+
+def is_dialog_message(msg: BaseMessage) -> bool:
+    """User messages and final assistant answers, not tool calls and tool results"""
+    return isinstance(msg, HumanMessage) or (
+        isinstance(msg, AIMessage) and not msg.additional_kwargs.get("tool_calls")
+    )
+
+
+def is_summary(msg: BaseMessage) -> bool:
+    return isinstance(msg, HumanMessage) and isinstance(msg.content, str) and msg.content.startswith(SUMMARY_PREFIX)
+
+
+class HistoryManager:
+    """
+    Chat history window for the prompts, bounded by both the number of messages
+    and the number of tokens. The running summary is always kept.
+    Views are cached per state version (message count and ids of the first and last message).
+    """
+
+    def __init__(self, max_messages: int = MAX_HISTORY_LENGTH, max_tokens: int = HISTORY_TOKEN_BUDGET,
+                 cache_size: int = 1024):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.cache_size = cache_size
+        self._views = OrderedDict()
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _message_tokens(self, msg: BaseMessage) -> int:
+        key = (msg.id, len(msg.content)) if msg.id else None
+        if key is not None:
+            with self._lock:
+                if key in self._tokens:
+                    return self._tokens[key]
+        tokens = count_tokens(msg.content if isinstance(msg.content, str) else str(msg.content))
+        if key is not None:
+            with self._lock:
+                self._tokens[key] = tokens
+                while len(self._tokens) > self.cache_size * 4:
+                    self._tokens.popitem(last=False)
+        return tokens
+
+    def chat_history(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """The most recent dialog messages that fit the window"""
+        if not messages:
+            return []
+        version = (len(messages), messages[0].id, messages[-1].id)
+        cacheable = all(version[1:])
+        if cacheable:
+            with self._lock:
+                if version in self._views:
+                    self._views.move_to_end(version)
+                    return list(self._views[version])
+
+        dialog = [msg for msg in messages if is_dialog_message(msg)]
+        summary = dialog[0] if dialog and is_summary(dialog[0]) else None
+        if summary is not None:
+            dialog = dialog[1:]
+
+        budget = self.max_tokens - (self._message_tokens(summary) if summary is not None else 0)
+        limit = self.max_messages - (1 if summary is not None else 0)
+        window = []
+        for msg in reversed(dialog):
+            if len(window) >= limit:
+                break
+            tokens = self._message_tokens(msg)
+            # The latest message is always kept, older ones only while they fit
+            if window and tokens > budget:
+                break
+            window.append(msg)
+            budget -= tokens
+        window.reverse()
+        # The window starts with a user turn, a leading answer without its question is dropped
+        while len(window) > 1 and not isinstance(window[0], HumanMessage):
+            window.pop(0)
+        if summary is not None:
+            window.insert(0, summary)
+
+        if cacheable:
+            with self._lock:
+                self._views[version] = window
+                while len(self._views) > self.cache_size:
+                    self._views.popitem(last=False)
+        return list(window)
+
+    @staticmethod
+    def compact_tool_message(messages: List[BaseMessage], tool_message: ToolMessage) -> None:
+        """
+        Replace the payload of a consumed ToolMessage with a short marker. The message keeps
+        its id, so the add_messages reducer overwrites the stored copy instead of appending.
+        """
+        for i, msg in enumerate(messages):
+            if msg is tool_message:
+                messages[i] = ToolMessage(
+                    content=CONSUMED_TOOL_CONTENT,
+                    tool_call_id=msg.tool_call_id,
+                    name=msg.name,
+                    id=msg.id
+                )
+                return
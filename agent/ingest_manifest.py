@@ -0,0 +1,228 @@
+# agent/ingest_manifest.py
+
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+from agent.file_lock import file_lock
+from config import (
+    INGEST_MANIFEST_PATH, EMBEDDING_BACKEND, LOCAL_EMBEDDING_MODEL, VECTOR_BACKEND,
+    CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNK_MIN_TOKENS, CHUNK_TITLE_COLUMNS
+)
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def ingest_settings() -> dict:
+    """Settings that change the produced documents: a manifest built with other settings is stale"""
+    # Imported here: the schema reads workbooks through the cache, which uses file_sha256 of this module
+    from agent.ingest_schema import ingest_schema
+
+    return {
+        "embedding_backend": EMBEDDING_BACKEND,
+        "local_embedding_model": LOCAL_EMBEDDING_MODEL if EMBEDDING_BACKEND == "local" else None,
+        "vector_backend": VECTOR_BACKEND,
+        "chunk_max_tokens": CHUNK_MAX_TOKENS,
+        "chunk_overlap_tokens": CHUNK_OVERLAP_TOKENS,
+        "chunk_min_tokens": CHUNK_MIN_TOKENS,
+        "chunk_title_columns": CHUNK_TITLE_COLUMNS,
+        "ingest_schema": ingest_schema.fingerprint(),
+    }
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(file_path: str) -> dict:
+    """Size, mtime and content hash of a workbook"""
+    stat_result = os.stat(file_path)
+    return {
+        "size": stat_result.st_size,
+        "mtime_ns": stat_result.st_mtime_ns,
+        "sha256": file_sha256(file_path),
+    }
+
+
+def count_rows(docs) -> int:
+    """Spreadsheet rows behind the documents (merged documents carry "a|b" row ids, chunks share one)"""
+    rows = set()
+    for doc in docs:
+        rows.update(row_id for row_id in str((doc.metadata or {}).get("row_id", "")).split("|") if row_id)
+    return len(rows)
+
+
+def sheet_list(docs) -> Optional[str]:
+    """Sheets the documents come from, in order, joined by ", " """
+    sheets = dict.fromkeys((doc.metadata or {}).get("sheet") for doc in docs)
+    return ", ".join(str(sheet) for sheet in sheets if sheet) or None
+
+
+class IngestManifest:
+    """
+    What was indexed from which file version: path, size, mtime, sha256, row count and document ids
+    per file. Unchanged files are recognised by size + mtime without opening them (the hash is only
+    computed when those differ), so re-ingestion skips the pandas parsing and the embedding calls.
+    """
+
+    def __init__(self, path: str = INGEST_MANIFEST_PATH):
+        self.path = path
+        self.settings = ingest_settings()
+        self.files: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.files
+
+    # ---------- QUERIES ---------- #
+    def get(self, filename: str) -> Optional[dict]:
+        return self.files.get(filename)
+
+    def doc_ids(self, filename: str) -> List[str]:
+        return list((self.files.get(filename) or {}).get("doc_ids", []))
+
+    def is_unchanged(self, filename: str, file_path: str) -> bool:
+        """
+        True if file_path is the version recorded for filename. A touched file (new mtime, same
+        content) is recognised by its hash and its entry is refreshed, a missing file is changed.
+        """
+        entry = self.files.get(filename)
+        if entry is None:
+            return False
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            return False
+        if stat_result.st_size != entry["size"]:
+            return False
+        if stat_result.st_mtime_ns == entry["mtime_ns"]:
+            return True
+        if file_sha256(file_path) != entry["sha256"]:
+            return False
+        with self._lock:
+            entry["mtime_ns"] = stat_result.st_mtime_ns
+        return True
+
+    def summary(self) -> dict:
+        """Totals and per-file details for the status endpoint"""
+        files = [
+            {
+                "filename": filename,
+                **{key: value for key, value in entry.items() if key != "doc_ids"},
+                "doc_count": len(entry.get("doc_ids", [])),
+            }
+            for filename, entry in sorted(self.files.items())
+        ]
+        return {
+            "files_count": len(files),
+            "documents_count": sum(item["doc_count"] for item in files),
+            "rows_count": sum(item.get("row_count", 0) for item in files),
+            "files": files,
+        }
+
+    # ---------- UPDATES ---------- #
+    def record(self, filename: str, file_path: str, doc_ids: List[str], row_count: int,
+               sheet: Optional[str] = None, fingerprint: Optional[dict] = None) -> None:
+        entry = {
+            "path": file_path,
+            **(fingerprint or file_fingerprint(file_path)),
+            "sheet": sheet,
+            "row_count": row_count,
+            "doc_ids": list(doc_ids),
+            "indexed_at": time.time(),
+        }
+        with self._lock:
+            self.files[filename] = entry
+
+    def record_documents(self, docs, ids: List[str], files: Dict[str, Tuple[str, dict]]) -> None:
+        """
+        Record every file of a full build. files maps the filename to its path and the fingerprint
+        taken before the file was read (a file edited during the build stays changed); the documents
+        are grouped by their filename metadata, a file without documents is recorded with no ids.
+        """
+        grouped = {filename: {"docs": [], "ids": []} for filename in files}
+        for doc, doc_id in zip(docs, ids):
+            group = grouped.get((doc.metadata or {}).get("filename"))
+            if group is not None:
+                group["docs"].append(doc)
+                group["ids"].append(doc_id)
+        for filename, group in grouped.items():
+            file_path, fingerprint = files[filename]
+            self.record(filename, file_path, group["ids"], count_rows(group["docs"]), sheet_list(group["docs"]), fingerprint)
+
+    def put(self, filename: str, entry: dict) -> None:
+        """Store an entry taken from another copy of the manifest"""
+        with self._lock:
+            self.files[filename] = dict(entry)
+
+    def remove(self, filename: str) -> Optional[dict]:
+        with self._lock:
+            return self.files.pop(filename, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.files.clear()
+            self.settings = ingest_settings()
+
+    # ---------- PERSISTENCE ---------- #
+    def save(self) -> None:
+        """Atomically write the manifest next to the vector store"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            payload = {"version": 1, "settings": self.settings, "files": self.files}
+            tmp_path = f"{self.path}.{uuid4().hex}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    @classmethod
+    @contextmanager
+    def locked(cls, path: str = INGEST_MANIFEST_PATH) -> Iterator["IngestManifest"]:
+        """
+        Read-modify-write of the manifest under its file lock: yields the current manifest and saves
+        it on exit (not when the block raises). API, bot and file watcher processes update it concurrently.
+        """
+        with file_lock(path):
+            manifest = cls.load(path)
+            yield manifest
+            manifest.save()
+
+    @classmethod
+    def load(cls, path: str = INGEST_MANIFEST_PATH) -> "IngestManifest":
+        """
+        Load the manifest. Built with other chunking or embedding settings it is returned marked
+        stale (no files are unchanged) but keeps the document ids so the old documents can be removed.
+        """
+        manifest = cls(path)
+        if not os.path.exists(path):
+            return manifest
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+            manifest.files = payload.get("files", {})
+            if payload.get("settings") != manifest.settings:
+                logger.info("[INGEST_MANIFEST] Настройки индексации изменились, все файлы будут переиндексированы")
+                for entry in manifest.files.values():
+                    entry["sha256"] = None
+                    entry["size"] = -1
+        except Exception as e:
+            logger.error(f"[INGEST_MANIFEST] Ошибка при загрузке манифеста {path}: {e}")
+            manifest = cls(path)
+        return manifest
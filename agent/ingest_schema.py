@@ -0,0 +1,288 @@
+# agent/ingest_schema.py
+
+import hashlib
+import json
+import os
+import unicodedata
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+from langchain_core.documents import Document
+
+from config import INGEST_SCHEMA_PATH
+from agent.chunking import chunk_sheet, is_empty
+from agent.workbook_cache import WorkbookCache, workbook_cache, normalize_name
+from agent.ingest_manifest import file_sha256
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Per-workbook ingestion schema. A workbook is matched by a substring of its file name, for each of
+# its sheets (a name, "*" for all sheets, the first sheet if "sheets" is omitted):
+#   content  - columns rendered into the document text, in this order (all read columns by default,
+#              except the metadata-only ones)
+#   metadata - {column: key} stored in the document metadata, not embedded unless also in content
+#   filters  - {column: key} stored in the metadata with normalized text values, used to filter
+#              retrieval (the column stays in the text)
+#   types    - {column: "str" | "int" | "float"} coercion, cells that do not convert are kept as is
+#   fill_down - columns whose empty cells take the value above (merged cells of grouped rows)
+#   facet    - part of the knowledge base the documents belong to (metadata "facet"), rag_search
+#              runs separate filtered searches per facet (agent/facet_router.py)
+# Only the columns named in the sheet schema are parsed when content is given.
+# Workbooks matched by no entry are read as before: the first sheet, every column, facet "general".
+DEFAULT_SCHEMA = {
+    "workbooks": [
+        {
+            "match": "салон клиника FAQ",
+            "sheets": [
+                {
+                    "name": "клиника.салон",
+                    "content": [
+                        "Категория", "Услуга/Препарат", "Терапевтическая цель", "Показания (типичные проблемы)",
+                        "Противопоказания (стандартные + уточнения)", "Описание технологии", "Детали",
+                        "Цена (руб)", "Место оказания услуг", "Столбец1"
+                    ],
+                    "metadata": {"ID услуги из CRM": "crm_id", "Цена (руб)": "price"},
+                    "filters": {"Категория": "category", "Место оказания услуг": "location"},
+                    "types": {"ID услуги из CRM": "str", "Цена (руб)": "int"},
+                    "fill_down": ["Категория"],
+                    "facet": "services",
+                },
+                {
+                    "name": "FAQ",
+                    "content": ["Вопрос", "Ответ"],
+                    "facet": "faq",
+                },
+            ],
+        },
+        {
+            "match": "описание услуг",
+            "sheets": [
+                {
+                    "name": "*",
+                    "content": [
+                        "Название услуги", "Часть тела/ зона", "Терапевтическая цель", "Показания (типичные проблемы)",
+                        "Противопоказания (стандартные + уточнения)", "Описание технологии", "Детали",
+                        "Цена (руб)", "Место оказания услуг"
+                    ],
+                    "metadata": {"ID услуги из CRM": "crm_id", "Цена (руб)": "price"},
+                    "filters": {"Часть тела/ зона": "zone", "Место оказания услуг": "location"},
+                    "types": {"ID услуги из CRM": "str", "Цена (руб)": "int"},
+                    "facet": "services",
+                },
+            ],
+        },
+        {
+            "match": "группировка услуг",
+            "sheets": [
+                {
+                    "name": "*",
+                    "content": ["Категория услуги", "Суть", "Перечень услуг категории", "Направление усдуги"],
+                    "filters": {"Категория услуги": "category", "Направление усдуги": "direction"},
+                    "facet": "groups",
+                },
+            ],
+        },
+        {
+            "match": "Направления услуг",
+            "sheets": [
+                {
+                    "name": "*",
+                    "content": ["Направление", "Перечень категорий направления"],
+                    "filters": {"Направление": "direction"},
+                    "facet": "directions",
+                },
+            ],
+        },
+        {
+            "match": "Оборудование",
+            "sheets": [
+                {
+                    "name": "*",
+                    "content": ["Название оборудования", "Описание оборудования"],
+                    "filters": {"Название оборудования": "equipment"},
+                    "facet": "equipment",
+                },
+            ],
+        },
+    ],
+}
+
+
+DEFAULT_FACET = "general"
+
+
+def normalize_filter_value(value) -> str:
+    """Filter value as stored and compared: NFC, whitespace collapsed, case kept"""
+    return normalize_name(value)
+
+
+# ---------- TYPE COERCION ---------- #
+def _to_number(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return float(str(value).replace("\xa0", "").replace(" ", "").replace(",", "."))
+
+
+def coerce_value(value, type_name: str):
+    """Cell converted to the schema type, None for empty cells, the original value if it does not convert"""
+    if is_empty(value):
+        return None
+    try:
+        if type_name == "str":
+            if isinstance(value, float) and value.is_integer():
+                return str(int(value))
+            return str(value).strip()
+        if type_name == "int":
+            number = _to_number(value)
+            return int(number) if float(number).is_integer() else value
+        if type_name == "float":
+            return float(_to_number(value))
+    except (TypeError, ValueError):
+        return value
+    raise ValueError(f"Неизвестный тип колонки: {type_name}")
+
+
+# ---------- SCHEMA ---------- #
+class SheetSchema:
+    """Columns of one sheet that become the text, the metadata and the filters of its documents"""
+
+    def __init__(self, name: str = None, content: Optional[List[str]] = None, metadata: Optional[Dict[str, str]] = None,
+                 filters: Optional[Dict[str, str]] = None, types: Optional[Dict[str, str]] = None,
+                 fill_down: Optional[List[str]] = None, facet: str = DEFAULT_FACET):
+        self.name = name
+        self.facet = facet
+        self.content = [normalize_name(column) for column in content] if content is not None else None
+        self.metadata = {normalize_name(column): key for column, key in (metadata or {}).items()}
+        self.filters = {normalize_name(column): key for column, key in (filters or {}).items()}
+        self.types = {normalize_name(column): type_name for column, type_name in (types or {}).items()}
+        self.fill_down = [normalize_name(column) for column in (fill_down or [])]
+
+    @property
+    def usecols(self) -> Optional[List[str]]:
+        """Columns to parse: everything the schema names, all columns if content is not restricted"""
+        if self.content is None:
+            return None
+        return list(dict.fromkeys([*self.content, *self.metadata, *self.filters]))
+
+    def prepare(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Normalized headers, merged cells filled down and coerced column types"""
+        df = df.rename(columns=normalize_name)
+        missing = [column for column in (self.usecols or []) if column not in df.columns]
+        if missing:
+            logger.warning(f"[INGEST_SCHEMA] Лист {self.name}: нет колонок {missing}")
+        for column in self.fill_down:
+            if column in df.columns:
+                df[column] = df[column].mask(df[column].map(is_empty)).ffill()
+        for column, type_name in self.types.items():
+            if column in df.columns:
+                df[column] = df[column].map(lambda value: coerce_value(value, type_name)).astype(object)
+        return df
+
+    def content_columns(self, df: pd.DataFrame) -> List[str]:
+        if self.content is None:
+            return [column for column in df.columns if column not in self.metadata or column in self.filters]
+        return [column for column in self.content if column in df.columns]
+
+    def row_metadata(self, row) -> dict:
+        """Metadata and filter values of a row, empty cells left out"""
+        values = {}
+        for column, key in self.metadata.items():
+            value = row.get(column)
+            if not is_empty(value):
+                values[key] = value if isinstance(value, (str, int, float, bool)) else str(value)
+        for column, key in self.filters.items():
+            value = row.get(column)
+            if not is_empty(value):
+                values[key] = normalize_filter_value(value)
+        return values
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "content": self.content, "metadata": self.metadata,
+                "filters": self.filters, "types": self.types, "fill_down": self.fill_down, "facet": self.facet}
+
+
+class WorkbookSchema:
+    """Sheets of a workbook to ingest, matched by a substring of the file name"""
+
+    def __init__(self, match: str = "", sheets: Optional[List[dict]] = None):
+        self.match = match
+        self.sheets = [SheetSchema(**sheet) for sheet in sheets] if sheets is not None else None
+
+    def matches(self, filename: str) -> bool:
+        return normalize_name(self.match).casefold() in normalize_name(filename).casefold()
+
+    def select(self, sheet_names: List[str]) -> List[Tuple[str, SheetSchema]]:
+        """(sheet name in the workbook, its schema) in workbook order"""
+        if not self.sheets:
+            return [(sheet_names[0], SheetSchema(sheet_names[0]))] if sheet_names else []
+        selected = []
+        for sheet_name in sheet_names:
+            key = normalize_name(sheet_name).casefold()
+            sheet_schema = next(
+                (schema for schema in self.sheets if schema.name == "*" or normalize_name(schema.name).casefold() == key),
+                None
+            )
+            if sheet_schema is not None:
+                selected.append((sheet_name, sheet_schema))
+        named = {normalize_name(schema.name).casefold() for schema in self.sheets if schema.name != "*"}
+        absent = named - {normalize_name(sheet_name).casefold() for sheet_name in sheet_names}
+        if absent:
+            logger.warning(f"[INGEST_SCHEMA] В книге нет листов {sorted(absent)} (есть {sheet_names})")
+        return selected
+
+
+class IngestSchema:
+    """Workbook schemas in order, the first matching one applies"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.workbooks = [WorkbookSchema(**workbook) for workbook in config.get("workbooks", [])]
+        self.default = WorkbookSchema(**config.get("default", {}))
+
+    def for_file(self, filename: str) -> WorkbookSchema:
+        filename = unicodedata.normalize("NFC", filename)
+        return next((workbook for workbook in self.workbooks if workbook.matches(filename)), self.default)
+
+    def fingerprint(self) -> str:
+        """Hash of the schema: documents ingested with another schema are re-indexed"""
+        return hashlib.md5(json.dumps(self.config, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def load(cls, path: Optional[str] = INGEST_SCHEMA_PATH) -> "IngestSchema":
+        """Schema from the JSON file at path (same structure as DEFAULT_SCHEMA), DEFAULT_SCHEMA otherwise"""
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    return cls(json.load(f))
+            except Exception as e:
+                logger.error(f"[INGEST_SCHEMA] Ошибка при загрузке схемы {path}, используется схема по умолчанию: {e}")
+        return cls(DEFAULT_SCHEMA)
+
+
+ingest_schema = IngestSchema.load()
+
+
+# ---------- READING ---------- #
+def read_workbook(file_path: str, file_hash: Optional[str] = None,
+                  cache: Optional[WorkbookCache] = None) -> List[Tuple[str, pd.DataFrame, SheetSchema]]:
+    """(sheet name, prepared DataFrame, sheet schema) of the sheets the schema selects, only the needed columns parsed"""
+    cache = cache or workbook_cache
+    file_hash = file_hash or (file_sha256(file_path) if cache.enabled else None)
+    workbook_schema = ingest_schema.for_file(os.path.basename(file_path))
+    selected = workbook_schema.select(cache.sheet_names(file_path, file_hash))
+    frames = cache.read_sheets(file_path, {sheet_name: schema.usecols for sheet_name, schema in selected}, file_hash)
+    return [(sheet_name, schema.prepare(frames[sheet_name]), schema) for sheet_name, schema in selected]
+
+
+def sheet_documents(df: pd.DataFrame, sheet_schema: SheetSchema, metadata: dict, **chunk_kwargs: Any) -> List[Document]:
+    """Documents of a prepared sheet: schema content columns as text, metadata and filters per row"""
+    return chunk_sheet(
+        df,
+        metadata={**metadata, "facet": sheet_schema.facet} if sheet_schema.facet else metadata,
+        content_columns=sheet_schema.content_columns(df),
+        row_metadata=sheet_schema.row_metadata,
+        **chunk_kwargs
+    )
@@ -0,0 +1,337 @@
+# agent/lexical_index.py
+
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+from langchain_core.documents import Document
+
+from agent.file_lock import file_lock
+from agent.numpy_index import matches_filter
+from config import LEXICAL_INDEX_PATH
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# ---------- RUSSIAN STEMMER ---------- #
+# Porter stemmer for Russian (snowball rules in regexp form)
+_RVRE = re.compile(r"^(.*?[аеиоуыэюя])(.*)$")
+_PERFECTIVE_GERUND = re.compile(r"((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$")
+_REFLEXIVE = re.compile(r"(с[яь])$")
+_ADJECTIVE = re.compile(r"(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$")
+_PARTICIPLE = re.compile(r"((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$")
+_VERB = re.compile(
+    r"((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)"
+    r"|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$"
+)
+_NOUN = re.compile(r"(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$")
+_DERIVATIONAL = re.compile(r".*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$")
+_DER = re.compile(r"ость?$")
+_SUPERLATIVE = re.compile(r"(ейше|ейш)$")
+_I = re.compile(r"и$")
+_P = re.compile(r"ь$")
+_NN = re.compile(r"нн$")
+
+_TOKEN_RE = re.compile(r"[a-zа-я0-9]+")
+
+STOP_WORDS = {
+    "и", "в", "во", "на", "с", "со", "по", "к", "ко", "о", "об", "от", "до", "для", "из", "у", "за",
+    "а", "но", "или", "ли", "же", "бы", "не", "ни", "что", "как", "это", "то", "мне", "я", "вы", "вас",
+    "вам", "мы", "есть", "при", "без", "под", "над", "так", "все", "его", "ее", "их",
+}
+
+
+@lru_cache(maxsize=100_000)
+def stem(word: str) -> str:
+    """Reduce a Russian word to its stem. Non-cyrillic tokens are returned as is"""
+    match = _RVRE.match(word)
+    if not match:
+        return word
+    prefix, rv = match.groups()
+
+    temp = _PERFECTIVE_GERUND.sub("", rv, 1)
+    if temp == rv:
+        rv = _REFLEXIVE.sub("", rv, 1)
+        temp = _ADJECTIVE.sub("", rv, 1)
+        if temp != rv:
+            rv = _PARTICIPLE.sub("", temp, 1)
+        else:
+            temp = _VERB.sub("", rv, 1)
+            rv = _NOUN.sub("", rv, 1) if temp == rv else temp
+    else:
+        rv = temp
+
+    rv = _I.sub("", rv, 1)
+    if _DERIVATIONAL.match(rv):
+        rv = _DER.sub("", rv, 1)
+
+    temp = _P.sub("", rv, 1)
+    if temp == rv:
+        rv = _SUPERLATIVE.sub("", rv, 1)
+        rv = _NN.sub("н", rv, 1)
+    else:
+        rv = temp
+
+    return prefix + rv
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, replace ё and collapse whitespace"""
+    return " ".join(str(text).lower().replace("ё", "е").split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into stemmed terms without stop words"""
+    return [
+        stem(token)
+        for token in _TOKEN_RE.findall(normalize_text(text))
+        if token not in STOP_WORDS
+    ]
+
+
+def _field_values(text: str) -> List[str]:
+    """Values of the "column: value" lines of a spreadsheet row"""
+    values = []
+    for line in text.split("\n"):
+        _, sep, value = line.partition(": ")
+        value = normalize_text(value if sep else line)
+        if value and len(value) <= 120:
+            values.append(value)
+    return values
+
+
+# ---------- INDEX ---------- #
+class LexicalIndex:
+    """
+    In-process BM25 inverted index over the knowledge base documents.
+    Documents share their ids with the vector store so the result lists can be fused.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents: Dict[str, dict] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._exact_values: Dict[str, List[str]] = {}
+        self._metadata_values: Dict[Tuple[str, Optional[str]], Counter] = {}
+        self._filter_ids: Dict[str, set] = {}
+        self._avg_length = 0.0
+
+    def __len__(self):
+        return len(self.documents)
+
+    # ----- building -----
+    def add_documents(self, documents: List[Document], ids: List[str]) -> None:
+        """Add documents with the same ids they have in the vector store"""
+        for doc_id, doc in zip(ids, documents):
+            text = doc.page_content or ""
+            self.documents[doc_id] = {
+                "text": text,
+                "metadata": dict(doc.metadata or {}),
+                "terms": dict(Counter(tokenize(text)))
+            }
+        self._rebuild()
+
+    def delete(self, ids: List[str]) -> None:
+        for doc_id in ids:
+            self.documents.pop(doc_id, None)
+        self._rebuild()
+
+    def delete_by_filename(self, filename: str) -> int:
+        ids = [
+            doc_id for doc_id, entry in self.documents.items()
+            if entry["metadata"].get("filename") == filename
+        ]
+        self.delete(ids)
+        return len(ids)
+
+    def clear(self) -> None:
+        self.documents = {}
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        """Rebuild postings from the stored term frequencies"""
+        postings: Dict[str, Dict[str, int]] = {}
+        exact_values: Dict[str, List[str]] = {}
+        total_length = 0
+
+        for doc_id, entry in self.documents.items():
+            terms = entry["terms"]
+            entry["length"] = sum(terms.values())
+            total_length += entry["length"]
+            for term, tf in terms.items():
+                postings.setdefault(term, {})[doc_id] = tf
+            for value in _field_values(entry["text"]):
+                exact_values.setdefault(value, []).append(doc_id)
+
+        self._postings = postings
+        self._exact_values = exact_values
+        self._metadata_values = {}
+        self._filter_ids = {}
+        self._avg_length = total_length / len(self.documents) if self.documents else 0.0
+
+    # ----- search -----
+    def _to_document(self, doc_id: str) -> Document:
+        entry = self.documents[doc_id]
+        return Document(page_content=entry["text"], metadata=entry["metadata"], id=doc_id)
+
+    def _allowed_ids(self, where: dict) -> set:
+        """Ids of the documents matching the filter, computed once per filter and index version"""
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        if key not in self._filter_ids:
+            self._filter_ids[key] = {
+                doc_id for doc_id, entry in self.documents.items() if matches_filter(entry["metadata"], where)
+            }
+        return self._filter_ids[key]
+
+    def idf(self, term: str) -> float:
+        """BM25 inverse document frequency of a stemmed term, 0 for terms not in the index"""
+        posting = self._postings.get(term)
+        if not posting:
+            return 0.0
+        return math.log(1 + (len(self.documents) - len(posting) + 0.5) / (len(posting) + 0.5))
+
+    def document_terms(self, doc_id: str) -> Optional[Dict[str, int]]:
+        """Stemmed term frequencies of an indexed document, None for unknown ids"""
+        entry = self.documents.get(doc_id)
+        return entry["terms"] if entry is not None else None
+
+    def _scores(self, terms: List[str], allowed: Optional[set] = None) -> Dict[str, float]:
+        scores: Dict[str, float] = {}
+        for term in set(terms):
+            posting = self._postings.get(term)
+            if not posting:
+                continue
+            idf = self.idf(term)
+            for doc_id, tf in posting.items():
+                if allowed is not None and doc_id not in allowed:
+                    continue
+                length_norm = 1 - self.b + self.b * self.documents[doc_id]["length"] / self._avg_length
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+        return scores
+
+    def search(self, query: str, k: int = 5, where: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        """BM25 top-k documents for the query, only documents matching the Chroma-style where filter"""
+        scores = self._scores(tokenize(query), self._allowed_ids(where) if where else None)
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self._to_document(doc_id), score) for doc_id, score in top]
+
+    def exact_matches(self, query: str, k: int = 5) -> List[Tuple[Document, float]]:
+        """
+        Documents where a whole field equals the query (exact service or device name).
+        A single dictionary lookup, so it costs microseconds and needs no embedding.
+        Generic values shared by more than k rows (e.g. "клиника") are not exact matches;
+        chunks of one long row share its title and count as a single row. At most k documents
+        are returned, the chunks of the matched rows beyond them are dropped.
+        """
+        doc_ids = self._exact_values.get(normalize_text(query))
+        if not doc_ids:
+            return []
+        rows = {self.documents[doc_id]["metadata"].get("row_id", doc_id) for doc_id in doc_ids}
+        if len(rows) > k:
+            return []
+        # The shortest document is the most specific one (the row of the service itself)
+        ranked = sorted(doc_ids, key=lambda doc_id: self.documents[doc_id]["length"])
+        return [(self._to_document(doc_id), 1.0) for doc_id in ranked[:k]]
+
+    def metadata_values(self, key: str, facet: Optional[str] = None) -> Counter:
+        """Document count per value of a metadata field (within a facet), computed once per index version"""
+        cache_key = (key, facet)
+        if cache_key not in self._metadata_values:
+            self._metadata_values[cache_key] = Counter(
+                entry["metadata"][key] for entry in self.documents.values()
+                if key in entry["metadata"] and (facet is None or entry["metadata"].get("facet") == facet)
+            )
+        return self._metadata_values[cache_key]
+
+    # ----- persistence -----
+    def save(self, path: str = LEXICAL_INDEX_PATH) -> None:
+        """Atomically write the index next to the vector store"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = {
+            "version": 1,
+            "documents": [
+                {"id": doc_id, "text": entry["text"], "metadata": entry["metadata"], "terms": entry["terms"]}
+                for doc_id, entry in self.documents.items()
+            ]
+        }
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    @contextmanager
+    def locked(cls, path: str = LEXICAL_INDEX_PATH) -> Iterator["LexicalIndex"]:
+        """Load -> modify -> save under the index file lock (the index is updated from several processes)"""
+        with file_lock(path):
+            index = cls.load(path)
+            yield index
+            index.save(path)
+
+    @classmethod
+    def load(cls, path: str = LEXICAL_INDEX_PATH) -> "LexicalIndex":
+        """Load the index, an empty one is returned if it was never built"""
+        index = cls()
+        if not os.path.exists(path):
+            return index
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+            for item in payload.get("documents", []):
+                index.documents[item["id"]] = {
+                    "text": item["text"],
+                    "metadata": item["metadata"],
+                    "terms": item["terms"]
+                }
+            index._rebuild()
+        except Exception as e:
+            logger.error(f"[LEXICAL_INDEX] Ошибка при загрузке индекса {path}: {e}")
+            index = cls()
+        return index
+
+
+# ---------- FUSION ---------- #
+def _doc_key(doc: Document):
+    return doc.id or (doc.metadata.get("source"), doc.page_content)
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Document]], k: int, rrf_k: int = 60) -> List[Tuple[Document, float]]:
+    """Merge several ranked lists: score(d) = sum(1 / (rrf_k + rank))"""
+    scores = {}
+    documents = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, start=1):
+            key = _doc_key(doc)
+            documents.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [(documents[key], scores[key]) for key in ranked[:k]]
+
+
+# ---------- SHARED INSTANCE ---------- #
+_index_lock = threading.Lock()
+_loaded_index: Optional[LexicalIndex] = None
+_loaded_generation: Optional[str] = None
+
+
+def get_lexical_index(generation: str) -> LexicalIndex:
+    """Lexical index for the given index generation, reloaded from disk only when it changes"""
+    global _loaded_index, _loaded_generation
+    with _index_lock:
+        if _loaded_index is None or _loaded_generation != generation:
+            _loaded_index = LexicalIndex.load()
+            _loaded_generation = generation
+            logger.info(f"[LEXICAL_INDEX] Загружен лексический индекс: {len(_loaded_index)} документов")
+        return _loaded_index
@@ -19,6 +19,12 @@ class MessageClassifier:
     
     def __init__(self, llm: ChatOpenAI):
         self.llm = llm
+        # Промпт компилируется один раз, системная часть одинакова для всех клиентов
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", IRRELEVANT_CLASSIFICATION_PROMPT),
+            ("human", "{query}")
+        ])
+        self.chain = prompt | self.llm
     
     def extract_classification_variables(self, llm_response: str) -> Dict[str, int]:
         """
@@ -100,28 +106,19 @@ class MessageClassifier:
             logger.error(f"[CLASSIFIER] Ошибка извлечения чистого ответа: {e}")
             return llm_response.strip()
     
-    def classify_message(self, user_message: str, client_name: str = "клиент", gender: str = "неизвестен") -> Tuple[str, Dict[str, int]]:
+    def classify_message(self, user_message: str) -> Tuple[str, Dict[str, int]]:
         """
         Классифицирует сообщение пользователя и возвращает ответ с переменными
         
         Args:
             user_message: Сообщение пользователя
-            client_name: Имя клиента
-            gender: Пол клиента
             
         Returns:
             Кортеж (чистый_ответ, переменные_классификации)
         """
         try:
-            # Создаем промпт для классификации
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", IRRELEVANT_CLASSIFICATION_PROMPT.format(client_name=client_name, gender=gender)),
-                ("human", "{query}")
-            ])
-            
             # Получаем ответ от LLM
-            chain = prompt | self.llm
-            response = chain.invoke({"query": user_message})
+            response = self.chain.invoke({"query": user_message})
             
             if not isinstance(response, AIMessage):
                 logger.error(f"[CLASSIFIER] Неожиданный тип ответа: {type(response)}")
@@ -0,0 +1,205 @@
+# agent/metrics.py
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Optional, Tuple
+
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Trace id of the current ConsultationAgent.run: the session id (TalkMe user_id / Telegram user id)
+trace_id_var: ContextVar[str] = ContextVar("trace_id", default="-")
+# Node timings of the current run, shared by the nodes of one graph invocation
+run_timings_var: ContextVar[Optional[Dict[str, float]]] = ContextVar("run_timings", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# ---------- METRIC TYPES ---------- #
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return "\n".join(lines)
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing value"""
+    type_name = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def _samples(self):
+        for key, state in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, state["counts"]):
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {state['count']}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {state['sum']}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {state['count']}"
+
+
+class MetricsRegistry:
+    """Process-wide metrics rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = MetricsRegistry()
+
+# ---------- PIPELINE METRICS ---------- #
+RUNS = registry.counter("iteira_agent_runs_total", "ConsultationAgent.run calls")
+RUN_DURATION = registry.histogram("iteira_agent_run_duration_seconds", "Duration of ConsultationAgent.run")
+NODE_DURATION = registry.histogram("iteira_agent_node_duration_seconds", "Duration of a graph node", ["node"])
+LLM_TOKENS = registry.counter(
+    "iteira_llm_tokens_total", "LLM tokens by node and type (prompt, completion, cached)", ["node", "type"]
+)
+RETRIEVAL_EVENTS = registry.counter(
+    "iteira_retrieval_events_total", "rag_search subqueries by outcome (cache_hit, cache_miss, exact_match, vector, facet, rerank, rerank_partial)", ["outcome"]
+)
+RETRIEVAL_DOCUMENTS = registry.histogram(
+    "iteira_retrieval_documents", "Documents in the packed rag_search context", buckets=(0, 1, 2, 3, 5, 8, 13, 21)
+)
+ERRORS = registry.counter("iteira_errors_total", "Errors by component", ["component"])
+
+
+def current_trace_id() -> str:
+    return trace_id_var.get()
+
+
+def record_error(component: str) -> None:
+    ERRORS.inc(component=component)
+
+
+def record_llm_usage(node: str, usage: Optional[dict]) -> None:
+    """Token counters from the usage_metadata of an LLM response"""
+    if not usage:
+        return
+    LLM_TOKENS.inc(usage.get("input_tokens", 0) or 0, node=node, type="prompt")
+    LLM_TOKENS.inc(usage.get("output_tokens", 0) or 0, node=node, type="completion")
+    cached = (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+    LLM_TOKENS.inc(cached, node=node, type="cached")
+
+
+def timed_node(name: str, func):
+    """Wrap a graph node: duration histogram, error counter and the per-run timings"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            record_error(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            NODE_DURATION.observe(elapsed, node=name)
+            timings = run_timings_var.get()
+            if timings is not None:
+                timings[name] = timings.get(name, 0.0) + elapsed
+    return wrapper
+
+
+@contextmanager
+def trace_run(trace_id: str):
+    """Around ConsultationAgent.run: sets the trace id and logs the node timings of the run"""
+    trace_token = trace_id_var.set(trace_id)
+    timings: Dict[str, float] = {}
+    timings_token = run_timings_var.set(timings)
+    start = time.perf_counter()
+    try:
+        yield timings
+    except Exception:
+        record_error("run")
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        RUNS.inc()
+        RUN_DURATION.observe(elapsed)
+        details = ", ".join(f"{node}={seconds:.3f}s" for node, seconds in timings.items())
+        logger.info(f"[METRICS][trace={trace_id}] run {elapsed:.3f}s: {details}")
+        run_timings_var.reset(timings_token)
+        trace_id_var.reset(trace_token)
@@ -0,0 +1,151 @@
+# agent/name_extractor.py
+
+import re
+from typing import Optional
+
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# ---------- GAZETTEER ---------- #
+# Common Russian first names and their everyday short forms (ё written as е)
+FEMALE_NAMES = set("""
+агата агния ада аделина азалия айгуль аксинья алевтина алена алина алиса алла альбина альфия амалия анастасия настя
+ангелина анжела анжелика анна аня анюта антонина тоня арина ариана ася белла берта валентина валерия лера варвара варя
+василиса вера вероника верочка виктория вика виолетта влада владислава галина галя гульнара дана дарина дарья даша
+диана дина доминика ева евгения евдокия екатерина катя катерина елена лена елизавета лиза жанна зарина злата зинаида
+зоя изабелла илона инга инесса инна ирина ира ирэна камила камилла карина каролина кира клавдия кристина ксения ксюша
+лада лариса лейла леся лиана лидия лилиана лилия лиля лолита любовь люба людмила люда мадина майя маргарита рита марианна
+марина мария маша марта марьям марьяна мелания милана мила милена мирослава надежда надя наталья наталия наташа нелли
+нина нонна оксана олеся ольга оля полина раиса регина римма роза руслана сабина самира светлана света снежана софия
+софья соня станислава стефания сусанна таисия тамара татьяна таня ульяна фаина элеонора элина элла эльвира эльмира
+эмилия эвелина юлиана юлия юля яна ярослава
+""".split())
+
+MALE_NAMES = set("""
+августин адам айдар аким алан александр алексей леша алик альберт амир анатолий толя андрей антон аркадий арсен
+арсений артем артур богдан борис вадим валерий василий вася вениамин виктор витя виталий владимир вова володя
+владислав влад всеволод вячеслав гавриил геннадий гена георгий гоша герман глеб григорий гриша давид даниил данил
+даниэль даня демид денис дмитрий дима евгений егор ефим захар зиновий иван ваня игнат игорь илья ильдар ильнур ислам
+камиль карен кирилл клим константин костя лев леонид леня лука любомир макар максим макс марат марк матвей мирон
+михаил миша назар никита николай коля олег павел паша петр петя платон прохор радик ренат ринат родион роман рома
+ростислав рубен руслан рустам савва савелий святослав семен сергей сережа серега станислав стас степан тагир тарас
+тимофей тимур тихон федор федя феликс филипп фома эдуард эльдар эмиль эрик юрий юра яков ян ярослав
+""".split())
+
+# Names used for both genders, the LLM decides
+AMBIGUOUS_NAMES = {"саша", "шура", "женя", "валя", "слава", "ника", "сева", "мишель", "славик"}
+
+# ---------- PATTERNS ---------- #
+GREETING_WORDS = {
+    "здравствуйте", "здравствуй", "здрасте", "привет", "приветствую", "добрый", "доброе",
+    "доброго", "день", "дня", "вечер", "вечера", "утро", "утра", "хай", "hello", "hi", "start", "алло",
+}
+# Words introducing the name: "меня зовут Анна", "я Анна", "это Анна", "мое имя Анна"
+CUE_WORDS = {"зовут", "я", "это", "имя", "меня", "зовите", "называйте", "обращайтесь", "мое", "моё"}
+FILLER_WORDS = GREETING_WORDS | CUE_WORDS | {
+    "пожалуйста", "ко", "мне", "можно", "просто", "и", "а", "вас", "вам", "спасибо",
+}
+# Substrings of a question about services: such a message is answered right away
+SERVICE_STEMS = (
+    "стриж", "маникюр", "педикюр", "массаж", "окраш", "эпиляц", "космет", "бров", "ресниц", "уход", "лазер",
+    "пилинг", "ботокс", "чистк", "процедур", "цен", "стоим", "сколько", "запис", "кож", "волос", "ногт",
+    "лиц", "аппарат", "услуг", "инъекц", "биоревит", "мезотерап", "лифтинг", "lpg", "подтяжк", "морщин",
+    "акне", "пигмент", "прием", "приём", "врач", "консультац", "адрес", "телефон", "работаете",
+)
+SURNAME_RE = re.compile(r"(ов|ев|ин|ова|ева|ина|ский|ская|цкий|цкая|вич|вна|ична|чна|ко|ук|юк|ян)$")
+
+_WORD_RE = re.compile(r"[а-яa-z]+(?:-[а-яa-z]+)?")
+
+GENDER_FEMALE = "женский"
+GENDER_MALE = "мужской"
+GENDER_UNKNOWN = "неизвестен"
+DEFAULT_CLIENT_NAME = "клиент"
+
+GREETING_RESPONSE = "Здравствуйте! Подскажите, пожалуйста, как к Вам обращаться?"
+
+
+def _normalize(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+
+def name_gender(name: str) -> Optional[str]:
+    """Gender of a first name from the gazetteer, None for unknown and ambiguous names"""
+    key = _normalize(name)
+    if key in AMBIGUOUS_NAMES:
+        return None
+    if key in FEMALE_NAMES:
+        return GENDER_FEMALE
+    if key in MALE_NAMES:
+        return GENDER_MALE
+    return None
+
+
+def _is_known_name(word: str) -> bool:
+    return word in FEMALE_NAMES or word in MALE_NAMES or word in AMBIGUOUS_NAMES
+
+
+def extract_identity(message: str) -> Optional[dict]:
+    """
+    Resolve the client's name and gender from a message without the LLM.
+
+    Returns:
+        dict with client_name, gender and response (None - do not answer, go on to the consultation),
+        or None when the message is ambiguous and IDENTIFICATION_PROMPT has to decide
+    """
+    if not message or not message.strip():
+        return None
+    normalized = _normalize(message)
+    words = _WORD_RE.findall(normalized)
+    has_service_request = any(stem in normalized for stem in SERVICE_STEMS) or "?" in message
+
+    # Known names: after a cue word, alone in the message or addressed before a comma
+    content_words = [word for word in words if word not in FILLER_WORDS]
+    names = []
+    for i, word in enumerate(words):
+        if not _is_known_name(word):
+            continue
+        after_cue = i > 0 and words[i - 1] in CUE_WORDS
+        alone = content_words and content_words[0] == word and all(
+            SURNAME_RE.search(other) for other in content_words[1:3]
+        ) and len(content_words) <= 3
+        addressed = bool(re.search(rf"(^|[\s,.!]){re.escape(word)}\s*,", normalized)) and content_words[:1] == [word]
+        if after_cue or alone or addressed:
+            names.append(word)
+
+    # Several names in one message ("я Анна и Мария") are left to the LLM
+    if len(set(names) | {word for word in content_words if _is_known_name(word)}) > 1:
+        return None
+    if names:
+        name = names[0]
+        gender = name_gender(name)
+        if gender is None:
+            return None
+        # The name as the client wrote it, in its initial form
+        original = next(
+            (m.group(0) for m in re.finditer(r"[А-Яа-яЁё]+", message) if _normalize(m.group(0)) == name),
+            name
+        )
+        client_name = original[:1].upper() + original[1:].lower()
+        rest = [word for word in content_words if word != name and not SURNAME_RE.search(word)]
+        if rest and has_service_request:
+            # "Я Анна, сколько стоит маникюр?" - remember the name and answer the question
+            return {"client_name": client_name, "gender": gender, "response": None}
+        if len(rest) > 1:
+            return None
+        return {
+            "client_name": client_name,
+            "gender": gender,
+            "response": f"{client_name}, расскажите, какая процедура Вас интересует?"
+        }
+
+    if has_service_request and content_words:
+        # A question about services without a name: no need to ask for it
+        return {"client_name": DEFAULT_CLIENT_NAME, "gender": GENDER_UNKNOWN, "response": None}
+    if not content_words:
+        # Only a greeting
+        return {"client_name": None, "gender": None, "response": GREETING_RESPONSE}
+    return None
@@ -0,0 +1,390 @@
+# agent/numpy_index.py
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from agent.embeddings import embed_queries
+from agent.file_lock import file_lock
+from config import NUMPY_INDEX_PATH, NUMPY_INDEX_DTYPE
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+METADATA_FILE = "metadata.json"
+# Attempts to open the index when another process replaces it between reading the sidecar and the matrix
+LOAD_ATTEMPTS = 3
+SUPPORTED_DTYPES = ("float32", "float16", "int8")
+
+
+def matches_filter(metadata: dict, where: Optional[dict]) -> bool:
+    """Chroma-style equality filter: {"field": value} or {"$and": [{...}, {...}]}"""
+    if not where:
+        return True
+    if "$and" in where:
+        return all(matches_filter(metadata, condition) for condition in where["$and"])
+    return all(metadata.get(key) == value for key, value in where.items())
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    In-memory vector index over a contiguous matrix of L2-normalized embeddings.
+
+    Search is a single matrix-vector product plus argpartition top-k.
+    The index is persisted as a .npy matrix (float32, float16 or int8 with per-row scales)
+    and a JSON metadata sidecar; float32 matrices are opened with mmap, so startup
+    does not read the index into memory. float16/int8 halve/quarter the file and are
+    dequantized to float32 once on load.
+    """
+
+    def __init__(self, embedding: Embeddings, persist_directory: str = NUMPY_INDEX_PATH, dtype: str = NUMPY_INDEX_DTYPE):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Неподдерживаемый тип индекса: {dtype}")
+        self._embedding = embedding
+        self.persist_directory = persist_directory
+        self.dtype = dtype
+        self._lock = threading.RLock()
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._ids: List[str] = []
+        self._texts: List[str] = []
+        self._metadatas: List[dict] = []
+        self._vectors_file = None
+        # Opened from persist_directory: writes re-read it first (a store built in memory replaces it)
+        self._attached = False
+        # Thread inside the deferred_save() block, nesting depth and unsaved changes made in it
+        self._writer = None
+        self._defer_depth = 0
+        self._dirty = False
+        # Filter -> (metadata list it was computed for, matching positions, their rows of the matrix)
+        self._filter_cache: dict = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding
+
+    # ---------- PERSISTENCE ---------- #
+    @classmethod
+    def load(cls, embedding: Embeddings, persist_directory: str = NUMPY_INDEX_PATH, dtype: str = NUMPY_INDEX_DTYPE) -> "NumpyVectorStore":
+        """Open a persisted index (memory-mapped), an empty store is returned if there is none"""
+        store = cls(embedding, persist_directory, dtype)
+        store._read()
+        store._attached = True
+        return store
+
+    def _read(self) -> None:
+        """Replace the index in memory with the one persisted in persist_directory (if any)"""
+        metadata_path = os.path.join(self.persist_directory, METADATA_FILE)
+        if not os.path.exists(metadata_path):
+            return
+
+        for attempt in range(LOAD_ATTEMPTS):
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                sidecar = json.load(f)
+            try:
+                matrix = self._load_matrix(self.persist_directory, sidecar)
+                break
+            except FileNotFoundError:
+                # The index was saved again by another process and the matrix of this sidecar
+                # was removed in between: the new sidecar points to a matrix that exists
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"[NUMPY_INDEX] Индекс {self.persist_directory} обновлен во время загрузки, повтор")
+                time.sleep(0.05)
+
+        with self._lock:
+            self.dtype = sidecar["dtype"]
+            self._matrix = matrix
+            self._ids = sidecar["ids"]
+            self._texts = sidecar["documents"]
+            self._metadatas = sidecar["metadatas"]
+            self._vectors_file = sidecar["vectors_file"]
+        logger.info(f"[NUMPY_INDEX] Загружен индекс {self.persist_directory}: {len(self)} векторов ({self.dtype})")
+
+    @staticmethod
+    def _load_matrix(persist_directory: str, sidecar: dict) -> np.ndarray:
+        vectors = np.load(os.path.join(persist_directory, sidecar["vectors_file"]), mmap_mode="r")
+        if sidecar["dtype"] == "int8":
+            scales = np.load(os.path.join(persist_directory, sidecar["scales_file"]))
+            return vectors.astype(np.float32) * scales[:, None]
+        if sidecar["dtype"] == "float16":
+            return vectors.astype(np.float32)
+        return np.asarray(vectors)
+
+    def _persisted_files(self) -> set:
+        """Matrix files the sidecar on disk points to (possibly written by another process)"""
+        try:
+            with open(os.path.join(self.persist_directory, METADATA_FILE), "r", encoding="utf-8") as f:
+                sidecar = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        return {sidecar.get("vectors_file"), sidecar.get("scales_file")} - {None}
+
+    @contextmanager
+    def deferred_save(self):
+        """
+        Write block: add_texts / delete inside it only change the index in memory, it is saved once
+        when the outermost block exits (also on errors, so the files match the memory).
+        The outermost block holds the index file lock shared by the API, bot and file watcher
+        processes and re-reads the persisted index first, so the rows another process wrote
+        since this store was opened are kept.
+        """
+        thread = threading.get_ident()
+        if self._writer == thread:
+            self._defer_depth += 1
+            try:
+                yield self
+            finally:
+                self._defer_depth -= 1
+            return
+
+        with file_lock(self.persist_directory):
+            if self._attached:
+                self._read()
+            self._writer, self._defer_depth = thread, 1
+            try:
+                yield self
+            finally:
+                self._writer, self._defer_depth = None, 0
+                with self._lock:
+                    if self._dirty:
+                        self.save()
+
+    def save(self) -> None:
+        """Atomically persist the index: new matrix file first, then the sidecar that points to it"""
+        with self._lock:
+            os.makedirs(self.persist_directory, exist_ok=True)
+            previous_files = self._persisted_files()
+            suffix = uuid4().hex[:8]
+            vectors_file = f"vectors-{suffix}.npy"
+            sidecar = {
+                "dtype": self.dtype,
+                "dimensions": int(self._matrix.shape[1]) if self._matrix.size else 0,
+                "vectors_file": vectors_file,
+                "ids": self._ids,
+                "documents": self._texts,
+                "metadatas": self._metadatas
+            }
+
+            matrix = np.ascontiguousarray(self._matrix, dtype=np.float32)
+            if self.dtype == "int8":
+                scales = np.abs(matrix).max(axis=1) / 127.0 if len(matrix) else np.empty(0, dtype=np.float32)
+                scales = np.where(scales == 0, 1.0, scales).astype(np.float32)
+                quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+                sidecar["scales_file"] = f"scales-{suffix}.npy"
+                np.save(os.path.join(self.persist_directory, sidecar["scales_file"]), scales)
+                np.save(os.path.join(self.persist_directory, vectors_file), quantized)
+            else:
+                np.save(os.path.join(self.persist_directory, vectors_file), matrix.astype(self.dtype))
+
+            metadata_path = os.path.join(self.persist_directory, METADATA_FILE)
+            tmp_path = f"{metadata_path}.{suffix}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(sidecar, f, ensure_ascii=False)
+            os.replace(tmp_path, metadata_path)
+
+            # The previous matrices stay: a reader may have read the old sidecar and not yet
+            # opened its matrix. Older ones are removed (mapped files stay valid for their readers)
+            for filename in os.listdir(self.persist_directory):
+                if filename.endswith(".npy") and suffix not in filename and filename not in previous_files:
+                    try:
+                        os.remove(os.path.join(self.persist_directory, filename))
+                    except OSError:
+                        pass
+            self._vectors_file = vectors_file
+            self._attached = True
+            self._dirty = False
+
+    # ---------- WRITE ---------- #
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = [doc_id or str(uuid4()) for doc_id in ids] if ids else [str(uuid4()) for _ in texts]
+
+        vectors = np.asarray(self._embedding.embed_documents(texts), dtype=np.float32)
+        vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+        with self.deferred_save(), self._lock:
+            matrix = vectors if not len(self._ids) else np.vstack([np.asarray(self._matrix, dtype=np.float32), vectors])
+            self._matrix = np.ascontiguousarray(matrix)
+            self._ids = self._ids + ids
+            self._texts = self._texts + texts
+            self._metadatas = self._metadatas + [dict(m or {}) for m in metadatas]
+            self._dirty = True
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        to_delete = set(ids)
+        with self.deferred_save(), self._lock:
+            keep = [i for i, doc_id in enumerate(self._ids) if doc_id not in to_delete]
+            if len(keep) == len(self._ids):
+                return False
+            self._matrix = np.ascontiguousarray(np.asarray(self._matrix, dtype=np.float32)[keep]) if keep else np.empty((0, 0), dtype=np.float32)
+            self._ids = [self._ids[i] for i in keep]
+            self._texts = [self._texts[i] for i in keep]
+            self._metadatas = [self._metadatas[i] for i in keep]
+            self._dirty = True
+        return True
+
+    # ---------- READ ---------- #
+    def get(self, ids: Optional[List[str]] = None, where: Optional[dict] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include: Optional[List[str]] = None, **kwargs: Any) -> dict:
+        """Chroma-compatible get(): ids plus the requested fields ("documents", "metadatas")"""
+        include = ["documents", "metadatas"] if include is None else include
+        with self._lock:
+            wanted = set(ids) if ids else None
+            positions = [
+                i for i, doc_id in enumerate(self._ids)
+                if (wanted is None or doc_id in wanted) and matches_filter(self._metadatas[i], where)
+            ]
+        start = offset or 0
+        positions = positions[start:start + limit] if limit else positions[start:]
+        return {
+            "ids": [self._ids[i] for i in positions],
+            "documents": [self._texts[i] for i in positions] if "documents" in include else None,
+            "metadatas": [self._metadatas[i] for i in positions] if "metadatas" in include else None
+        }
+
+    def get_by_ids(self, ids, /) -> List[Document]:
+        result = self.get(ids=list(ids))
+        return [
+            Document(page_content=text, metadata=metadata, id=doc_id)
+            for doc_id, text, metadata in zip(result["ids"], result["documents"], result["metadatas"])
+        ]
+
+    def _filtered(self, where: dict) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Positions matching the filter and their rows of the matrix. Computed once per filter and
+        reused while the index is unchanged (add/delete/load replace the metadata list).
+        """
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        cached = self._filter_cache.get(key)
+        if cached is None or cached[0] is not self._metadatas:
+            positions = np.array([i for i, m in enumerate(self._metadatas) if matches_filter(m, where)], dtype=np.int64)
+            rows = np.asarray(self._matrix[positions], dtype=np.float32) if len(positions) else None
+            cached = (self._metadatas, positions, rows)
+            self._filter_cache[key] = cached
+        return cached[1], cached[2]
+
+    def _top_k(self, query_vector: np.ndarray, k: int, where: Optional[dict] = None) -> List[Tuple[int, float]]:
+        with self._lock:
+            if not self._ids:
+                return []
+            if where:
+                candidates, rows = self._filtered(where)
+                if not len(candidates):
+                    return []
+                scores = rows @ query_vector
+            else:
+                candidates = None
+                scores = self._matrix @ query_vector
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        positions = candidates[top] if candidates is not None else top
+        return [(int(p), float(scores[t])) for p, t in zip(positions, top)]
+
+    def _to_document(self, position: int) -> Document:
+        return Document(page_content=self._texts[position], metadata=self._metadatas[position], id=self._ids[position])
+
+    def _embed_query(self, query: str) -> np.ndarray:
+        vector = np.asarray(self._embedding.embed_query(query), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        query_vector = np.asarray(embedding, dtype=np.float32)
+        return [(self._to_document(p), score) for p, score in self._top_k(query_vector, k, filter)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        """Documents with cosine similarity (higher is more relevant)"""
+        return self.similarity_search_by_vector_with_score(self._embed_query(query), k, filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def search_many(self, queries: List[str], k: int = 4, filter: Optional[dict] = None,
+                    query_vectors: Optional[np.ndarray] = None) -> List[List[Tuple[Document, float]]]:
+        """
+        Top-k for several queries at once: one embedding request and one matrix product.
+        query_vectors (one row per query) skips the embedding when the caller already has them.
+        Returns a ranked list of (document, cosine similarity) per query.
+        """
+        if not queries:
+            return []
+        query_matrix = embed_queries(self._embedding, queries) if query_vectors is None else np.array(query_vectors, dtype=np.float32)
+        query_matrix /= np.clip(np.linalg.norm(query_matrix, axis=1, keepdims=True), 1e-12, None)
+
+        with self._lock:
+            if not self._ids:
+                return [[] for _ in queries]
+            if filter:
+                candidates, rows = self._filtered(filter)
+                if not len(candidates):
+                    return [[] for _ in queries]
+                scores = query_matrix @ rows.T
+            else:
+                candidates = None
+                scores = query_matrix @ self._matrix.T
+
+            k = min(k, scores.shape[1])
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            positions = candidates[top] if candidates is not None else top
+
+            return [
+                [(self._to_document(int(p)), float(score)) for p, score in zip(row_positions, row_scores)]
+                for row_positions, row_scores in zip(positions, top_scores)
+            ]
+
+    def _select_relevance_score_fn(self):
+        # Scores are already cosine similarities
+        return lambda score: score
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   ids: Optional[List[str]] = None, persist_directory: str = NUMPY_INDEX_PATH, **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(embedding, persist_directory, kwargs.get("dtype", NUMPY_INDEX_DTYPE))
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+
+# ---------- SHARED INSTANCE ---------- #
+_store_lock = threading.Lock()
+_loaded_store: Optional[NumpyVectorStore] = None
+_loaded_generation: Optional[str] = None
+
+
+def get_numpy_vector_store(generation: str) -> NumpyVectorStore:
+    """Numpy index for the given index generation, re-opened from disk only when it changes"""
+    from agent.embeddings import get_embedding_model
+
+    global _loaded_store, _loaded_generation
+    with _store_lock:
+        if _loaded_store is None or _loaded_generation != generation:
+            _loaded_store = NumpyVectorStore.load(get_embedding_model())
+            _loaded_generation = generation
+        return _loaded_store
@@ -0,0 +1,236 @@
+# agent/reranker.py
+
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from agent.embeddings import load_onnx_model
+from agent.lexical_index import LexicalIndex, tokenize
+from config import (
+    RAG_RERANK, RAG_RERANK_TOP_N, RAG_RERANK_BUDGET_MS, RERANK_MODEL, RERANK_ONNX_FILE,
+    RERANK_MAX_LENGTH, RERANK_BATCH_SIZE, RERANK_THREADS
+)
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+Hits = List[Tuple[Document, float]]
+
+# Weight of the query terms found in the first line of a document (the service, device or question name)
+TITLE_WEIGHT = 0.5
+# Weight of the retrieval rank, only breaks ties between equally overlapping documents
+RANK_WEIGHT = 0.01
+
+
+# ---------- LEXICAL ---------- #
+class LexicalReranker:
+    """
+    Share of the query terms (weighted by their BM25 idf) present in the document and in its title.
+    Needs no model and scores a few dozen documents in well under a millisecond.
+    """
+
+    def score(self, query: str, docs: List[Document], lexical_index: Optional[LexicalIndex] = None) -> List[float]:
+        query_terms = set(tokenize(query))
+        if not query_terms:
+            return [0.0] * len(docs)
+        weights = {
+            term: (lexical_index.idf(term) if lexical_index is not None and len(lexical_index) else 1.0) or 1.0
+            for term in query_terms
+        }
+        total = sum(weights.values())
+
+        scores = []
+        for doc in docs:
+            text = doc.page_content or ""
+            doc_terms = lexical_index.document_terms(doc.id) if lexical_index is not None and doc.id else None
+            doc_terms = set(doc_terms) if doc_terms is not None else set(tokenize(text))
+            title_terms = set(tokenize(text.split("\n", 1)[0]))
+            overlap = sum(weight for term, weight in weights.items() if term in doc_terms) / total
+            title_overlap = sum(weight for term, weight in weights.items() if term in title_terms) / total
+            scores.append((overlap + TITLE_WEIGHT * title_overlap) / (1 + TITLE_WEIGHT))
+        return scores
+
+
+# ---------- CROSS-ENCODER ---------- #
+class CrossEncoderReranker:
+    """
+    Cross-encoder (query, document) relevance model exported to ONNX, executed on CPU with onnxruntime.
+    The model is loaded in a background thread: until it is ready rerank() falls back to the
+    lexical reranker instead of blocking the request.
+    """
+
+    def __init__(
+        self,
+        model_name: str = RERANK_MODEL,
+        onnx_file: str = RERANK_ONNX_FILE,
+        batch_size: int = RERANK_BATCH_SIZE,
+        max_length: int = RERANK_MAX_LENGTH,
+        num_threads: int = RERANK_THREADS
+    ):
+        self.model_name = model_name
+        self.onnx_file = onnx_file
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self._session = None
+        self._tokenizer = None
+        self._input_names = set()
+        self._load_lock = threading.Lock()
+        self._loader = None
+        self.failed = False
+        # Moving average of the scoring time of one (query, document) pair, None until measured
+        self.pair_ms: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._session is not None
+
+    def load(self) -> bool:
+        """Load the model in the calling thread, False if it cannot be loaded"""
+        if self._session is not None or self.failed:
+            return self._session is not None
+        with self._load_lock:
+            if self._session is None and not self.failed:
+                try:
+                    tokenizer, session, input_names = load_onnx_model(
+                        self.model_name, self.onnx_file, self.max_length, self.num_threads
+                    )
+                    self._tokenizer = tokenizer
+                    self._input_names = input_names
+                    self._session = session
+                    logger.info(f"[RERANKER] Загружен cross-encoder {self.model_name} ({self.onnx_file}), потоков: {self.num_threads}")
+                except Exception as e:
+                    self.failed = True
+                    logger.error(f"[RERANKER] Не удалось загрузить cross-encoder {self.model_name}, используется лексический reranker: {e}")
+        return self._session is not None
+
+    def load_async(self) -> None:
+        """Start loading the model in a background thread (once)"""
+        with self._load_lock:
+            if self._loader is None and self._session is None and not self.failed:
+                self._loader = threading.Thread(target=self.load, name="reranker-loader", daemon=True)
+                self._loader.start()
+
+    def pairs_within(self, remaining_ms: float) -> int:
+        """How many pairs fit in remaining_ms: a full batch at most, 1 while the cost is not measured yet"""
+        if self.pair_ms is None:
+            return 1 if remaining_ms > 0 else 0
+        return max(0, min(self.batch_size, int(remaining_ms / self.pair_ms)))
+
+    def score_batch(self, query: str, texts: List[str]) -> np.ndarray:
+        """Relevance in [0, 1] of every text to the query"""
+        started = time.perf_counter()
+        scores = self._score(query, texts)
+        pair_ms = (time.perf_counter() - started) * 1000 / max(1, len(texts))
+        self.pair_ms = pair_ms if self.pair_ms is None else 0.8 * self.pair_ms + 0.2 * pair_ms
+        return scores
+
+    def _score(self, query: str, texts: List[str]) -> np.ndarray:
+        encodings = self._tokenizer.encode_batch([(query, text) for text in texts])
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        inputs = {name: value for name, value in inputs.items() if name in self._input_names}
+
+        logits = self._session.run(None, inputs)[0]
+        if logits.ndim == 2 and logits.shape[1] > 1:
+            # Two-class head: probability of the "relevant" class
+            exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+            return (exp[:, 1] / exp.sum(axis=1)).astype(np.float32)
+        return (1 / (1 + np.exp(-logits.reshape(len(texts))))).astype(np.float32)
+
+
+@lru_cache(maxsize=None)
+def get_cross_encoder() -> CrossEncoderReranker:
+    """Cross-encoder shared by the process"""
+    return CrossEncoderReranker()
+
+
+lexical_reranker = LexicalReranker()
+
+
+# ---------- RERANKING ---------- #
+def _ordered(hits: Hits, scores: List[float]) -> Hits:
+    """
+    Scored hits by score, the unscored rest (budget exhausted) after them in retrieval order.
+    Scores are returned in place of the retrieval scores, unscored hits get lower ones.
+    """
+    scored = sorted(
+        ((doc, score + RANK_WEIGHT / (rank + 1)) for rank, ((doc, _), score) in enumerate(zip(hits, scores))),
+        key=lambda hit: hit[1], reverse=True
+    )
+    floor = min((score for _, score in scored), default=0.0)
+    rest = [(doc, floor - RANK_WEIGHT * (rank + 1)) for rank, (doc, _) in enumerate(hits[len(scores):])]
+    return scored + rest
+
+
+def rerank(
+    query: str,
+    hits: Hits,
+    top_n: int = RAG_RERANK_TOP_N,
+    mode: str = RAG_RERANK,
+    budget_ms: float = RAG_RERANK_BUDGET_MS,
+    lexical_index: Optional[LexicalIndex] = None
+) -> Tuple[Hits, bool]:
+    """
+    Rescore the retrieved (Document, score) pairs of a subquery and keep the best top_n.
+    Documents are scored in retrieval order in batches sized from the measured per-pair cost so
+    that scoring ends within budget_ms, the rest keep their retrieval order after the scored ones.
+    A budget below the cost of one pair falls back to the lexical reranker. mode "off" (or a budget of 0) returns the hits
+    cut to top_n unchanged.
+
+    Returns:
+        tuple: reranked hits and whether every hit was scored by the requested model
+    """
+    if mode == "off" or budget_ms <= 0 or len(hits) <= 1:
+        return hits[:top_n], True
+
+    started = time.perf_counter()
+    deadline = started + budget_ms / 1000
+    docs = [doc for doc, _ in hits]
+    scores: List[float] = []
+
+    cross_encoder = get_cross_encoder() if mode == "cross_encoder" else None
+    fallback = False
+    if cross_encoder is not None and not cross_encoder.ready:
+        # Still loading: lexical scores now, not cached. Failed to load: lexical for good
+        cross_encoder.load_async()
+        fallback = not cross_encoder.failed
+        cross_encoder, mode = None, "lexical"
+
+    if cross_encoder is not None and not cross_encoder.pairs_within(budget_ms):
+        # Not even one pair fits in the budget: lexical scores instead of an overrun
+        logger.warning(f"[RERANKER] Бюджет {budget_ms} мс меньше оценки одной пары ({cross_encoder.pair_ms:.1f} мс), используется лексический reranker")
+        fallback = True
+        cross_encoder, mode = None, "lexical"
+
+    if cross_encoder is not None:
+        # Every batch is sized to the time left: a batch that cannot finish by the deadline is not started
+        while len(scores) < len(docs):
+            size = cross_encoder.pairs_within((deadline - time.perf_counter()) * 1000)
+            if not size:
+                break
+            batch = docs[len(scores):len(scores) + size]
+            scores.extend(cross_encoder.score_batch(query, [doc.page_content or "" for doc in batch]).tolist())
+    elif mode == "lexical":
+        scores = lexical_reranker.score(query, docs, lexical_index)
+    else:
+        raise ValueError(f"Неизвестный RAG_RERANK: {mode}")
+
+    complete = len(scores) == len(docs) and not fallback
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if len(scores) < len(docs):
+        logger.warning(f"[RERANKER] Бюджет {budget_ms} мс исчерпан: оценено {len(scores)} из {len(docs)} документов за {elapsed_ms:.1f} мс")
+    else:
+        logger.info(f"[RERANKER] '{query}': {mode}, {len(docs)} -> {top_n} документов за {elapsed_ms:.1f} мс")
+    return _ordered(hits, scores)[:top_n], complete
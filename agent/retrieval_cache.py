@@ -0,0 +1,107 @@
+# agent/retrieval_cache.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from config import INDEX_GENERATION_PATH, RAG_CACHE_SIZE
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# ---------- INDEX GENERATION ---------- #
+def get_index_generation() -> str:
+    """
+    Read the current index generation.
+
+    The generation is a marker file shared by every process (API, bot, file watcher),
+    so a rebuild made by one of them invalidates the caches of all the others.
+    """
+    try:
+        with open(INDEX_GENERATION_PATH, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+    except Exception as e:
+        logger.warning(f"[RETRIEVAL_CACHE] Не удалось прочитать поколение индекса: {e}")
+        return ""
+
+
+def bump_index_generation() -> str:
+    """
+    Start a new index generation. Must be called after every change of the vector store.
+    """
+    generation = f"{time.time_ns()}-{uuid4().hex[:8]}"
+    os.makedirs(os.path.dirname(INDEX_GENERATION_PATH), exist_ok=True)
+    tmp_path = f"{INDEX_GENERATION_PATH}.{uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(generation)
+    os.replace(tmp_path, INDEX_GENERATION_PATH)
+
+    # Entries of the old generation can no longer be hit, free the memory right away
+    retrieval_cache.clear()
+    logger.info(f"[RETRIEVAL_CACHE] Новое поколение индекса: {generation}")
+    return generation
+
+
+# ---------- CACHE ---------- #
+class RetrievalCache:
+    """
+    Thread-safe LRU cache of retrieval results keyed by (subquery, k, index generation).
+    """
+
+    def __init__(self, max_size: int = RAG_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _make_key(subquery: str, k: int, generation: str) -> tuple:
+        # RAG_PROMPT produces canonical subqueries, only case and spacing may differ
+        return (" ".join(subquery.lower().split()), k, generation)
+
+    def get(self, subquery: str, k: int, generation: str):
+        """Return cached results or None on a miss"""
+        key = self._make_key(subquery, k, generation)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, subquery: str, k: int, generation: str, results) -> None:
+        """Store results, evicting the least recently used entries"""
+        if self.max_size <= 0:
+            return
+        key = self._make_key(subquery, k, generation)
+        with self._lock:
+            self._entries[key] = results
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+# Global cache shared by rag_search calls of the process
+retrieval_cache = RetrievalCache()
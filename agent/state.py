@@ -19,8 +19,8 @@ def add_messages_custom(left: list[BaseMessage] | None, right: list[BaseMessage]
     if (isinstance(right[0], HumanMessage) and 
         right[0].content and 
         right[0].content.startswith("Предыдущий диалог:")):
-        # If this is a summary, replace all messages with new ones
-        return right
+        # If this is a summary, replace all messages with new ones (ids are assigned to new messages)
+        return add_messages([], right)
     
     # Standard processing from langgraph
     return add_messages(left, right)
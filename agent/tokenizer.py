@@ -0,0 +1,35 @@
+# agent/tokenizer.py
+
+from functools import lru_cache
+from typing import List
+
+import tiktoken
+
+
+# Same tokenizer the OpenAI embedding and chat models count with
+TOKENIZER_MODEL = "text-embedding-ada-002"
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer() -> tiktoken.Encoding:
+    """Shared tiktoken encoding, loaded once per process"""
+    return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+
+
+def encode(text: str) -> List[int]:
+    return get_tokenizer().encode_ordinary(text or "")
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in the text"""
+    return len(encode(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut the text to at most max_tokens, at a whitespace boundary when possible"""
+    tokens = encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    truncated = get_tokenizer().decode(tokens[:max(max_tokens, 0)])
+    cut = max(truncated.rfind("\n"), truncated.rfind(" "))
+    return truncated[:cut] if cut > 0 else truncated
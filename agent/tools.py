@@ -1,7 +1,27 @@
-from config import CHROMA_PATH, OPENAI_API_KEY
+import json
+import math
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+import numpy as np
+
+from agent.context_packer import pack_context
+from agent.embeddings import embed_queries, get_embedding_model
+from agent.facet_router import route
+from agent.lexical_index import get_lexical_index, reciprocal_rank_fusion
+from agent.metrics import RETRIEVAL_DOCUMENTS, RETRIEVAL_EVENTS, record_error
+from agent.numpy_index import get_numpy_vector_store
+from agent.reranker import rerank
+from agent.retrieval_cache import get_index_generation, retrieval_cache
+from config import (
+    CHROMA_PATH, RAG_TOP_K, VECTOR_BACKEND,
+    RAG_HYBRID_SEARCH, RAG_RRF_K, RAG_FUSION_CANDIDATES, RAG_FACET_ROUTING,
+    RAG_RERANK, RAG_RERANK_CANDIDATES, RAG_RERANK_TOP_N
+)
+from langchain_core.documents import Document
 from langchain_core.tools import tool
 from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
 from pydantic import BaseModel, Field
 import logs.logging_config
 import logging
@@ -14,6 +34,10 @@ logger = logging.getLogger(__name__)
 # Vector storage initialization function
 def get_vector_store():
     """Get vector store instance - creates new connection each time to ensure fresh data"""
+    if VECTOR_BACKEND == "numpy":
+        # The numpy index is memory-mapped once per index generation
+        return get_numpy_vector_store(get_index_generation())
+
     import chromadb
     import time
     
@@ -30,7 +54,7 @@ def get_vector_store():
         vector_store = Chroma(
             client=client,
             collection_name="langchain",
-            embedding_function=OpenAIEmbeddings(api_key=OPENAI_API_KEY)
+            embedding_function=get_embedding_model()
         )
         
         return vector_store
@@ -40,10 +64,259 @@ def get_vector_store():
         # Fallback к старому способу
         return Chroma(
             persist_directory=CHROMA_PATH,
-            embedding_function=OpenAIEmbeddings(api_key=OPENAI_API_KEY),
+            embedding_function=get_embedding_model(),
             collection_name="langchain"
         )
 
+
+# (collection id, filter) -> documents and embedding matrix matching the filter, LRU of the
+# current index generation (subsets of an older generation are dropped when it changes)
+FILTERED_SUBSETS_SIZE = 64
+_filtered_subsets = OrderedDict()
+_filtered_subsets_generation = None
+_filtered_subsets_lock = threading.Lock()
+
+
+def _filtered_subset(collection, where: dict) -> dict:
+    """Documents matching the filter with their embeddings as one matrix, read once per index generation"""
+    global _filtered_subsets_generation
+    generation = get_index_generation()
+    key = (str(collection.id), json.dumps(where, sort_keys=True, ensure_ascii=False))
+    with _filtered_subsets_lock:
+        if _filtered_subsets_generation != generation:
+            _filtered_subsets.clear()
+            _filtered_subsets_generation = generation
+        subset = _filtered_subsets.get(key)
+        if subset is not None:
+            _filtered_subsets.move_to_end(key)
+            return subset
+
+    # Read outside the lock: a concurrent miss on the same filter only reads it twice
+    subset = collection.get(where=where, include=["embeddings", "documents", "metadatas"])
+    subset["matrix"] = np.asarray(subset["embeddings"], dtype=np.float32) if subset["ids"] else None
+    with _filtered_subsets_lock:
+        if _filtered_subsets_generation == generation:
+            _filtered_subsets[key] = subset
+            _filtered_subsets.move_to_end(key)
+            while len(_filtered_subsets) > FILTERED_SUBSETS_SIZE:
+                _filtered_subsets.popitem(last=False)
+    return subset
+
+
+def _filtered_query(collection, query_embeddings: np.ndarray, k: int, where: dict) -> dict:
+    """
+    Chroma query result computed exactly over the documents matching the filter. Filtered HNSW
+    search in Chroma is slow for broad filters and returns fewer than k results for selective ones,
+    the facet subsets of this knowledge base are small enough to score in one matrix product.
+    """
+    subset = _filtered_subset(collection, where)
+    if subset["matrix"] is None:
+        return {key: [[] for _ in query_embeddings] for key in ("ids", "documents", "metadatas", "distances")}
+    matrix = subset["matrix"]
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+    space = (collection.metadata or {}).get("hnsw:space", "l2")
+    if space == "cosine":
+        norms = np.clip(np.linalg.norm(matrix, axis=1), 1e-12, None)
+        distances = 1 - (queries / np.clip(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12, None)) @ matrix.T / norms
+    elif space == "ip":
+        distances = 1 - queries @ matrix.T
+    else:
+        distances = (queries ** 2).sum(axis=1, keepdims=True) - 2 * queries @ matrix.T + (matrix ** 2).sum(axis=1)
+    k = min(k, matrix.shape[0])
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(top, np.argsort(np.take_along_axis(distances, top, axis=1), axis=1), axis=1)
+    result = {key: [[subset[key][i] for i in row] for row in order] for key in ("ids", "documents", "metadatas")}
+    result["distances"] = [[float(distances[q, i]) for i in row] for q, row in enumerate(order)]
+    return result
+
+
+def search_many(vector_store, queries: list, k: int = RAG_TOP_K, filter: dict = None, query_vectors=None) -> list:
+    """
+    Batched top-k search: all queries are embedded in one request and scored together
+    (one matrix product for the numpy index, one batched query for Chroma). The filter is
+    applied inside the index, only matching documents are scored. query_vectors reuses
+    embeddings the caller already has.
+
+    Returns:
+        list: per query, a ranked list of (Document, relevance score), higher is better
+    """
+    if not queries:
+        return []
+    if hasattr(vector_store, "search_many"):
+        return vector_store.search_many(queries, k=k, filter=filter, query_vectors=query_vectors)
+
+    # Chroma: one embedding request and one collection query for all queries
+    query_embeddings = embed_queries(vector_store.embeddings, queries) if query_vectors is None else np.asarray(query_vectors)
+    if filter:
+        results = _filtered_query(vector_store._collection, query_embeddings, k, filter)
+    else:
+        results = vector_store._collection.query(
+            query_embeddings=query_embeddings.tolist(),
+            n_results=k,
+            include=["documents", "metadatas", "distances"]
+        )
+    relevance = vector_store._select_relevance_score_fn()
+    return [
+        [
+            (Document(page_content=text, metadata=metadata or {}, id=doc_id), relevance(distance))
+            for doc_id, text, metadata, distance in zip(ids, texts, metadatas, distances)
+        ]
+        for ids, texts, metadatas, distances in zip(
+            results["ids"], results["documents"], results["metadatas"], results["distances"]
+        )
+    ]
+
+
+def _fuse(subquery: str, vector_hits: list, lexical_index, k: int, candidates_k: int, rrf_k: int, where: dict = None) -> list:
+    """Vector hits fused with the BM25 hits of the same filter (reciprocal rank fusion), top k"""
+    if lexical_index is None:
+        return vector_hits[:k]
+    lexical_hits = lexical_index.search(subquery, max(candidates_k, k), where=where)
+    return reciprocal_rank_fusion(
+        [[doc for doc, _ in vector_hits], [doc for doc, _ in lexical_hits]],
+        k=k, rrf_k=rrf_k
+    )
+
+
+def _retrieve_scoped(subqueries: list, routes: dict, lexical_index, store, k: int, candidates_k: int, rrf_k: int,
+                     facet_scale: float = 1.0) -> dict:
+    """
+    Facet-scoped retrieval: every subquery is embedded once, then searched in each of its facets
+    with the facet filter pushed into the vector store and the lexical index. Subqueries sharing
+    a filter are searched in one batch. The facet results (k per facet, times facet_scale when
+    over-fetching for the reranker) are merged by score and cut to k.
+    """
+    vectors = dict(zip(subqueries, embed_queries(store.embeddings, subqueries)))
+    batches = {}
+    for subquery in subqueries:
+        for facet, facet_k, where in routes[subquery]:
+            key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+            batches.setdefault(key, (where, []))[1].append((subquery, math.ceil(facet_k * facet_scale)))
+
+    retrieved = {subquery: [] for subquery in subqueries}
+    for where, items in batches.values():
+        queries = [subquery for subquery, _ in items]
+        max_k = max(facet_k for _, facet_k in items)
+        results = search_many(
+            store, queries, k=max(candidates_k, max_k) if lexical_index is not None else max_k,
+            filter=where, query_vectors=np.stack([vectors[subquery] for subquery in queries])
+        )
+        for (subquery, facet_k), vector_hits in zip(items, results):
+            retrieved[subquery].extend(_fuse(subquery, vector_hits, lexical_index, facet_k, candidates_k, rrf_k, where))
+    return {subquery: sorted(hits, key=lambda hit: hit[1], reverse=True)[:k] for subquery, hits in retrieved.items()}
+
+
+def _retrieve_many(subqueries: list, lexical_index, get_store, k: int = RAG_TOP_K,
+                   candidates_k: int = RAG_FUSION_CANDIDATES, rrf_k: int = RAG_RRF_K,
+                   facet_routing: bool = RAG_FACET_ROUTING, facet_scale: float = 1.0, exact_k: int = None,
+                   record_metrics: bool = True) -> dict:
+    """
+    Top-k (Document, score) pairs for every subquery.
+    Exact service/device names are answered by the lexical index alone, without an embedding call;
+    the remaining subqueries go to the vector store in one batch and are fused with BM25
+    (reciprocal rank fusion). With facet routing they are searched per facet of the knowledge
+    base instead (agent/facet_router.py), k per facet. The sizes default to the config and are
+    arguments for benchmarks/retrieval_eval.py. exact_k bounds how many rows an exact match may
+    have (k by default), so over-fetching for the reranker does not make generic values exact.
+    record_metrics=False keeps the lookups out of RETRIEVAL_EVENTS (startup warm-up).
+    """
+    def count(amount, outcome):
+        if record_metrics:
+            RETRIEVAL_EVENTS.inc(amount, outcome=outcome)
+
+    use_lexical = lexical_index is not None and len(lexical_index) > 0
+    retrieved = {}
+    pending = []
+    for subquery in subqueries:
+        exact_matches = lexical_index.exact_matches(subquery, exact_k or k) if use_lexical else []
+        if exact_matches:
+            logger.info(f"[CONSULTATION_AGENT][RAG_SEARCH] Exact lexical match for subquery: '{subquery}'")
+            count(1, "exact_match")
+            retrieved[subquery] = exact_matches
+        else:
+            pending.append(subquery)
+
+    if not pending:
+        return retrieved
+
+    count(len(pending), "vector")
+    fusion_index = lexical_index if use_lexical else None
+    routes = {subquery: route(subquery, fusion_index) for subquery in pending} if facet_routing else {}
+    scoped = [subquery for subquery in pending if routes.get(subquery)]
+    unscoped = [subquery for subquery in pending if not routes.get(subquery)]
+
+    if scoped:
+        count(len(scoped), "facet")
+        retrieved.update(_retrieve_scoped(scoped, routes, fusion_index, get_store(), k, candidates_k, rrf_k, facet_scale))
+        # Nothing in the routed facets (an index built without facets): search the whole index
+        unscoped += [subquery for subquery in scoped if not retrieved[subquery]]
+    if unscoped:
+        vector_results = search_many(get_store(), unscoped, k=max(candidates_k, k) if use_lexical else k)
+        for subquery, vector_hits in zip(unscoped, vector_results):
+            retrieved[subquery] = _fuse(subquery, vector_hits, fusion_index, k, candidates_k, rrf_k)
+    return retrieved
+
+
+def search_context(user_query: str, use_cache: bool = True) -> Tuple[str, int]:
+    """
+    Retrieved context of a rag_search query (subqueries separated by ";"), errors are raised.
+    use_cache=False retrieves every subquery without reading or filling the retrieval cache and
+    without counting it in the metrics (startup warm-up).
+
+    Returns:
+        tuple: context text and the number of documents in it
+    """
+    logger.info(f"[CONSULTATION_AGENT][RAG_SEARCH] Starting RAG search for user query: '{user_query}'")
+    subqueries = [q.strip() for q in user_query.split(";") if q.strip()]
+    generation = get_index_generation()
+    lexical_index = get_lexical_index(generation) if RAG_HYBRID_SEARCH else None
+    vector_store = None
+
+    def get_store():
+        # Get fresh vector store instance only when the vector search is really needed
+        nonlocal vector_store
+        if vector_store is None:
+            vector_store = get_vector_store()
+        return vector_store
+
+    # With reranking more candidates are retrieved and the best RAG_RERANK_TOP_N of them kept
+    reranking = RAG_RERANK != "off"
+    top_k = RAG_RERANK_TOP_N if reranking else RAG_TOP_K
+    fetch_k = max(RAG_RERANK_CANDIDATES, top_k) if reranking else RAG_TOP_K
+
+    hits = {}
+    for subquery in subqueries if use_cache else ():
+        cached = retrieval_cache.get(subquery, top_k, generation)
+        if cached is not None:
+            logger.info(f"[CONSULTATION_AGENT][RAG_SEARCH] Cache hit for subquery: '{subquery}'")
+            hits[subquery] = cached
+
+    if use_cache:
+        RETRIEVAL_EVENTS.inc(len(hits), outcome="cache_hit")
+
+    misses = [subquery for subquery in dict.fromkeys(subqueries) if subquery not in hits]
+    if misses:
+        if use_cache:
+            RETRIEVAL_EVENTS.inc(len(misses), outcome="cache_miss")
+        retrieved = _retrieve_many(
+            misses, lexical_index, get_store, k=fetch_k, facet_scale=fetch_k / RAG_TOP_K, exact_k=RAG_TOP_K,
+            record_metrics=use_cache
+        )
+        for subquery, subquery_hits in retrieved.items():
+            complete = True
+            if reranking:
+                subquery_hits, complete = rerank(subquery, subquery_hits, top_k, lexical_index=lexical_index)
+                if use_cache:
+                    RETRIEVAL_EVENTS.inc(outcome="rerank" if complete else "rerank_partial")
+            # Results scored only partly within the rerank budget are not cached
+            if complete and use_cache:
+                retrieval_cache.put(subquery, top_k, generation, subquery_hits)
+            hits[subquery] = subquery_hits
+
+    # Hits of all subqueries are merged, de-duplicated and trimmed to the token budget
+    return pack_context({subquery: hits[subquery] for subquery in subqueries})
+
+
 class RAGSearchInput(BaseModel):
     user_query: str = Field(..., title="User Query", description="User query for rag search")
 
@@ -55,25 +328,14 @@ def rag_search(user_query: str) -> str:
     Args:
         user_query (str): content of user query
 
-    Returns: str: A string containing the contents of the three most relevant
-    documents or a message about missing data.
+    Returns: str: A string containing the most relevant documents of all subqueries
+    within the context token budget or a message about missing data.
     """
     try:
-        logger.info(f"[CONSULTATION_AGENT][RAG_SEARCH] Starting RAG search for user query: '{user_query}'")
-        # Get fresh vector store instance to ensure latest data
-        vector_store = get_vector_store()
-        vector_retriever = vector_store.as_retriever(search_kwargs={"k": 5})
-        subqueries = [q.strip() for q in user_query.split(";") if q.strip()]
-        results = []
-
-        for subquery in subqueries:
-            relevant_docs = vector_retriever.invoke(subquery)
-            retrieved_texts = "\n\n".join(
-                [f"[Source: {doc.metadata.get('source', 'N/A')}]\n{doc.page_content or 'Пустой документ'}"
-                for doc in relevant_docs if doc.page_content is not None]
-            )
-            results.append(retrieved_texts or f"Нет информации по запросу: {subquery}")
-        return "\n\n".join(results)
+        context, documents_count = search_context(user_query)
+        RETRIEVAL_DOCUMENTS.observe(documents_count)
+        return context
     except Exception as e:
         logger.error(f"[CONSULTATION_AGENT][RAG_SEARCH] ❌ Error during RAG search: {e}")
+        record_error("rag_search")
         return "Произошла ошибка при поиске документов."
@@ -4,35 +4,41 @@ import os
 import sys
 import stat
 
-import pandas as pd
 import time
 from typing import List
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(BASE_DIR)
-from config import DATA_PATH, CHROMA_PATH, OPENAI_API_KEY
+from config import DATA_PATH, CHROMA_PATH, VECTOR_BACKEND, INGEST_BATCH_SIZE, STORE_PAGE_SIZE
+from agent.retrieval_cache import bump_index_generation
+from agent.lexical_index import LexicalIndex
+from agent.ingest_manifest import IngestManifest, file_fingerprint, count_rows, sheet_list
+from agent.workbook_cache import workbook_cache
+from agent.ingest_schema import read_workbook, sheet_documents
+from agent.embeddings import get_embedding_model
+from agent.numpy_index import NumpyVectorStore
+from agent.tokenizer import get_tokenizer
 from langchain.docstore.document import Document
 from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
 import shutil
+from contextlib import nullcontext
+from functools import lru_cache
 from uuid import uuid4
-import tiktoken
-import argparse  # Добавляем импорт argparse
 
 
 class VectorDB:
     def __init__(self, persist_directory=CHROMA_PATH):
         self.persist_directory = persist_directory
-        self.embedding_model = OpenAIEmbeddings(api_key=OPENAI_API_KEY)
+        self.embedding_model = get_embedding_model()
         self.vector_store = None
         # Инициализируем токенизатор
-        self.tokenizer = tiktoken.encoding_for_model("text-embedding-ada-002")
+        self.tokenizer = get_tokenizer()
 
     def count_tokens(self, text: str) -> int:
         """Подсчет токенов в тексте"""
-        return len(self.tokenizer.encode(text))
+        return len(self.tokenizer.encode_ordinary(text))
 
-    def batch_documents(self, docs: List[Document], max_tokens: int = 250000) -> List[List[Document]]:
-        """Разбивает документы на батчи с учетом ограничения токенов"""
+    def batch_documents(self, docs: List[Document], max_tokens: int = 250000, max_docs: int = None) -> List[List[Document]]:
+        """Разбивает документы на батчи с учетом ограничения токенов (и, если задано, числа документов)"""
         batches = []
         current_batch = []
         current_tokens = 0
@@ -40,7 +46,7 @@ class VectorDB:
         for doc in docs:
             doc_tokens = self.count_tokens(doc.page_content)
             
-            if current_tokens + doc_tokens > max_tokens:
+            if current_batch and (current_tokens + doc_tokens > max_tokens or (max_docs and len(current_batch) >= max_docs)):
                 batches.append(current_batch)
                 current_batch = [doc]
                 current_tokens = doc_tokens
@@ -53,26 +59,22 @@ class VectorDB:
 
         return batches
 
-    def load_documents(self, folder_path):
-        """Load documents from a directory, supporting txt, md, docx, and json."""
+    def load_documents(self, folder_path, fingerprints=None):
+        """
+        Load documents from a directory, supporting xlsx and xls.
+        fingerprints (dict) receives filename -> (path, fingerprint) of every workbook, taken before it is read.
+        """
         try:
             docs = []
             for filename in os.listdir(folder_path):
                 file_path = os.path.join(folder_path, filename)
                 if filename.endswith((".xlsx", ".xls")):
-                    engine = 'openpyxl' if filename.endswith('.xlsx') else 'xlrd'
-                    df = pd.read_excel(file_path, engine=engine)
-                    for _, row in df.iterrows():
-                        content_parts = [
-                            f"{col}: {v}"
-                            for col, v in row.items() 
-                        ]
-                        text = "\n".join(content_parts)
-                        doc = Document(
-                            page_content=text,
-                            metadata={"source": file_path, "filename": filename}
-                        )
-                        docs.append(doc)
+                    if fingerprints is None:
+                        docs.extend(self.load_single_file(file_path))
+                        continue
+                    fingerprint = file_fingerprint(file_path)
+                    fingerprints[filename] = (file_path, fingerprint)
+                    docs.extend(self.load_single_file(file_path, fingerprint["sha256"]))
                 else:
                     print(f"[LOAD_DOCUMENTS] Unsupported file type: {filename}")
                     continue
@@ -83,26 +85,25 @@ class VectorDB:
             print(f"[LOAD_DOCUMENTS] error: {e}")
             raise e
 
-    def load_single_file(self, file_path):
-        """Load documents from a single file."""
+    def load_single_file(self, file_path, file_hash=None):
+        """
+        Load documents from a single file: the sheets and columns given by the ingestion schema
+        (agent/ingest_schema.py), long rows split into chunks. Parsed sheets come from the
+        workbook cache while the file content is unchanged.
+        """
         try:
-            docs = []
             filename = os.path.basename(file_path)
             
             if filename.endswith((".xlsx", ".xls")):
-                engine = 'openpyxl' if filename.endswith('.xlsx') else 'xlrd'
-                df = pd.read_excel(file_path, engine=engine)
-                for _, row in df.iterrows():
-                    content_parts = [
-                        f"{col}: {v}"
-                        for col, v in row.items() 
-                    ]
-                    text = "\n".join(content_parts)
-                    doc = Document(
-                        page_content=text,
-                        metadata={"source": file_path, "filename": filename}
-                    )
-                    docs.append(doc)
+                sheets = read_workbook(file_path, file_hash)
+                docs = []
+                for sheet_name, df, sheet_schema in sheets:
+                    docs.extend(sheet_documents(
+                        df, sheet_schema,
+                        metadata={"source": file_path, "filename": filename, "sheet": sheet_name}
+                    ))
+                rows = sum(len(df) for _, df, _ in sheets)
+                print(f"[LOAD_SINGLE_FILE] {filename}: листов {len(sheets)}, {rows} строк -> {len(docs)} документов")
             else:
                 print(f"[LOAD_SINGLE_FILE] Unsupported file type: {filename}")
                 return []
@@ -115,6 +116,9 @@ class VectorDB:
 
     def create_vector_store(self, data_path=None):
         """Recreate the vector database."""
+        if VECTOR_BACKEND == "numpy":
+            return self._create_numpy_vector_store(data_path)
+
         # Устанавливаем umask для создания файлов с полными правами
         old_umask = os.umask(0o000)
         
@@ -130,18 +134,22 @@ class VectorDB:
                 
                 # Use provided data_path or default DATA_PATH
                 folder_path = data_path if data_path else DATA_PATH
-                docs = self.load_documents(folder_path)
+                fingerprints = {}
+                docs = self.load_documents(folder_path, fingerprints)
                 
                 if not docs:
                     print("[CREATE_VECTOR_STORE] Нет документов для обработки")
+                    self._record_manifest(docs, [], fingerprints=fingerprints)
                     return
                 
                 # Создаем базу для первого батча
                 batches = self.batch_documents(docs)
                 print(f"[CREATE_VECTOR_STORE] Total batches: {len(batches)}")
+                all_ids = []
 
                 for i, batch in enumerate(batches):
                     uuids = [str(uuid4()) for _ in range(len(batch))]
+                    all_ids.extend(uuids)
                     
                     if i == 0:
                         # Создаем новую базу с первым батчем
@@ -180,6 +188,9 @@ class VectorDB:
                     
                     print(f"[CREATE_VECTOR_STORE] Processed batch {i+1}/{len(batches)}")
 
+                self._update_lexical_index(add_docs=docs, add_ids=all_ids, clear=True)
+                self._record_manifest(docs, all_ids, fingerprints=fingerprints)
+                bump_index_generation()
                 print("[CREATE_VECTOR_STORE] Vector database successfully created.")
                 return  # Успешно завершено
                 
@@ -194,6 +205,31 @@ class VectorDB:
                     print("[CREATE_VECTOR_STORE] Все попытки исчерпаны")
                     raise e
 
+    def _create_numpy_vector_store(self, data_path=None):
+        """Пересоздание numpy индекса: матрица строится заново и сохраняется атомарно"""
+        folder_path = data_path if data_path else DATA_PATH
+        fingerprints = {}
+        docs = self.load_documents(folder_path, fingerprints)
+
+        self.vector_store = NumpyVectorStore(self.embedding_model)
+        all_ids = []
+        batches = self.batch_documents(docs)
+        print(f"[CREATE_VECTOR_STORE] Total batches: {len(batches)}")
+        with self.vector_store.deferred_save():
+            for i, batch in enumerate(batches):
+                uuids = [str(uuid4()) for _ in range(len(batch))]
+                self.vector_store.add_documents(documents=batch, ids=uuids)
+                all_ids.extend(uuids)
+                print(f"[CREATE_VECTOR_STORE] Processed batch {i+1}/{len(batches)}")
+            if not all_ids:
+                # Пустой индекс тоже сохраняется, чтобы заменить прежний
+                self.vector_store.save()
+
+        self._update_lexical_index(add_docs=docs, add_ids=all_ids, clear=True)
+        self._record_manifest(docs, all_ids, fingerprints=fingerprints)
+        bump_index_generation()
+        print(f"[CREATE_VECTOR_STORE] Numpy index successfully created: {len(all_ids)} documents.")
+
     def _force_cleanup_chroma(self):
         """Принудительная очистка ChromaDB"""
         import time
@@ -325,6 +361,11 @@ class VectorDB:
     def get_or_create_vector_store(self):
         """Получить существующую или создать новую базу знаний"""
         try:
+            if VECTOR_BACKEND == "numpy":
+                # Индекс всегда перечитывается с диска: его могли изменить другие процессы
+                self.vector_store = NumpyVectorStore.load(self.embedding_model)
+                return self.vector_store
+
             if os.path.exists(self.persist_directory) and os.listdir(self.persist_directory):
                 # База данных существует, загружаем её
                 print(f"[VECTOR_STORE] Загружаем существующую базу из {self.persist_directory}")
@@ -349,27 +390,179 @@ class VectorDB:
             print(f"[VECTOR_STORE] Ошибка при инициализации: {e}")
             raise e
 
-    def add_file_to_knowledge_base(self, file_path):
-        """Добавить один файл в базу знаний"""
+    def _deferred_save(self, vector_store=None):
+        """
+        Блок записей, после которого numpy индекс сохраняется один раз (а не после каждого батча).
+        Блок держит межпроцессную блокировку индекса и начинается с его перечитывания с диска
+        """
+        vector_store = vector_store or self.vector_store
+        if isinstance(vector_store, NumpyVectorStore):
+            return vector_store.deferred_save()
+        return nullcontext()
+
+    def _update_lexical_index(self, add_docs=None, add_ids=None, remove_ids=None, clear=False):
+        """Синхронизирует лексический (BM25) индекс с векторным хранилищем"""
+        try:
+            # Перечитываем индекс с диска под блокировкой: его меняют и другие процессы
+            with LexicalIndex.locked() as lexical_index:
+                if clear:
+                    lexical_index.clear()
+                if remove_ids:
+                    lexical_index.delete(remove_ids)
+                if add_docs:
+                    lexical_index.add_documents(add_docs, add_ids)
+            print(f"[LEXICAL_INDEX] Лексический индекс обновлен: {len(lexical_index)} документов")
+        except Exception as e:
+            print(f"[LEXICAL_INDEX] Ошибка при обновлении лексического индекса: {e}")
+
+    def iter_store_pages(self, where=None, include=None, page_size=STORE_PAGE_SIZE):
+        """
+        Постраничное чтение коллекции вместо полного get(): по умолчанию только id (include=[]),
+        тексты документов и эмбеддинги не загружаются
+        """
+        include = [] if include is None else include
+        offset = 0
+        while True:
+            page = self.vector_store.get(where=where, include=include, limit=page_size, offset=offset)
+            if not page or not page['ids']:
+                return
+            yield page
+            if len(page['ids']) < page_size:
+                return
+            offset += page_size
+
+    def get_ids(self, where=None):
+        """Все id коллекции (или подходящие под where) постранично"""
+        return [doc_id for page in self.iter_store_pages(where=where) for doc_id in page['ids']]
+
+    def get_catalog(self):
+        """
+        Каталог базы знаний: id документов по файлам. Берется из манифеста индексации,
+        для базы, построенной до него, - постраничным чтением одних метаданных
+        """
+        manifest = IngestManifest.load()
+        if manifest.files:
+            return {filename: manifest.doc_ids(filename) for filename in manifest.files}
+        
+        if not self.vector_store or VECTOR_BACKEND == "numpy":
+            self.get_or_create_vector_store()
+        catalog = {}
+        for page in self.iter_store_pages(include=["metadatas"]):
+            for doc_id, metadata in zip(page['ids'], page['metadatas']):
+                filename = (metadata or {}).get('filename')
+                if filename:
+                    catalog.setdefault(filename, []).append(doc_id)
+        return catalog
+
+    def _file_doc_ids(self, filename, manifest):
+        """Id документов файла: из манифеста, для файлов, проиндексированных до него, - запросом по метаданным"""
+        if filename in manifest:
+            return manifest.doc_ids(filename)
+        return self.get_ids(where={"filename": filename})
+
+    @staticmethod
+    def _prune_workbook_cache(manifest):
+        """Удаляет из кэша разобранных таблиц версии файлов, которых нет в манифесте"""
+        try:
+            workbook_cache.prune(entry.get("sha256") for entry in manifest.files.values())
+        except Exception as e:
+            print(f"[WORKBOOK_CACHE] Ошибка при очистке кэша: {e}")
+
+    def _record_manifest(self, docs, ids, added_ids=None, fingerprints=None):
+        """
+        Записывает манифест полной сборки: только файлы, все документы которых добавлены
+        (файлы без документов - с пустым списком id). fingerprints - версии файлов,
+        снятые до чтения (load_documents)
+        """
+        try:
+            added = set(ids if added_ids is None else added_ids)
+            incomplete = {doc.metadata.get("filename") for doc, doc_id in zip(docs, ids) if doc_id not in added}
+            complete = [(doc, doc_id) for doc, doc_id in zip(docs, ids) if doc.metadata.get("filename") not in incomplete]
+            files = {filename: entry for filename, entry in (fingerprints or {}).items() if filename not in incomplete}
+            with IngestManifest.locked() as manifest:
+                manifest.clear()
+                manifest.record_documents([doc for doc, _ in complete], [doc_id for _, doc_id in complete], files)
+            self._prune_workbook_cache(manifest)
+            print(f"[INGEST_MANIFEST] Манифест обновлен: {len(manifest)} файлов")
+        except Exception as e:
+            print(f"[INGEST_MANIFEST] Ошибка при обновлении манифеста: {e}")
+
+    def add_file_to_knowledge_base(self, file_path, progress_callback=None, force=False):
+        """
+        Добавить один файл в базу знаний
+
+        Файл, уже проиндексированный в той же версии (по манифесту), пропускается без чтения.
+        Документы предыдущей версии файла удаляются после добавления новых.
+
+        Args:
+            file_path: Путь к файлу
+            progress_callback: Необязательная функция (processed, total), вызывается после каждого батча
+            force: Переиндексировать, даже если файл не изменился
+        """
         try:
             print(f"[ADD_FILE] Добавляем файл: {file_path}")
+            filename = os.path.basename(file_path)
+            manifest = IngestManifest.load()
+            
+            if not force and manifest.is_unchanged(filename, file_path):
+                # Сохраняем обновленное время изменения (файл могли тронуть без изменения содержимого)
+                with IngestManifest.locked() as current:
+                    current.put(filename, manifest.get(filename))
+                print(f"[ADD_FILE] Файл {filename} не изменился, пропускаем")
+                return {"status": "success", "message": "Файл не изменился", "added_docs": 0, "skipped": True}
             
             # Получаем или создаем базу знаний
-            if not self.vector_store:
+            if not self.vector_store or VECTOR_BACKEND == "numpy":
                 self.get_or_create_vector_store()
             
+            # Версия файла фиксируется до чтения: изменение во время чтения будет замечено в следующий раз
+            fingerprint = file_fingerprint(file_path)
+            old_ids = self._file_doc_ids(filename, manifest)
+            
             # Загружаем документы из файла
-            docs = self.load_single_file(file_path)
-            if not docs:
-                print(f"[ADD_FILE] Нет документов в файле {file_path}")
-                return {"status": "success", "message": "Файл пуст", "added_docs": 0}
+            docs = self.load_single_file(file_path, fingerprint["sha256"])
             
-            # Добавляем документы в базу знаний
+            # Добавляем документы в базу знаний батчами, чтобы сообщать о прогрессе
             uuids = [str(uuid4()) for _ in range(len(docs))]
-            self.vector_store.add_documents(documents=docs, ids=uuids)
+            if progress_callback:
+                progress_callback(0, len(docs))
+            added = 0
+            with self._deferred_save():
+                try:
+                    for start in range(0, len(docs), INGEST_BATCH_SIZE):
+                        end = min(start + INGEST_BATCH_SIZE, len(docs))
+                        self.vector_store.add_documents(documents=docs[start:end], ids=uuids[start:end])
+                        added = end
+                        if progress_callback:
+                            progress_callback(end, len(docs))
+                except BaseException:
+                    # Ошибка или отмена задачи посреди файла: убираем уже добавленную часть
+                    if added:
+                        self.vector_store.delete(ids=uuids[:added])
+                    raise
+
+                # Удаляем документы предыдущей версии файла
+                if old_ids:
+                    self.vector_store.delete(ids=old_ids)
+            self._update_lexical_index(add_docs=docs, add_ids=uuids, remove_ids=old_ids)
             
-            print(f"[ADD_FILE] Добавлено {len(docs)} документов из файла {os.path.basename(file_path)}")
-            return {"status": "success", "message": f"Добавлено {len(docs)} документов", "added_docs": len(docs)}
+            # Записываем в актуальную версию манифеста: другие файлы мог обновить другой процесс
+            with IngestManifest.locked() as manifest:
+                manifest.record(filename, file_path, uuids, count_rows(docs), sheet_list(docs), fingerprint)
+            self._prune_workbook_cache(manifest)
+            bump_index_generation()
+            
+            if not docs:
+                print(f"[ADD_FILE] Нет документов в файле {file_path}")
+                return {"status": "success", "message": "Файл пуст", "added_docs": 0, "removed_docs": len(old_ids)}
+            
+            print(f"[ADD_FILE] Добавлено {len(docs)} документов из файла {filename} (удалено {len(old_ids)} старых)")
+            return {
+                "status": "success",
+                "message": f"Добавлено {len(docs)} документов",
+                "added_docs": len(docs),
+                "removed_docs": len(old_ids)
+            }
             
         except Exception as e:
             print(f"[ADD_FILE] Ошибка при добавлении файла {file_path}: {e}")
@@ -381,18 +574,23 @@ class VectorDB:
             print(f"[REMOVE_FILE] Удаляем файл: {filename}")
             
             # Получаем или создаем базу знаний
-            if not self.vector_store:
+            if not self.vector_store or VECTOR_BACKEND == "numpy":
                 self.get_or_create_vector_store()
             
-            # Получаем все документы
             try:
-                # Ищем документы по метаданным
-                results = self.vector_store.get(where={"filename": filename})
-                if results and results['ids']:
+                # Id документов берем из манифеста (или ищем по метаданным)
+                with IngestManifest.locked() as manifest:
+                    doc_ids = self._file_doc_ids(filename, manifest)
+                    removed_entry = manifest.remove(filename)
+                if removed_entry is not None:
+                    self._prune_workbook_cache(manifest)
+                if doc_ids:
                     # Удаляем найденные документы
-                    self.vector_store.delete(ids=results['ids'])
-                    print(f"[REMOVE_FILE] Удалено {len(results['ids'])} документов файла {filename}")
-                    return {"status": "success", "message": f"Удалено {len(results['ids'])} документов", "removed_docs": len(results['ids'])}
+                    self.vector_store.delete(ids=doc_ids)
+                    self._update_lexical_index(remove_ids=doc_ids)
+                    bump_index_generation()
+                    print(f"[REMOVE_FILE] Удалено {len(doc_ids)} документов файла {filename}")
+                    return {"status": "success", "message": f"Удалено {len(doc_ids)} документов", "removed_docs": len(doc_ids)}
                 else:
                     print(f"[REMOVE_FILE] Документы файла {filename} не найдены в базе знаний")
                     return {"status": "success", "message": "Документы не найдены", "removed_docs": 0}
@@ -404,13 +602,19 @@ class VectorDB:
             print(f"[REMOVE_FILE] Ошибка при удалении файла {filename}: {e}")
             return {"status": "error", "message": str(e)}
 
-    def update_knowledge_base_incrementally(self, files_path):
-        """Инкрементально обновить базу знаний"""
+    def update_knowledge_base_incrementally(self, files_path, progress_callback=None):
+        """
+        Инкрементально обновить базу знаний
+
+        Args:
+            files_path: Путь к папке с файлами
+            progress_callback: Необязательная функция (processed, total) по обработанным файлам
+        """
         try:
             print(f"[INCREMENTAL_UPDATE] Обновляем базу знаний из {files_path}")
             
             # Получаем или создаем базу знаний
-            if not self.vector_store:
+            if not self.vector_store or VECTOR_BACKEND == "numpy":
                 self.get_or_create_vector_store()
             
             # Получаем список файлов в папке
@@ -419,25 +623,29 @@ class VectorDB:
                 current_files = {f for f in os.listdir(files_path) 
                                if f.endswith(('.xlsx', '.xls')) and os.path.isfile(os.path.join(files_path, f))}
             
-            # Получаем список файлов в базе знаний
+            # Файлы в базе знаний берем из каталога (манифеста), без чтения всей коллекции
+            manifest = IngestManifest.load()
             try:
-                existing_results = self.vector_store.get()
-                existing_files = set()
-                if existing_results and existing_results['metadatas']:
-                    for metadata in existing_results['metadatas']:
-                        if metadata and 'filename' in metadata:
-                            existing_files.add(metadata['filename'])
-            except:
-                existing_files = set()
-            
-            # Файлы для добавления (есть в папке, но нет в базе)
-            files_to_add = current_files - existing_files
+                existing_files = set(self.get_catalog())
+            except Exception:
+                existing_files = set(manifest.files)
             
             # Файлы для удаления (есть в базе, но нет в папке)
             files_to_remove = existing_files - current_files
             
+            # Файлы для добавления: новые и измененные (неизмененные пропускаются без чтения)
+            files_to_add = {
+                filename for filename in current_files
+                if not manifest.is_unchanged(filename, os.path.join(files_path, filename))
+            }
+            files_unchanged = current_files - files_to_add
+            
             added_count = 0
             removed_count = 0
+            total_files = len(files_to_add) + len(files_to_remove)
+            processed_files = 0
+            if progress_callback:
+                progress_callback(0, total_files)
             
             # Добавляем новые файлы
             for filename in files_to_add:
@@ -445,12 +653,18 @@ class VectorDB:
                 result = self.add_file_to_knowledge_base(file_path)
                 if result['status'] == 'success':
                     added_count += result.get('added_docs', 0)
+                processed_files += 1
+                if progress_callback:
+                    progress_callback(processed_files, total_files)
             
             # Удаляем отсутствующие файлы
             for filename in files_to_remove:
                 result = self.remove_file_from_knowledge_base(filename)
                 if result['status'] == 'success':
                     removed_count += result.get('removed_docs', 0)
+                processed_files += 1
+                if progress_callback:
+                    progress_callback(processed_files, total_files)
             
             print(f"[INCREMENTAL_UPDATE] Обновление завершено: добавлено {added_count}, удалено {removed_count}")
             
@@ -460,15 +674,22 @@ class VectorDB:
                 "added_docs": added_count,
                 "removed_docs": removed_count,
                 "files_added": list(files_to_add),
-                "files_removed": list(files_to_remove)
+                "files_removed": list(files_to_remove),
+                "files_unchanged": len(files_unchanged)
             }
             
         except Exception as e:
             print(f"[INCREMENTAL_UPDATE] Ошибка при инкрементальном обновлении: {e}")
             return {"status": "error", "message": str(e)}
 
-    def soft_regenerate_vector_store(self, data_path=None):
-        """Мягкая перегенерация: очистка коллекции без удаления файлов базы данных"""
+    def soft_regenerate_vector_store(self, data_path=None, progress_callback=None):
+        """
+        Мягкая перегенерация: очистка коллекции без удаления файлов базы данных
+
+        Args:
+            data_path: Папка с файлами
+            progress_callback: Необязательная функция (processed, total) по добавленным документам
+        """
         try:
             import os
             from uuid import uuid4
@@ -483,39 +704,65 @@ class VectorDB:
             
             # Очищаем коллекцию (удаляем все документы)
             try:
-                collection = vector_store._collection
-                # Получаем все ID документов и удаляем их
-                all_docs = collection.get()
-                if all_docs['ids']:
-                    print(f"[SOFT_REGENERATE] Удаляем {len(all_docs['ids'])} существующих документов")
-                    collection.delete(ids=all_docs['ids'])
+                # Получаем все ID документов (постранично, без текстов) и удаляем их
+                existing_ids = self.get_ids()
+                if existing_ids:
+                    print(f"[SOFT_REGENERATE] Удаляем {len(existing_ids)} существующих документов")
+                    with self._deferred_save(vector_store):
+                        for start in range(0, len(existing_ids), STORE_PAGE_SIZE):
+                            vector_store.delete(ids=existing_ids[start:start + STORE_PAGE_SIZE])
+                    self._update_lexical_index(clear=True)
+                    bump_index_generation()
                 else:
                     print("[SOFT_REGENERATE] Коллекция уже пустая")
+                with IngestManifest.locked() as manifest:
+                    manifest.clear()
             except Exception as e:
                 print(f"[SOFT_REGENERATE] Ошибка при очистке коллекции: {e}")
             
             # Загружаем документы заново
             folder_path = data_path if data_path else DATA_PATH
-            docs = self.load_documents(folder_path)
+            fingerprints = {}
+            docs = self.load_documents(folder_path, fingerprints)
             
             if not docs:
                 print("[SOFT_REGENERATE] Нет документов для добавления")
+                self._record_manifest(docs, [], fingerprints=fingerprints)
                 return
             
             # Добавляем документы батчами
-            batches = self.batch_documents(docs)
+            batches = self.batch_documents(docs, max_docs=INGEST_BATCH_SIZE)
             print(f"[SOFT_REGENERATE] Добавляем {len(docs)} документов в {len(batches)} батчах")
             
             total_added = 0
-            for i, batch in enumerate(batches):
-                try:
-                    uuids = [str(uuid4()) for _ in range(len(batch))]
-                    vector_store.add_documents(documents=batch, ids=uuids)
-                    total_added += len(batch)
-                    print(f"[SOFT_REGENERATE] Батч {i+1}/{len(batches)}: добавлено {len(batch)} документов")
-                except Exception as e:
-                    print(f"[SOFT_REGENERATE] Ошибка в батче {i+1}: {e}")
-            
+            processed = 0
+            all_ids = [str(uuid4()) for _ in range(len(docs))]
+            added_docs = []
+            added_ids = []
+            if progress_callback:
+                progress_callback(0, len(docs))
+            try:
+                # Numpy индекс сохраняется один раз после всех батчей (и при отмене), до смены поколения
+                with self._deferred_save(vector_store):
+                    for i, batch in enumerate(batches):
+                        try:
+                            uuids = all_ids[processed:processed + len(batch)]
+                            vector_store.add_documents(documents=batch, ids=uuids)
+                            added_docs.extend(batch)
+                            added_ids.extend(uuids)
+                            total_added += len(batch)
+                            print(f"[SOFT_REGENERATE] Батч {i+1}/{len(batches)}: добавлено {len(batch)} документов")
+                        except Exception as e:
+                            print(f"[SOFT_REGENERATE] Ошибка в батче {i+1}: {e}")
+                        processed += len(batch)
+                        if progress_callback:
+                            progress_callback(processed, len(docs))
+            finally:
+                # Даже при отмене лексический индекс соответствует уже добавленным документам
+                self._update_lexical_index(add_docs=added_docs, add_ids=added_ids, clear=True)
+                # В манифест попадают только файлы, добавленные полностью: остальные переиндексирует следующее обновление
+                self._record_manifest(docs, all_ids, added_ids, fingerprints)
+                bump_index_generation()
             print(f"[SOFT_REGENERATE] ✅ Мягкая перегенерация завершена. Добавлено {total_added} документов")
             
         except Exception as e:
@@ -529,6 +776,12 @@ class VectorDB:
                 pass
 
 
+@lru_cache(maxsize=None)
+def get_vector_db() -> VectorDB:
+    """Общий экземпляр VectorDB процесса (API, менеджер синхронизации и прогрев используют один объект)"""
+    return VectorDB()
+
+
 if __name__ == "__main__":
     # Используем путь к папке files
     files_path = os.path.join(BASE_DIR, "files")
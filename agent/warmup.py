@@ -0,0 +1,122 @@
+# agent/warmup.py
+
+import threading
+import time
+from typing import Callable, Optional
+
+from agent.embeddings import LocalOnnxEmbeddings, get_embedding_model
+from agent.lexical_index import get_lexical_index
+from agent.reranker import get_cross_encoder
+from agent.retrieval_cache import get_index_generation
+from agent.tokenizer import count_tokens
+from agent.tools import get_vector_store, search_context
+from config import RAG_HYBRID_SEARCH, RAG_RERANK, WARMUP_QUERY
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class WarmupState:
+    """
+    Startup warm-up of a process: every step loads something the first request would otherwise
+    pay for (tokenizer, embedding model, indexes, compiled graph) and the last one runs a real
+    retrieval. The state answers the health endpoint: ready only after every step succeeded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.status = "cold"  # cold -> warming -> ready | failed
+        self.steps = {}
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.documents = None
+
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+
+    def _step(self, name: str, func: Callable[[], Optional[dict]]) -> None:
+        started = time.perf_counter()
+        try:
+            details = func() or {}
+        except Exception as e:
+            self.steps[name] = {"ok": False, "ms": round((time.perf_counter() - started) * 1000, 1), "error": str(e)}
+            raise
+        self.steps[name] = {"ok": True, "ms": round((time.perf_counter() - started) * 1000, 1), **details}
+        logger.info(f"[WARMUP] {name}: {self.steps[name]}")
+
+    def run(self, agent=None) -> bool:
+        """Run every warm-up step in the calling thread, False if one of them failed"""
+        with self._lock:
+            if self.status == "warming":
+                return False
+            self.status, self.steps, self.error = "warming", {}, None
+            self.started_at, self.finished_at = time.time(), None
+
+        try:
+            self._step("tokenizer", lambda: {"tokens": count_tokens(WARMUP_QUERY)})
+            self._step("embeddings", self._warm_embeddings)
+            self._step("index", self._warm_index)
+            if RAG_RERANK == "cross_encoder":
+                self._step("reranker", lambda: {"loaded": get_cross_encoder().load()})
+            if agent is not None:
+                self._step("graph", lambda: {"nodes": len(agent.graph.get_graph().nodes)})
+            self._step("retrieval", self._warm_retrieval)
+            self.status = "ready"
+        except Exception as e:
+            self.status, self.error = "failed", str(e)
+            logger.error(f"[WARMUP] Прогрев не завершен: {e}")
+        self.finished_at = time.time()
+        logger.info(f"[WARMUP] Статус: {self.status} за {self.finished_at - self.started_at:.2f} с")
+        return self.ready
+
+    def start(self, agent=None) -> None:
+        """Run the warm-up in a background thread, the process serves health checks meanwhile"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.run, args=(agent,), name="warmup", daemon=True)
+            self._thread.start()
+
+    # ----- steps -----
+    @staticmethod
+    def _warm_embeddings() -> dict:
+        model = get_embedding_model()
+        if isinstance(model, LocalOnnxEmbeddings):
+            # Loads the ONNX session; an OpenAI query is embedded by the warm-up retrieval
+            model.embed_query(WARMUP_QUERY)
+        return {"model": type(model).__name__}
+
+    def _warm_index(self) -> dict:
+        generation = get_index_generation()
+        details = {"generation": generation}
+        if RAG_HYBRID_SEARCH:
+            details["lexical_documents"] = len(get_lexical_index(generation))
+        store = get_vector_store()
+        if store is None:
+            raise RuntimeError("векторное хранилище недоступно")
+        return details
+
+    def _warm_retrieval(self) -> dict:
+        # The real rag_search path: routing, vector and BM25 search, reranking, context packing.
+        # Bypasses the retrieval cache so the first user query and the cache metrics stay genuine
+        _, documents_count = search_context(WARMUP_QUERY, use_cache=False)
+        self.documents = documents_count
+        return {"documents": documents_count}
+
+    def to_dict(self) -> dict:
+        return {
+            "status": self.status,
+            "ready": self.ready,
+            "steps": dict(self.steps),
+            "error": self.error,
+            "warmup_seconds": round(self.finished_at - self.started_at, 2) if self.finished_at and self.started_at else None,
+            "documents": self.documents,
+        }
+
+
+warmup_state = WarmupState()
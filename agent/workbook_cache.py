@@ -0,0 +1,217 @@
+# agent/workbook_cache.py
+
+import hashlib
+import json
+import os
+import unicodedata
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+
+from config import WORKBOOK_CACHE_PATH, WORKBOOK_CACHE_ENABLED
+from agent.ingest_manifest import file_sha256
+import logs.logging_config
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+_CACHE_SUFFIX = ".arrow"
+_SHEETS_SUFFIX = ".sheets.json"
+
+
+def normalize_name(name) -> str:
+    """Sheet or column name as compared by the ingestion schema: NFC, whitespace collapsed"""
+    return " ".join(unicodedata.normalize("NFC", str(name)).split())
+
+
+def _engine(file_path: str) -> str:
+    return "openpyxl" if file_path.endswith(".xlsx") else "xlrd"
+
+
+def _columns_key(usecols: Optional[Sequence[str]]) -> str:
+    return "*" if usecols is None else "\x1f".join(sorted(normalize_name(column) for column in usecols))
+
+
+def _entry_path(directory: str, file_hash: str, sheet_name: str, usecols: Optional[Sequence[str]]) -> str:
+    digest = hashlib.md5(f"{sheet_name}\x1e{_columns_key(usecols)}".encode("utf-8")).hexdigest()[:12]
+    return os.path.join(directory, f"{file_hash}-{digest}{_CACHE_SUFFIX}")
+
+
+def _atomic_write(path: str, write) -> None:
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# ---------- ARROW CONVERSION ---------- #
+def _to_arrow(df: pd.DataFrame):
+    """
+    Arrow table of a parsed sheet. Object columns mixing types (numbers and text in one Excel
+    column) cannot be stored as is, their non-empty cells are kept as str(value), which is
+    exactly how chunk_sheet renders them.
+    """
+    import pyarrow as pa
+
+    df = df.copy()
+    df.columns = [str(column) for column in df.columns]
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    for column in df.columns:
+        if df[column].dtype == object:
+            try:
+                pa.array(df[column], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                df[column] = df[column].map(lambda value: value if pd.isna(value) else str(value))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _from_arrow(table) -> pd.DataFrame:
+    df = table.to_pandas()
+    # Empty cells of text columns come back as None, pandas.read_excel gives NaN
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].where(df[column].notna(), np.nan)
+    return df
+
+
+# ---------- CACHE ---------- #
+class WorkbookCache:
+    """
+    Parsed sheets of the knowledge workbooks stored as uncompressed Arrow IPC (Feather v2) files,
+    keyed by the sha256 of the workbook content, the sheet name and the selected columns.
+    An unchanged workbook is never re-parsed with openpyxl: the sheet list and the sheets are read
+    from the cache (memory-mapped), a changed workbook gets a new hash and misses the cache.
+    """
+
+    def __init__(self, directory: str = WORKBOOK_CACHE_PATH, enabled: bool = WORKBOOK_CACHE_ENABLED):
+        self.directory = directory
+        self.enabled = enabled
+        if enabled:
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                logger.warning("[WORKBOOK_CACHE] pyarrow не установлен, кэш таблиц отключен")
+                self.enabled = False
+
+    # ----- sheet list -----
+    def sheet_names(self, file_path: str, file_hash: Optional[str] = None) -> List[str]:
+        """Sheet names of the workbook, cached next to the sheets"""
+        if not self.enabled:
+            with pd.ExcelFile(file_path, engine=_engine(file_path)) as workbook:
+                return list(workbook.sheet_names)
+        file_hash = file_hash or file_sha256(file_path)
+        path = os.path.join(self.directory, f"{file_hash}{_SHEETS_SUFFIX}")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+        with pd.ExcelFile(file_path, engine=_engine(file_path)) as workbook:
+            names = list(workbook.sheet_names)
+        self._write_json(path, names)
+        return names
+
+    # ----- sheets -----
+    def read_sheets(self, file_path: str, sheets: Mapping[str, Optional[Sequence[str]]],
+                    file_hash: Optional[str] = None) -> Dict[str, pd.DataFrame]:
+        """
+        DataFrames of the given sheets ({sheet name: columns to read or None for all}), from the
+        cache or parsed (the workbook is opened once for all missing sheets) and then cached.
+        """
+        sheets = dict(sheets)
+        if not self.enabled:
+            return self._parse(file_path, sheets)
+
+        file_hash = file_hash or file_sha256(file_path)
+        frames, missing = {}, {}
+        for sheet_name, usecols in sheets.items():
+            df = self._load(_entry_path(self.directory, file_hash, sheet_name, usecols))
+            if df is None:
+                missing[sheet_name] = usecols
+            else:
+                frames[sheet_name] = df
+        if missing:
+            parsed = self._parse(file_path, missing)
+            for sheet_name, df in parsed.items():
+                self._store(_entry_path(self.directory, file_hash, sheet_name, missing[sheet_name]), df)
+            frames.update(parsed)
+            logger.info(f"[WORKBOOK_CACHE] {os.path.basename(file_path)}: разобрано листов {len(missing)}, из кэша {len(sheets) - len(missing)}")
+        return {sheet_name: frames[sheet_name] for sheet_name in sheets}
+
+    # ----- maintenance -----
+    def prune(self, keep_hashes: Iterable[str]) -> int:
+        """Remove cached sheets of workbook versions that are no longer indexed"""
+        if not self.enabled or not os.path.isdir(self.directory):
+            return 0
+        keep = {file_hash for file_hash in keep_hashes if file_hash}
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith((_CACHE_SUFFIX, _SHEETS_SUFFIX)):
+                continue
+            file_hash = name.split("-", 1)[0].split(".", 1)[0]
+            if file_hash not in keep:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    removed += 1
+                except OSError:
+                    pass
+        if removed:
+            logger.info(f"[WORKBOOK_CACHE] Удалено устаревших записей кэша: {removed}")
+        return removed
+
+    # ----- internals -----
+    @staticmethod
+    def _parse(file_path: str, sheets: Mapping[str, Optional[Sequence[str]]]) -> Dict[str, pd.DataFrame]:
+        """Parse the sheets, only the listed columns (names compared after normalize_name)"""
+        frames = {}
+        with pd.ExcelFile(file_path, engine=_engine(file_path)) as workbook:
+            for sheet_name, usecols in sheets.items():
+                wanted = None if usecols is None else {normalize_name(column) for column in usecols}
+                frames[sheet_name] = workbook.parse(
+                    sheet_name,
+                    usecols=None if wanted is None else (lambda column, wanted=wanted: normalize_name(column) in wanted)
+                )
+        return frames
+
+    @staticmethod
+    def _load(path: str) -> Optional[pd.DataFrame]:
+        if not os.path.exists(path):
+            return None
+        try:
+            from pyarrow import feather
+            return _from_arrow(feather.read_table(path, memory_map=True))
+        except Exception as e:
+            logger.warning(f"[WORKBOOK_CACHE] Не удалось прочитать {path}, лист будет разобран заново: {e}")
+            return None
+
+    def _store(self, path: str, df: pd.DataFrame) -> None:
+        try:
+            from pyarrow import feather
+            os.makedirs(self.directory, exist_ok=True)
+            table = _to_arrow(df)
+            _atomic_write(path, lambda tmp_path: feather.write_feather(table, tmp_path, compression="uncompressed"))
+        except Exception as e:
+            logger.warning(f"[WORKBOOK_CACHE] Не удалось сохранить лист в кэш: {e}")
+
+    def _write_json(self, path: str, payload) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+
+            def write(tmp_path):
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(payload, f, ensure_ascii=False)
+            _atomic_write(path, write)
+        except Exception as e:
+            logger.warning(f"[WORKBOOK_CACHE] Не удалось сохранить список листов: {e}")
+
+
+workbook_cache = WorkbookCache()
@@ -1,16 +1,20 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List
 import os
-import shutil
-import threading
-import asyncio
-from pathlib import Path
-from agent.vector_db import VectorDB
+from uuid import uuid4
+import aiofiles
+from agent.vector_db import get_vector_db
+from agent.warmup import warmup_state
+from agent.ingest_manifest import IngestManifest
 from sync_manager import regen_manager
-from integrations.talkme_integration import handle_talkme_webhook, get_talkme_stats, clear_talkme_session, clear_all_talkme_sessions
+from job_manager import job_manager
+from file_claims import claim_files, release_claim
+from config import UPLOAD_CHUNK_SIZE, WARMUP_ON_STARTUP
+from agent.metrics import registry as metrics_registry
+from integrations.talkme_integration import talkme_integration, handle_talkme_webhook, get_talkme_stats, clear_talkme_session, clear_all_talkme_sessions
 import uvicorn
 
 app = FastAPI(title="Iteira Knowledge Base API", version="1.0.0")
@@ -32,11 +36,14 @@ FILES_DIR = "files"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FILES_PATH = os.path.join(BASE_DIR, FILES_DIR)
 
+# Суффикс временных файлов загрузки (file_watcher и список файлов их не видят)
+UPLOAD_TMP_SUFFIX = ".upload"
+
 # Создаем папку files если её нет
 os.makedirs(FILES_PATH, exist_ok=True)
 
-# Инициализируем VectorDB
-vector_db = VectorDB()
+# Инициализируем VectorDB (общий экземпляр с менеджером синхронизации)
+vector_db = get_vector_db()
 
 # Запускаем API при старте приложения
 @app.on_event("startup")
@@ -44,6 +51,9 @@ async def startup_event():
     print("🚀 API сервер запущен")
     # Обеспечиваем правильные права доступа при старте
     ensure_data_directories()
+    # Прогрев в фоне: индекс, модели и граф агента загружаются до первого вебхука, /health отвечает 503 до готовности
+    if WARMUP_ON_STARTUP:
+        warmup_state.start(talkme_integration.consultation_agent)
 
 def refresh_rag_cache_internal():
     """Внутренняя функция для обновления RAG кэша"""
@@ -55,9 +65,13 @@ def refresh_rag_cache_internal():
             importlib.reload(sys.modules['agent.tools'])
         
         from agent.tools import get_vector_store
+        from agent.retrieval_cache import retrieval_cache
         import chromadb
         from config import CHROMA_PATH
         
+        # Сбрасываем кэш результатов поиска
+        retrieval_cache.clear()
+        
         # Создаем новое подключение к векторной базе
         vector_store = get_vector_store()
         
@@ -97,7 +111,7 @@ def ensure_data_directories():
         except Exception as e:
             print(f"Предупреждение: не удалось установить права для {directory}: {e}")
 
-def update_knowledge_base_incremental(source="API"):
+def update_knowledge_base_incremental(source="API", progress_callback=None):
     """Инкрементальное обновление базы знаний"""
     try:
         # Обеспечиваем правильные права доступа
@@ -106,7 +120,7 @@ def update_knowledge_base_incremental(source="API"):
         print(f"🔄 Начинаем инкрементальное обновление базы знаний (источник: {source})")
         
         # Используем инкрементальное обновление
-        result = vector_db.update_knowledge_base_incrementally(FILES_PATH)
+        result = vector_db.update_knowledge_base_incrementally(FILES_PATH, progress_callback=progress_callback)
         
         if result["status"] == "error":
             raise HTTPException(status_code=500, detail=result["message"])
@@ -119,14 +133,14 @@ def update_knowledge_base_incremental(source="API"):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при обновлении базы знаний: {str(e)}")
 
-def add_file_to_knowledge_base(file_path, source="API"):
+def add_file_to_knowledge_base(file_path, source="API", progress_callback=None):
     """Добавить конкретный файл в базу знаний"""
     try:
         ensure_data_directories()
         
         print(f"➕ Добавляем файл в базу знаний: {os.path.basename(file_path)} (источник: {source})")
         
-        result = vector_db.add_file_to_knowledge_base(file_path)
+        result = vector_db.add_file_to_knowledge_base(file_path, progress_callback=progress_callback)
         
         if result["status"] == "error":
             raise HTTPException(status_code=500, detail=result["message"])
@@ -159,13 +173,122 @@ def remove_file_from_knowledge_base(filename, source="API"):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при удалении файла из базы знаний: {str(e)}")
 
-def regenerate_knowledge_base(source="API"):
+def index_uploaded_files(job, filenames, source="API"):
+    """Фоновая задача: добавить загруженные файлы в базу знаний, прогресс - в документах"""
+    results = []
+    indexed_docs = 0
+    for filename in filenames:
+        job.check_cancelled()
+        file_path = os.path.join(FILES_PATH, filename)
+        job.description = f"Индексация {filename}"
+
+        def on_progress(processed, total, offset=indexed_docs):
+            job.update_progress(offset + processed, offset + total)
+
+        try:
+            kb_result = add_file_to_knowledge_base(file_path, progress_callback=on_progress)
+            indexed_docs += kb_result.get("added_docs", 0)
+        except HTTPException as e:
+            kb_result = {"status": "error", "message": e.detail}
+        results.append({"filename": filename, "knowledge_base_result": kb_result})
+
+    failed = [r["filename"] for r in results if r["knowledge_base_result"]["status"] == "error"]
+    if failed:
+        raise RuntimeError(f"Не удалось добавить в базу знаний: {', '.join(failed)}")
+    job.description = f"Индексация {len(filenames)} файлов"
+    return {"knowledge_base_updates": results, "added_docs": indexed_docs}
+
+def run_job_operation(operation, *args, **kwargs):
+    """Выполнить операцию базы знаний в фоновой задаче: HTTPException превращается в ошибку задачи"""
+    try:
+        return operation(*args, **kwargs)
+    except HTTPException as e:
+        raise RuntimeError(e.detail)
+
+def delete_file_job(job, filename):
+    """Фоновая задача: удалить файл из базы знаний, затем с диска"""
+    # Удаление файла с диска не должно запускать еще одно удаление из базы в file_watcher
+    claim = claim_files([filename], owner=f"job {job.id}")
+    try:
+        job.update_progress(0, 2)
+        kb_result = run_job_operation(remove_file_from_knowledge_base, filename)
+        job.update_progress(1, 2)
+        file_path = os.path.join(FILES_PATH, filename)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        job.update_progress(2, 2)
+    finally:
+        release_claim(claim)
+    return {
+        "message": f"Файл {filename} успешно удален",
+        "knowledge_base_result": kb_result
+    }
+
+def delete_all_files_job(job):
+    """Фоновая задача: удалить все файлы и перегенерировать (пустую) базу знаний"""
+    deleted_files = []
+    filenames = [
+        filename for filename in os.listdir(FILES_PATH)
+        if os.path.isfile(os.path.join(FILES_PATH, filename)) and not filename.endswith(UPLOAD_TMP_SUFFIX)
+    ]
+    # База пересобирается здесь же, file_watcher удаления не обрабатывает
+    claim = claim_files(filenames, owner=f"job {job.id}")
+    try:
+        for filename in filenames:
+            file_path = os.path.join(FILES_PATH, filename)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+                deleted_files.append(filename)
+        
+        # Перегенерируем базу знаний (она будет пустой)
+        regenerate_result = run_job_operation(regenerate_knowledge_base, progress_callback=job.update_progress, wait=True)
+    finally:
+        release_claim(claim)
+    
+    return {
+        "message": f"Удалено {len(deleted_files)} файлов",
+        "deleted_files": deleted_files,
+        "knowledge_base": regenerate_result
+    }
+
+def job_response(job, message):
+    """Ответ эндпоинта, поставившего задачу в очередь"""
+    return {
+        "message": message,
+        "job_id": job.id,
+        "job": job.to_dict()
+    }
+
+async def save_upload(file: UploadFile, file_path: str) -> int:
+    """Потоково сохранить загруженный файл: чанками во временный файл, затем атомарное переименование"""
+    tmp_path = os.path.join(
+        os.path.dirname(file_path), f".{os.path.basename(file_path)}.{uuid4().hex[:8]}{UPLOAD_TMP_SUFFIX}"
+    )
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as buffer:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await buffer.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, file_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        await file.close()
+    return size
+
+def regenerate_knowledge_base(source="API", progress_callback=None, wait=False):
     """Полная перегенерация базы знаний из файлов (для обратной совместимости)"""
     try:
         # Обеспечиваем правильные права доступа перед перегенерацией
         ensure_data_directories()
         
-        result = regen_manager.regenerate(FILES_PATH, source)
+        result = regen_manager.regenerate(FILES_PATH, source, progress_callback=progress_callback, wait=wait)
         
         if result["status"] == "error":
             raise HTTPException(status_code=500, detail=result["message"])
@@ -192,7 +315,7 @@ async def get_files():
         files = []
         for filename in os.listdir(FILES_PATH):
             file_path = os.path.join(FILES_PATH, filename)
-            if os.path.isfile(file_path):
+            if os.path.isfile(file_path) and not filename.endswith(UPLOAD_TMP_SUFFIX):
                 file_size = os.path.getsize(file_path)
                 files.append({
                     "name": filename,
@@ -218,105 +341,96 @@ async def download_file(filename: str):
 
 @app.post("/files/upload")
 async def upload_files(files: List[UploadFile] = File(...)):
-    """Загрузить один или несколько файлов"""
+    """Загрузить один или несколько файлов, индексация выполняется фоновой задачей"""
+    # Проверяем расширения всех файлов до записи на диск
+    for file in files:
+        if not file.filename.endswith(('.xlsx', '.xls')):
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Неподдерживаемый тип файла: {file.filename}. Поддерживаются только .xlsx и .xls файлы"
+            )
+    
     uploaded_files = []
+    # Файлы захвачены до переименования в files/ и до конца фоновой индексации (или ее отмены):
+    # file_watcher видит событие переименования, но индексацию оставляет задаче
+    claim = claim_files([os.path.basename(file.filename) for file in files], owner="upload")
     
     try:
         for file in files:
-            # Проверяем расширение файла
-            if not file.filename.endswith(('.xlsx', '.xls')):
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Неподдерживаемый тип файла: {file.filename}. Поддерживаются только .xlsx и .xls файлы"
-                )
-            
-            file_path = os.path.join(FILES_PATH, file.filename)
+            filename = os.path.basename(file.filename)
+            file_path = os.path.join(FILES_PATH, filename)
             
-            # Сохраняем файл
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            # Сохраняем файл потоково, не блокируя event loop
+            size = await save_upload(file, file_path)
             
             uploaded_files.append({
-                "name": file.filename,
-                "size": os.path.getsize(file_path),
+                "name": filename,
+                "size": size,
                 "status": "uploaded"
             })
         
-        # Добавляем файлы в базу знаний инкрементально
-        knowledge_base_results = []
-        for file_info in uploaded_files:
-            file_path = os.path.join(FILES_PATH, file_info["name"])
-            kb_result = add_file_to_knowledge_base(file_path)
-            knowledge_base_results.append({
-                "filename": file_info["name"],
-                "knowledge_base_result": kb_result
-            })
+        # Добавляем файлы в базу знаний в фоне
+        filenames = [file_info["name"] for file_info in uploaded_files]
+        job = job_manager.submit(
+            "upload",
+            lambda job: index_uploaded_files(job, filenames),
+            f"Индексация {len(filenames)} файлов",
+            on_finish=lambda job: release_claim(claim)
+        )
         
         return {
             "uploaded_files": uploaded_files,
-            "knowledge_base_updates": knowledge_base_results
+            "job_id": job.id,
+            "job": job.to_dict()
         }
         
     except Exception as e:
+        release_claim(claim)
         raise HTTPException(status_code=500, detail=f"Ошибка при загрузке файлов: {str(e)}")
 
 @app.delete("/files/{filename}")
 async def delete_file(filename: str):
-    """Удалить конкретный файл"""
+    """Удалить конкретный файл (фоновая задача)"""
     file_path = os.path.join(FILES_PATH, filename)
     
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="Файл не найден")
     
-    try:
-        # Сначала удаляем из базы знаний
-        kb_result = remove_file_from_knowledge_base(filename)
-        
-        # Затем удаляем физический файл
-        os.remove(file_path)
-        
-        return {
-            "message": f"Файл {filename} успешно удален",
-            "knowledge_base_result": kb_result
-        }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка при удалении файла: {str(e)}")
+    job = job_manager.submit(
+        "delete_file",
+        lambda job: delete_file_job(job, filename),
+        f"Удаление {filename}",
+        coalesce_key=f"delete_file:{filename}"
+    )
+    return job_response(job, f"Удаление файла {filename} поставлено в очередь")
 
 @app.delete("/files")
 async def delete_all_files():
-    """Удалить все файлы"""
-    try:
-        deleted_files = []
-        for filename in os.listdir(FILES_PATH):
-            file_path = os.path.join(FILES_PATH, filename)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-                deleted_files.append(filename)
-        
-        # Перегенерируем базу знаний (она будет пустой)
-        regenerate_result = regenerate_knowledge_base()
-        
-        return {
-            "message": f"Удалено {len(deleted_files)} файлов",
-            "deleted_files": deleted_files,
-            "knowledge_base": regenerate_result
-        }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка при удалении файлов: {str(e)}")
+    """Удалить все файлы (фоновая задача)"""
+    job = job_manager.submit("delete_all", delete_all_files_job, "Удаление всех файлов", coalesce_key="delete_all")
+    return job_response(job, "Удаление всех файлов поставлено в очередь")
 
 @app.post("/knowledge-base/regenerate")
 async def regenerate_kb():
-    """Принудительно перегенерировать базу знаний (полная перегенерация)"""
-    result = regenerate_knowledge_base()
-    return result
+    """Принудительно перегенерировать базу знаний (полная перегенерация, фоновая задача)"""
+    job = job_manager.submit(
+        "regenerate",
+        lambda job: run_job_operation(regenerate_knowledge_base, progress_callback=job.update_progress, wait=True),
+        "Перегенерация базы знаний",
+        coalesce_key="regenerate"
+    )
+    return job_response(job, "Перегенерация базы знаний поставлена в очередь")
 
 @app.post("/knowledge-base/update")
 async def update_kb():
-    """Инкрементально обновить базу знаний"""
-    result = update_knowledge_base_incremental()
-    return result
+    """Инкрементально обновить базу знаний (фоновая задача)"""
+    job = job_manager.submit(
+        "update",
+        lambda job: run_job_operation(update_knowledge_base_incremental, progress_callback=job.update_progress),
+        "Инкрементальное обновление базы знаний",
+        coalesce_key="update"
+    )
+    return job_response(job, "Обновление базы знаний поставлено в очередь")
 
 @app.get("/knowledge-base/status")
 async def get_kb_status():
@@ -327,10 +441,17 @@ async def get_kb_status():
         
         files_count = len([f for f in os.listdir(FILES_PATH) if os.path.isfile(os.path.join(FILES_PATH, f))])
         
+        # Состав базы знаний - из манифеста индексации, без чтения коллекции
+        manifest = IngestManifest.load().summary()
+        
         return {
             "knowledge_base_exists": kb_exists,
             "files_count": files_count,
-            "chroma_path": chroma_path
+            "chroma_path": chroma_path,
+            "indexed_files_count": manifest["files_count"],
+            "documents_count": manifest["documents_count"],
+            "rows_count": manifest["rows_count"],
+            "indexed_files": manifest["files"]
         }
         
     except Exception as e:
@@ -356,9 +477,50 @@ async def get_regeneration_status():
     return {
         "is_regenerating": status["is_regenerating"],
         "last_regeneration_time": status["last_regeneration_time"],
-        "manager_status": "Активен" if not status["is_regenerating"] else "Выполняется перегенерация"
+        "manager_status": "Активен" if not status["is_regenerating"] else "Выполняется перегенерация",
+        "active_jobs": job_manager.list_jobs(active_only=True)
     }
 
+# ========== JOBS ==========
+
+@app.get("/jobs")
+async def get_jobs(active: bool = False):
+    """Список фоновых задач базы знаний (active=true - только ожидающие и выполняющиеся)"""
+    return {"jobs": job_manager.list_jobs(active_only=active)}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Статус и прогресс фоновой задачи"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return job.to_dict()
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Отменить фоновую задачу (выполняющаяся остановится между батчами)"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    if job.is_finished:
+        raise HTTPException(status_code=409, detail=f"Задача уже завершена: {job.status}")
+    job_manager.cancel(job_id)
+    return job.to_dict()
+
+# ========== METRICS ==========
+
+@app.get("/health")
+async def health():
+    """Готовность процесса: 200 после успешного прогрева, иначе 503 со статусом шагов прогрева"""
+    if not WARMUP_ON_STARTUP and warmup_state.status == "cold":
+        return {"status": "ok", "ready": True, "warmup": "disabled"}
+    return JSONResponse(status_code=200 if warmup_state.ready else 503, content=warmup_state.to_dict())
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики агента в формате Prometheus: время узлов графа, токены LLM, поиск, ошибки"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # ========== TALK ME WEBHOOK ENDPOINTS ==========
 
 @app.post("/webhook/talkme")
@@ -369,7 +531,7 @@ async def talkme_webhook_endpoint(request: Request):
 @app.get("/webhook/talkme/health")
 async def talkme_health_check():
     """Проверка здоровья Talk Me webhook"""
-    return {"status": "ok", "service": "talkme_webhook"}
+    return {"status": "ok", "service": "talkme_webhook", "ready": warmup_state.ready}
 
 @app.get("/webhook/talkme/stats")
 async def talkme_get_stats():
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк бэкендов эмбеддингов на корпусе files/*.xlsx:
+время построения индекса, задержка одиночного запроса, время на запрос при пакетном
+поиске (search_many) и полнота поиска (recall@k)
+
+Запросы строятся из самих строк таблиц: значение первого заполненного поля строки
+(название услуги, вопрос FAQ, название аппарата) должно находить эту же строку.
+Для второго и следующих бэкендов дополнительно считается совпадение top-k с первым
+бэкендом (по умолчанию OpenAI) - насколько локальная модель воспроизводит эталонную выдачу.
+
+Примеры:
+  python benchmarks/embedding_benchmark.py --backends openai local
+  python benchmarks/embedding_benchmark.py --backends local --k 10 --queries 100
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(BASE_DIR)
+from agent.embeddings import embed_queries, get_embedding_model
+from agent.vector_db import VectorDB
+
+
+def build_queries(docs, limit, seed=42):
+    """Пары (запрос, индекс строки) из первого содержательного поля каждой строки"""
+    queries = []
+    for idx, doc in enumerate(docs):
+        for line in doc.page_content.split("\n"):
+            _, sep, value = line.partition(": ")
+            value = value.strip() if sep else line.strip()
+            if len(value) > 3 and value.lower() != "nan" and not value.isdigit():
+                queries.append((value, idx))
+                break
+    random.Random(seed).shuffle(queries)
+    return queries[:limit]
+
+
+def top_k(matrix, query_vector, k):
+    scores = matrix @ query_vector
+    k = min(k, len(scores))
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+def run_backend(backend, texts, queries, k):
+    model = get_embedding_model(backend)
+
+    start = time.perf_counter()
+    matrix = np.asarray(model.embed_documents(texts), dtype=np.float32)
+    build_time = time.perf_counter() - start
+
+    latencies = []
+    rankings = []
+    for query, _ in queries:
+        start = time.perf_counter()
+        query_vector = np.asarray(model.embed_query(query), dtype=np.float32)
+        rankings.append(top_k(matrix, query_vector, k))
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    # The same queries as one batch: one embedding call and one matrix product (search_many)
+    start = time.perf_counter()
+    query_matrix = embed_queries(model, [query for query, _ in queries])
+    scores = query_matrix @ matrix.T
+    batch_k = min(k, matrix.shape[0])
+    np.argpartition(-scores, batch_k - 1, axis=1)[:, :batch_k]
+    batch_time = time.perf_counter() - start
+
+    recall = sum(target in ranking for (_, target), ranking in zip(queries, rankings)) / max(len(queries), 1)
+    return {
+        "backend": backend,
+        "dimensions": matrix.shape[1] if matrix.size else 0,
+        "build_time_s": build_time,
+        "latency_p50_ms": float(np.percentile(latencies, 50)) if latencies else 0.0,
+        "latency_p95_ms": float(np.percentile(latencies, 95)) if latencies else 0.0,
+        "batch_ms_per_query": batch_time * 1000 / max(len(queries), 1),
+        "recall": recall,
+        "rankings": rankings
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение бэкендов эмбеддингов")
+    parser.add_argument("--backends", nargs="+", default=["openai", "local"], help="openai и/или local")
+    parser.add_argument("--files", default=os.path.join(BASE_DIR, "files"), help="Папка с xlsx файлами")
+    parser.add_argument("--k", type=int, default=5, help="Глубина поиска для recall@k")
+    parser.add_argument("--queries", type=int, default=200, help="Количество запросов")
+    args = parser.parse_args()
+
+    docs = VectorDB().load_documents(args.files)
+    texts = [doc.page_content for doc in docs]
+    queries = build_queries(docs, args.queries)
+    print(f"Документов: {len(texts)}, запросов: {len(queries)}, k={args.k}")
+
+    results = []
+    for backend in args.backends:
+        print(f"\n⏱️ Бэкенд {backend}...")
+        results.append(run_backend(backend, texts, queries, args.k))
+
+    reference = results[0]["rankings"] if results else []
+    print()
+    print(f"{'backend':<10} {'dim':>5} {'build, s':>10} {'p50, ms':>9} {'p95, ms':>9} {'batch, ms/q':>12} {'recall@' + str(args.k):>10} {'overlap':>8}")
+    for result in results:
+        overlap = np.mean([
+            len(set(a.tolist()) & set(b.tolist())) / max(len(a), 1)
+            for a, b in zip(result["rankings"], reference)
+        ]) if reference else 0.0
+        print(
+            f"{result['backend']:<10} {result['dimensions']:>5} {result['build_time_s']:>10.2f} "
+            f"{result['latency_p50_ms']:>9.2f} {result['latency_p95_ms']:>9.2f} {result['batch_ms_per_query']:>12.2f} {result['recall']:>10.3f} {overlap:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест всего конвейера: TalkMe webhook -> ConsultationAgent -> ответ
+
+Записанные (или синтетические) тела webhook'ов TalkMe воспроизводятся на /webhook/talkme.
+Сообщения одного клиента отправляются по порядку, как в живом диалоге, диалоги разных
+виртуальных клиентов идут параллельно (--concurrency). Итог: задержка p50/p95/p99,
+пропускная способность, ошибки и рост памяти (RSS) процесса API.
+
+С --spawn скрипт сам запускает заглушку OpenAI (benchmarks/stub_openai_server.py) и API
+с OPENAI_BASE_URL на нее: ни один запрос не уходит в сеть, результаты воспроизводимы.
+
+Примеры:
+  python benchmarks/load_test.py --spawn --regenerate --users 20 --concurrency 5 --stub-latency-ms 300
+  python benchmarks/load_test.py --url http://localhost:8000 --pid 12345 --users 50 --concurrency 10
+  python benchmarks/load_test.py --spawn --users 20 --output load_test.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+import numpy as np
+import psutil
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(BASE_DIR)
+
+DEFAULT_WEBHOOKS = os.path.join(BASE_DIR, "benchmarks", "data", "talkme_webhooks.jsonl")
+
+
+# ---------- SCENARIOS ---------- #
+def _client_id(body: dict) -> str:
+    """Client of a webhook, the same fields as TalkMeIntegration.parse_talkme_webhook uses"""
+    client = body.get("client") or {}
+    dialog = body.get("originalOnlineChatMessage") or {}
+    return str(body.get("user_id") or client.get("clientId") or client.get("login") or dialog.get("dialogId") or "")
+
+
+def load_dialogs(path: str) -> list:
+    """Webhook bodies grouped into dialogs by client, in recorded order"""
+    dialogs = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                body = json.loads(line)
+                dialogs.setdefault(_client_id(body), []).append(body)
+    return list(dialogs.values())
+
+
+def virtual_users(dialogs: list, users: int, run_id: str) -> list:
+    """users dialogs cycled from the recorded ones, each under its own client id"""
+    result = []
+    for i in range(users):
+        bodies = []
+        for body in dialogs[i % len(dialogs)]:
+            body = json.loads(json.dumps(body))
+            user_id = f"{_client_id(body)}-{run_id}-{i}"
+            body.pop("user_id", None)
+            body.setdefault("client", {})["clientId"] = user_id
+            body.setdefault("originalOnlineChatMessage", {})["dialogId"] = user_id
+            bodies.append(body)
+        result.append(bodies)
+    return result
+
+
+# ---------- LOAD ---------- #
+async def run_dialog(client: httpx.AsyncClient, url: str, bodies: list, semaphore: asyncio.Semaphore, results: list):
+    async with semaphore:
+        for body in bodies:
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json=body)
+                ok = response.status_code == 200 and response.json().get("success", False)
+                status = response.status_code
+            except Exception as e:
+                ok, status = False, type(e).__name__
+            results.append({"latency": time.perf_counter() - start, "ok": ok, "status": status})
+
+
+async def sample_memory(process, samples: list, stop: asyncio.Event, interval: float = 0.5):
+    while not stop.is_set():
+        try:
+            samples.append(process.memory_info().rss)
+        except psutil.Error:
+            return
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_load(args, dialogs: list, process) -> dict:
+    url = args.url.rstrip("/") + "/webhook/talkme"
+    results = []
+    memory = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        sampler = asyncio.create_task(sample_memory(process, memory, stop)) if process else None
+        start = time.perf_counter()
+        await asyncio.gather(*(run_dialog(client, url, bodies, semaphore, results) for bodies in dialogs))
+        duration = time.perf_counter() - start
+        stop.set()
+        if sampler:
+            await sampler
+
+    latencies_ms = np.array([r["latency"] * 1000 for r in results]) if results else np.zeros(1)
+    errors = [r for r in results if not r["ok"]]
+    statuses = {}
+    for r in errors:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    return {
+        "dialogs": len(dialogs),
+        "requests": len(results),
+        "errors": len(errors),
+        "error_statuses": statuses,
+        "concurrency": args.concurrency,
+        "duration_s": duration,
+        "throughput_rps": len(results) / duration if duration else 0.0,
+        "latency_mean_ms": float(latencies_ms.mean()),
+        "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "latency_p95_ms": float(np.percentile(latencies_ms, 95)),
+        "latency_p99_ms": float(np.percentile(latencies_ms, 99)),
+        "latency_max_ms": float(latencies_ms.max()),
+        "rss_start_mb": memory[0] / 2**20 if memory else None,
+        "rss_end_mb": memory[-1] / 2**20 if memory else None,
+        "rss_peak_mb": max(memory) / 2**20 if memory else None,
+    }
+
+
+# ---------- SERVERS ---------- #
+def wait_ready(url: str, timeout: float) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Сервер не ответил за {timeout:.0f} с: {url}")
+
+
+def wait_job(base_url: str, job_id: str, poll_s: float = 1.0) -> dict:
+    """Poll a knowledge-base background job until it finishes"""
+    while True:
+        job = httpx.get(f"{base_url}/jobs/{job_id}", timeout=10).json()
+        if job["status"] in ("success", "error", "cancelled"):
+            return job
+        time.sleep(poll_s)
+
+
+def spawn_servers(args) -> list:
+    """Stub OpenAI server and the API pointed at it"""
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(BASE_DIR, "benchmarks", "stub_openai_server.py"),
+        "--port", str(args.stub_port),
+        "--latency", args.stub_latency,
+        "--latency-ms", str(args.stub_latency_ms),
+        "--jitter-ms", str(args.stub_jitter_ms),
+        "--tokens-per-second", str(args.stub_tokens_per_second),
+        "--rate-limit", str(args.stub_rate_limit),
+        "--seed", str(args.seed),
+    ], cwd=BASE_DIR)
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.stub_port}/v1",
+        "OPENAI_API_KEY": env.get("OPENAI_API_KEY") or "stub",
+        "EMBEDDING_BACKEND": "openai",
+        "TALKME_TEST_MODE": "true",
+    })
+    api = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(args.api_port),
+        "--log-level", "warning",
+    ], cwd=BASE_DIR, env=env)
+    args.url = f"http://127.0.0.1:{args.api_port}"
+    try:
+        wait_ready(f"http://127.0.0.1:{args.stub_port}/health", 30)
+        wait_ready(f"{args.url}/webhook/talkme/health", 120)
+    except Exception:
+        for process in (api, stub):
+            process.terminate()
+        raise
+    return [api, stub]
+
+
+def print_report(report: dict) -> None:
+    print(f"Диалогов: {report['dialogs']}, запросов: {report['requests']}, параллельно: {report['concurrency']}")
+    print(f"Ошибок: {report['errors']} {report['error_statuses'] or ''}")
+    print(f"Длительность: {report['duration_s']:.1f} с, пропускная способность: {report['throughput_rps']:.2f} запр/с")
+    print(f"{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (мс)")
+    print(f"{report['latency_mean_ms']:>10.0f}{report['latency_p50_ms']:>10.0f}{report['latency_p95_ms']:>10.0f}"
+          f"{report['latency_p99_ms']:>10.0f}{report['latency_max_ms']:>10.0f}")
+    if report["rss_start_mb"] is not None:
+        growth = report["rss_end_mb"] - report["rss_start_mb"]
+        print(f"Память API: {report['rss_start_mb']:.0f} -> {report['rss_end_mb']:.0f} МБ "
+              f"(рост {growth:+.0f} МБ, пик {report['rss_peak_mb']:.0f} МБ)")
+    if report.get("stub_requests"):
+        print(f"Запросы к заглушке OpenAI: {report['stub_requests']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест TalkMe webhook")
+    parser.add_argument("--url", default="http://localhost:8000", help="Адрес API")
+    parser.add_argument("--webhooks", default=DEFAULT_WEBHOOKS, help="JSONL с телами webhook'ов TalkMe")
+    parser.add_argument("--users", type=int, default=20, help="Число виртуальных клиентов (диалогов)")
+    parser.add_argument("--concurrency", type=int, default=5, help="Одновременно активных диалогов")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Таймаут запроса, с")
+    parser.add_argument("--pid", type=int, help="PID процесса API для замера памяти")
+    parser.add_argument("--regenerate", action="store_true", help="Перегенерировать базу знаний перед тестом")
+    parser.add_argument("--output", help="Сохранить результат в JSON")
+    parser.add_argument("--spawn", action="store_true", help="Запустить заглушку OpenAI и API самостоятельно")
+    parser.add_argument("--api-port", type=int, default=8001)
+    parser.add_argument("--stub-port", type=int, default=8100)
+    parser.add_argument("--stub-latency", default="uniform", help="Распределение задержки заглушки")
+    parser.add_argument("--stub-latency-ms", type=float, default=300.0)
+    parser.add_argument("--stub-jitter-ms", type=float, default=100.0)
+    parser.add_argument("--stub-tokens-per-second", type=float, default=0.0, help="Скорость генерации ответа заглушкой")
+    parser.add_argument("--stub-rate-limit", type=float, default=0.0, help="Доля ответов 429 от заглушки")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    spawned = spawn_servers(args) if args.spawn else []
+    try:
+        pid = spawned[0].pid if spawned else args.pid
+        process = psutil.Process(pid) if pid else None
+
+        if args.regenerate:
+            print("Перегенерация базы знаний...")
+            base_url = args.url.rstrip('/')
+            response = httpx.post(f"{base_url}/knowledge-base/regenerate", timeout=30)
+            response.raise_for_status()
+            job = wait_job(base_url, response.json()["job_id"])
+            if job["status"] != "success":
+                raise RuntimeError(f"Перегенерация не выполнена: {job['status']} {job['error'] or ''}")
+
+        dialogs = virtual_users(load_dialogs(args.webhooks), args.users, run_id=str(int(time.time())))
+        report = asyncio.run(run_load(args, dialogs, process))
+        if spawned:
+            # Calls that reached the stub, including the rate-limited ones the clients retried
+            report["stub_requests"] = httpx.get(f"http://127.0.0.1:{args.stub_port}/health").json()["requests"]
+        print_report(report)
+
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"Результат сохранен в {args.output}")
+    finally:
+        for process in spawned:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Оценка локального распознавания имени и пола клиента (agent/name_extractor.py)
+
+Для каждого сообщения из набора проверяется, решен ли случай без LLM (покрытие)
+и совпадают ли client_name и gender с разметкой (точность на решенных случаях).
+Неоднозначные сообщения должны уходить в LLM: их локальное "решение" считается ошибкой.
+
+Пример:
+  python benchmarks/name_extraction_eval.py
+  python benchmarks/name_extraction_eval.py --cases benchmarks/data/name_extraction_cases.jsonl -v
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(BASE_DIR)
+from agent.name_extractor import extract_identity
+
+
+def _normalize(value):
+    return value.lower().replace("ё", "е") if isinstance(value, str) else value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Оценка локального распознавания имени")
+    parser.add_argument("--cases", default=os.path.join(BASE_DIR, "benchmarks", "data", "name_extraction_cases.jsonl"))
+    parser.add_argument("-v", "--verbose", action="store_true", help="Показать все случаи")
+    args = parser.parse_args()
+
+    with open(args.cases, "r", encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+
+    resolved = correct = 0
+    errors = []
+    start = time.perf_counter()
+    for case in cases:
+        result = extract_identity(case["message"])
+        if result is None:
+            if args.verbose:
+                print(f"  LLM   {case['message']!r}")
+            continue
+        resolved += 1
+        ok = (
+            _normalize(result["client_name"]) == _normalize(case["client_name"])
+            and result["gender"] == case["gender"]
+        )
+        correct += ok
+        if not ok:
+            errors.append((case, result))
+        if args.verbose:
+            print(f"  {'OK ' if ok else 'ERR'}   {case['message']!r} -> {result['client_name']}, {result['gender']}")
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    total = len(cases)
+    print(f"Сообщений: {total}")
+    print(f"Решено без LLM: {resolved} ({resolved / max(total, 1):.1%})")
+    print(f"Точность на решенных: {correct / max(resolved, 1):.1%}")
+    print(f"Время: {elapsed_ms / max(total, 1):.3f} мс на сообщение")
+    for case, result in errors:
+        print(f"❌ {case['message']!r}: ожидалось {case['client_name']}/{case['gender']}, "
+              f"получено {result['client_name']}/{result['gender']}")
+
+
+if __name__ == "__main__":
+    main()
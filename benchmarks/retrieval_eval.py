@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Оценка качества и скорости поиска на корпусе files/*.xlsx
+
+Размеченный набор benchmarks/data/retrieval_queries.jsonl: запрос клиента -> строки таблиц
+("файл:лист:строка", номер строки как в Excel), где есть ответ. Для каждой конфигурации
+(размер чанков, бэкенд эмбеддингов, хранилище, тип numpy индекса, режим поиска) индекс строится
+во временной папке (data/ не затрагивается) и считаются recall@k, hit@k, MRR и задержка запроса.
+Режимы: dense - только векторный поиск, bm25 - только лексический индекс, hybrid - точное
+совпадение названия, иначе векторный поиск + BM25 через RRF по всему индексу, facet - как в
+rag_search: hybrid отдельно по фасетам базы знаний (agent/facet_router.py) со своим k.
+С --rerank векторные режимы дополнительно прогоняются с переранжированием (agent/reranker.py):
+извлекается --rerank-candidates документов, лучшие --rerank-top-n остаются в ответе.
+
+Примеры:
+  python benchmarks/retrieval_eval.py --backends local --stores numpy --modes dense bm25 hybrid facet
+  python benchmarks/retrieval_eval.py --backends openai local --stores numpy chroma --dtypes float32 int8
+  python benchmarks/retrieval_eval.py --backends local --chunk-sizes 400 200 --k 10 --output retrieval.json
+  python benchmarks/retrieval_eval.py --backends local --modes hybrid facet --rerank off lexical cross_encoder
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unicodedata
+from typing import List
+from uuid import uuid4
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(BASE_DIR)
+from agent.chunking import merge_row_chunks
+from agent.ingest_schema import read_workbook, sheet_documents
+from agent.workbook_cache import WorkbookCache
+from agent.embeddings import get_embedding_model
+from agent.lexical_index import LexicalIndex
+from agent.tokenizer import count_tokens
+from agent.numpy_index import NumpyVectorStore
+from agent.reranker import get_cross_encoder, rerank
+from agent.tools import _retrieve_many
+from config import (
+    CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNK_MIN_TOKENS, RAG_FUSION_CANDIDATES, RAG_RRF_K,
+    RAG_RERANK_MODES, RAG_RERANK_CANDIDATES, RAG_RERANK_TOP_N, RAG_RERANK_BUDGET_MS
+)
+
+DEFAULT_QUERIES = os.path.join(BASE_DIR, "benchmarks", "data", "retrieval_queries.jsonl")
+
+
+def _nfc(text: str) -> str:
+    # File names on disk may be NFD (macOS), labels are NFC
+    return unicodedata.normalize("NFC", text)
+
+
+class PrecomputedEmbeddings(Embeddings):
+    """Document vectors computed once per backend and chunking, reused by every store built from them"""
+
+    def __init__(self, model: Embeddings, texts: List[str], vectors: np.ndarray):
+        self.model = model
+        self.vectors = dict(zip(texts, vectors.tolist()))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.vectors[text] if text in self.vectors else self.model.embed_documents([text])[0] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.embed_query(text)
+
+
+# ---------- CORPUS ---------- #
+def read_sheets(files_dir: str) -> list:
+    """(filename, sheet, DataFrame, sheet schema) of every workbook, as VectorDB.load_single_file reads them"""
+    cache = WorkbookCache(enabled=False)  # data/ is not touched
+    sheets = []
+    for filename in sorted(os.listdir(files_dir)):
+        if not filename.endswith((".xlsx", ".xls")):
+            continue
+        for sheet_name, df, sheet_schema in read_workbook(os.path.join(files_dir, filename), cache=cache):
+            sheets.append((filename, sheet_name, df, sheet_schema))
+    return sheets
+
+
+def chunk_corpus(sheets: list, files_dir: str, max_tokens: int, overlap_tokens: int, min_tokens: int) -> list:
+    docs = []
+    for filename, sheet_name, df, sheet_schema in sheets:
+        docs.extend(sheet_documents(
+            df, sheet_schema,
+            metadata={"source": os.path.join(files_dir, filename), "filename": filename, "sheet": sheet_name},
+            max_tokens=max_tokens, overlap_tokens=overlap_tokens, min_tokens=min_tokens
+        ))
+    return docs
+
+
+def build_store(store_name: str, dtype: str, model: Embeddings, precomputed: PrecomputedEmbeddings, docs, ids, workdir):
+    """Vector store over docs built from the precomputed vectors, queries go to the real model"""
+    texts = [doc.page_content for doc in docs]
+    metadatas = [doc.metadata for doc in docs]
+    if store_name == "numpy":
+        directory = os.path.join(workdir, f"numpy_{dtype}_{uuid4().hex[:8]}")
+        NumpyVectorStore(precomputed, directory, dtype).add_texts(texts, metadatas=metadatas, ids=ids)
+        # Reopen from disk so float16/int8 quantization is applied as in production
+        return NumpyVectorStore.load(model, directory, dtype)
+    if store_name == "chroma":
+        from langchain_chroma import Chroma
+        store = Chroma(
+            collection_name=f"eval_{uuid4().hex[:8]}",
+            embedding_function=precomputed,
+            persist_directory=os.path.join(workdir, "chroma")
+        )
+        for start in range(0, len(texts), 1000):
+            store.add_texts(texts[start:start + 1000], metadatas=metadatas[start:start + 1000], ids=ids[start:start + 1000])
+        store._embedding_function = model
+        return store
+    raise ValueError(f"Неизвестное хранилище: {store_name}")
+
+
+# ---------- METRICS ---------- #
+def ranked_rows(hits) -> List[str]:
+    """Row ids of the retrieved documents in rank order (chunks merged back to rows)"""
+    rows = []
+    for doc, _ in merge_row_chunks(hits):
+        for row_id in str((doc.metadata or {}).get("row_id", "")).split("|"):
+            row_id = _nfc(row_id)
+            if row_id and row_id not in rows:
+                rows.append(row_id)
+    return rows
+
+
+def evaluate(search, queries: list, k: int) -> dict:
+    """recall@k, hit@k, MRR, per-query latency and returned tokens of search(query) -> [(Document, score)]"""
+    search(queries[0]["query"])  # warm-up: model sessions, mmap, first embedding request
+    recalls, hits, reciprocal_ranks, latencies, tokens = [], [], [], [], []
+    for case in queries:
+        expected = {_nfc(row_id) for row_id in case["expected"]}
+        start = time.perf_counter()
+        results = search(case["query"])
+        rows = ranked_rows(results)
+        latencies.append((time.perf_counter() - start) * 1000)
+        tokens.append(sum(count_tokens(doc.page_content) for doc, _ in merge_row_chunks(results)))
+
+        found = [row for row in rows if row in expected]
+        recalls.append(len(set(found)) / min(len(expected), k))
+        hits.append(1.0 if found else 0.0)
+        first = next((rank for rank, row in enumerate(rows, start=1) if row in expected), None)
+        reciprocal_ranks.append(1.0 / first if first else 0.0)
+    return {
+        "recall": float(np.mean(recalls)),
+        "hit": float(np.mean(hits)),
+        "mrr": float(np.mean(reciprocal_ranks)),
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p95_ms": float(np.percentile(latencies, 95)),
+        "tokens": float(np.mean(tokens)),
+    }
+
+
+def print_table(results: list, k: int) -> None:
+    header = (f"{'chunk':>6} {'backend':<8} {'store':<8} {'dtype':<8} {'mode':<7} {'rerank':<13} {'docs':>6} {'embed, s':>9} "
+              f"{'build, s':>9} {'recall@' + str(k):>10} {'hit@' + str(k):>7} {'MRR':>6} {'p50, ms':>8} {'p95, ms':>8} {'tokens':>7}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['chunk_tokens']:>6} {r['backend']:<8} {r['store']:<8} {r['dtype']:<8} {r['mode']:<7} {r['rerank']:<13} {r['docs']:>6} "
+            f"{r['embed_s']:>9.2f} {r['build_s']:>9.2f} {r['recall']:>10.3f} {r['hit']:>7.3f} {r['mrr']:>6.3f} "
+            f"{r['latency_p50_ms']:>8.2f} {r['latency_p95_ms']:>8.2f} {r['tokens']:>7.0f}"
+        )
+
+
+def search(query: str, mode: str, rerank_mode: str, lexical_index: LexicalIndex, store, args) -> list:
+    """Hits of a vector mode, over-fetched and reranked to --rerank-top-n unless rerank_mode is off"""
+    index = lexical_index if mode in ("hybrid", "facet") else None
+    fetch_k = args.k if rerank_mode == "off" else max(args.rerank_candidates, args.rerank_top_n)
+    hits = _retrieve_many(
+        [query], index, lambda: store, k=fetch_k,
+        candidates_k=args.candidates, rrf_k=RAG_RRF_K,
+        facet_routing=mode == "facet", facet_scale=fetch_k / args.k, exact_k=args.k
+    )[query]
+    if rerank_mode == "off":
+        return hits
+    return rerank(query, hits, args.rerank_top_n, rerank_mode, args.rerank_budget_ms, lexical_index)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Качество и скорость поиска по базе знаний")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES, help="JSONL: query, expected (файл:лист:строка)")
+    parser.add_argument("--files", default=os.path.join(BASE_DIR, "files"), help="Папка с xlsx файлами")
+    parser.add_argument("--backends", nargs="+", default=["openai"], help="Бэкенды эмбеддингов: openai, local")
+    parser.add_argument("--stores", nargs="+", default=["numpy"], help="Хранилища: numpy, chroma")
+    parser.add_argument("--dtypes", nargs="+", default=["float32"], help="Типы numpy индекса: float32, float16, int8")
+    parser.add_argument("--modes", nargs="+", default=["dense", "bm25", "hybrid", "facet"], help="Режимы: dense, bm25, hybrid, facet")
+    parser.add_argument("--chunk-sizes", nargs="+", type=int, default=[CHUNK_MAX_TOKENS], help="CHUNK_MAX_TOKENS")
+    parser.add_argument("--overlap", type=int, default=CHUNK_OVERLAP_TOKENS)
+    parser.add_argument("--min-tokens", type=int, default=CHUNK_MIN_TOKENS)
+    parser.add_argument("--k", type=int, default=5, help="Глубина поиска")
+    parser.add_argument("--candidates", type=int, default=RAG_FUSION_CANDIDATES, help="Кандидатов на список в hybrid")
+    parser.add_argument("--rerank", nargs="+", default=["off"], choices=RAG_RERANK_MODES, help="Переранжирование")
+    parser.add_argument("--rerank-candidates", type=int, default=RAG_RERANK_CANDIDATES, help="Кандидатов для переранжирования")
+    parser.add_argument("--rerank-top-n", type=int, default=RAG_RERANK_TOP_N, help="Документов после переранжирования")
+    parser.add_argument("--rerank-budget-ms", type=float, default=RAG_RERANK_BUDGET_MS, help="Бюджет переранжирования, мс")
+    parser.add_argument("--output", help="Сохранить результаты в JSON")
+    args = parser.parse_args()
+    if "cross_encoder" in args.rerank and not get_cross_encoder().load():
+        print("❌ Cross-encoder не загружен, режим cross_encoder пропущен")
+        args.rerank = [rerank_mode for rerank_mode in args.rerank if rerank_mode != "cross_encoder"]
+
+    with open(args.queries, "r", encoding="utf-8") as f:
+        queries = [json.loads(line) for line in f if line.strip()]
+    sheets = read_sheets(args.files)
+    print(f"Запросов: {len(queries)}, таблиц: {len(sheets)}, k={args.k}")
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix="retrieval_eval_")
+    try:
+        for chunk_tokens in args.chunk_sizes:
+            docs = chunk_corpus(sheets, args.files, chunk_tokens, min(args.overlap, chunk_tokens // 2), args.min_tokens)
+            ids = [str(uuid4()) for _ in docs]
+            lexical_index = LexicalIndex()
+            lexical_index.add_documents(docs, ids)
+            base = {"chunk_tokens": chunk_tokens, "docs": len(docs)}
+
+            if "bm25" in args.modes:
+                metrics = evaluate(lambda query: lexical_index.search(query, args.k), queries, args.k)
+                results.append({**base, "backend": "-", "store": "bm25", "dtype": "-", "mode": "bm25", "rerank": "off",
+                                "embed_s": 0.0, "build_s": 0.0, **metrics})
+
+            vector_modes = [mode for mode in args.modes if mode in ("dense", "hybrid", "facet")]
+            if not vector_modes:
+                continue
+            for backend in args.backends:
+                print(f"⏱️ Эмбеддинги {backend}, чанки до {chunk_tokens} токенов: {len(docs)} документов...")
+                model = get_embedding_model(backend)
+                texts = [doc.page_content for doc in docs]
+                start = time.perf_counter()
+                vectors = np.asarray(model.embed_documents(texts), dtype=np.float32)
+                embed_s = time.perf_counter() - start
+                precomputed = PrecomputedEmbeddings(model, texts, vectors)
+
+                for store_name in args.stores:
+                    for dtype in (args.dtypes if store_name == "numpy" else ["-"]):
+                        start = time.perf_counter()
+                        store = build_store(store_name, dtype, model, precomputed, docs, ids, workdir)
+                        build_s = time.perf_counter() - start
+                        for mode in vector_modes:
+                            for rerank_mode in args.rerank:
+                                metrics = evaluate(
+                                    lambda query: search(query, mode, rerank_mode, lexical_index, store, args),
+                                    queries, args.k
+                                )
+                                label = rerank_mode if rerank_mode == "off" else f"{rerank_mode}:{args.rerank_top_n}"
+                                results.append({**base, "backend": backend, "store": store_name, "dtype": dtype,
+                                                "mode": mode, "rerank": label, "embed_s": embed_s, "build_s": build_s, **metrics})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print_table(results, args.k)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
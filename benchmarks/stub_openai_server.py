@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка OpenAI API для нагрузочного тестирования без сети
+
+Отвечает детерминированно, задержка и ошибки задаются параметрами:
+  POST /v1/chat/completions - вызов rag_search при принудительном tool_choice (user_query - последний
+                              запрос клиента), "YES"/"NO" для NEEDS_RAG_PROMPT, JSON для
+                              IDENTIFICATION_PROMPT, резюме для суммаризации, иначе ответ консультанта
+  POST /v1/embeddings       - хэшированный мешок слов (токенов): одинаковый текст дает одинаковый вектор,
+                              тексты с общими словами близки
+  POST /v1/audio/transcriptions - фиксированная расшифровка для Whisper
+
+Задержка: распределение (fixed, uniform, normal, lognormal) вокруг --latency-ms для чата,
+--embedding-latency-ms и --whisper-latency-ms для остальных эндпоинтов, плюс время генерации
+ответа при --tokens-per-second. --rate-limit задает долю ответов 429 с заголовком Retry-After
+(клиенты OpenAI повторяют такие запросы сами). --seed делает последовательность задержек
+и ошибок воспроизводимой.
+
+Пример:
+  python benchmarks/stub_openai_server.py --port 8100 --latency-ms 300 --jitter-ms 100
+  python benchmarks/stub_openai_server.py --latency lognormal --latency-ms 800 --tokens-per-second 60 --rate-limit 0.05
+  OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=stub python run_api.py
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, File, Form, Request, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+EMBEDDING_DIMENSIONS = 1536
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "normal", "lognormal")
+DEFAULT_TRANSCRIPT = "Здравствуйте, сколько стоит маникюр с покрытием?"
+_WORD_RE = re.compile(r"\w+")
+
+app = FastAPI(title="OpenAI stub")
+app.state.latency = "uniform"
+app.state.latency_ms = {"chat": 0.0, "embeddings": 0.0, "transcriptions": 0.0}
+app.state.jitter_ms = 0.0
+app.state.tokens_per_second = 0.0
+app.state.rate_limit = 0.0
+app.state.retry_after_s = 1.0
+app.state.rng = random.Random()
+app.state.dimensions = EMBEDDING_DIMENSIONS
+app.state.answer_words = 60
+app.state.transcript = DEFAULT_TRANSCRIPT
+app.state.requests = {"chat": 0, "embeddings": 0, "transcriptions": 0, "rate_limited": 0}
+
+
+# ---------- HELPERS ---------- #
+def sample_latency_ms(endpoint: str) -> float:
+    """
+    Latency of one response: fixed - the base value, uniform - base +- jitter,
+    normal - jitter as the standard deviation, lognormal - base as the median and
+    jitter / base as sigma (a long right tail, like real LLM latencies).
+    """
+    base = app.state.latency_ms[endpoint]
+    jitter = app.state.jitter_ms
+    rng = app.state.rng
+    if app.state.latency == "fixed" or base <= 0:
+        delay = base
+    elif app.state.latency == "uniform":
+        delay = base + rng.uniform(-jitter, jitter)
+    elif app.state.latency == "normal":
+        delay = rng.gauss(base, jitter)
+    else:
+        delay = base * rng.lognormvariate(0.0, jitter / base if jitter else 0.5)
+    return max(delay, 0.0)
+
+
+async def _delay(endpoint: str, completion_tokens: int = 0) -> None:
+    """Injected latency plus the generation time of completion_tokens at tokens_per_second"""
+    delay = sample_latency_ms(endpoint) / 1000
+    if app.state.tokens_per_second > 0:
+        delay += completion_tokens / app.state.tokens_per_second
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+def _rate_limited():
+    """429 with Retry-After for the configured share of requests, None otherwise"""
+    if app.state.rate_limit <= 0 or app.state.rng.random() >= app.state.rate_limit:
+        return None
+    app.state.requests["rate_limited"] += 1
+    return JSONResponse(
+        status_code=429,
+        headers={"retry-after": str(app.state.retry_after_s)},
+        content={"error": {
+            "message": "Rate limit reached (stub)", "type": "requests", "param": None, "code": "rate_limit_exceeded"
+        }}
+    )
+
+
+def _count_tokens(text: str) -> int:
+    # Rough estimate for the usage block, the agent only logs and counts it
+    return max(1, len(text) // 4)
+
+
+def _content(message: dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def embed(item) -> list:
+    """Deterministic unit vector: hashed bag of words, or of token ids when the client sends tiktoken ids"""
+    features = [str(token) for token in item] if isinstance(item, list) else _WORD_RE.findall(str(item).lower())
+    vector = np.zeros(app.state.dimensions, dtype=np.float32)
+    for feature in features or [""]:
+        digest = hashlib.md5(feature.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % app.state.dimensions
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = float(np.linalg.norm(vector))
+    return (vector / norm if norm else vector).tolist()
+
+
+def _completion_text(messages: list) -> str:
+    """Deterministic answer for the prompt the agent sent"""
+    system = " ".join(_content(m) for m in messages if m.get("role") == "system")
+    user_messages = [_content(m) for m in messages if m.get("role") == "user"]
+    last_user = user_messages[-1] if user_messages else ""
+
+    if 'ответь "NO"' in system:
+        # NEEDS_RAG_PROMPT: short acknowledgements do not need the knowledge base
+        return "NO" if len(last_user.split()) <= 2 else "YES"
+    if "client_name" in system:
+        return json.dumps({
+            "response": "Расскажите, какая процедура Вас интересует?",
+            "client_name": "клиент",
+            "gender": "неизвестен"
+        }, ensure_ascii=False)
+    if "обобщать диалоги" in system:
+        return "Предыдущий диалог: " + " ".join(" ".join(user_messages).split()[:80])
+    words = ("Спасибо за вопрос. По вашему запросу в салонах Итейра доступны подходящие процедуры, "
+             "специалист подберет программу на консультации.").split()
+    return " ".join(words[i % len(words)] for i in range(app.state.answer_words))
+
+
+def _forced_tool(body: dict):
+    choice = body.get("tool_choice")
+    if isinstance(choice, dict):
+        return (choice.get("function") or {}).get("name")
+    if choice == "required" and body.get("tools"):
+        return body["tools"][0]["function"]["name"]
+    return None
+
+
+# ---------- ENDPOINTS ---------- #
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    app.state.requests["chat"] += 1
+    limited = _rate_limited()
+    if limited:
+        return limited
+
+    messages = body.get("messages", [])
+    prompt_tokens = sum(_count_tokens(_content(m)) for m in messages)
+    message = {"role": "assistant", "content": None}
+    finish_reason = "stop"
+
+    tool_name = _forced_tool(body)
+    if tool_name:
+        # RAG_PROMPT ends with a fixed instruction, the client's query is the user message before it
+        user_messages = [_content(m) for m in messages if m.get("role") == "user"]
+        query = user_messages[-2] if len(user_messages) > 1 else (user_messages[-1] if user_messages else "")
+        message["tool_calls"] = [{
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": tool_name, "arguments": json.dumps({"user_query": query}, ensure_ascii=False)}
+        }]
+        finish_reason = "tool_calls"
+        completion_tokens = _count_tokens(query)
+    else:
+        message["content"] = _completion_text(messages)
+        completion_tokens = _count_tokens(message["content"])
+    await _delay("chat", completion_tokens)
+
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0}
+        }
+    }
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    app.state.requests["embeddings"] += 1
+    limited = _rate_limited()
+    if limited:
+        return limited
+    await _delay("embeddings")
+
+    inputs = body.get("input", [])
+    # A single string or a single list of token ids is one input
+    if isinstance(inputs, str) or (isinstance(inputs, list) and inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+    data = [{"object": "embedding", "index": i, "embedding": embed(item)} for i, item in enumerate(inputs)]
+    tokens = sum(len(item) if isinstance(item, list) else _count_tokens(item) for item in inputs)
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "stub"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+    }
+
+
+@app.post("/v1/audio/transcriptions")
+async def transcriptions(
+    file: UploadFile = File(...),
+    model: str = Form("whisper-1"),
+    language: str = Form(None),
+    response_format: str = Form("json")
+):
+    await file.read()
+    app.state.requests["transcriptions"] += 1
+    limited = _rate_limited()
+    if limited:
+        return limited
+    await _delay("transcriptions")
+    if response_format == "text":
+        return PlainTextResponse(app.state.transcript)
+    return {"text": app.state.transcript}
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "requests": app.state.requests}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка OpenAI API для бенчмарков")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", choices=LATENCY_DISTRIBUTIONS, default="uniform", help="Распределение задержки")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Базовая задержка чата (медиана для lognormal)")
+    parser.add_argument("--embedding-latency-ms", type=float, help="Базовая задержка эмбеддингов, по умолчанию как у чата")
+    parser.add_argument("--whisper-latency-ms", type=float, help="Базовая задержка Whisper, по умолчанию как у чата")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Разброс задержки")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Скорость генерации ответа, 0 - мгновенно")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Доля ответов 429 (0..1)")
+    parser.add_argument("--retry-after-s", type=float, default=1.0, help="Заголовок Retry-After ответов 429")
+    parser.add_argument("--seed", type=int, help="Seed для воспроизводимых задержек и ошибок")
+    parser.add_argument("--dimensions", type=int, default=EMBEDDING_DIMENSIONS, help="Размерность эмбеддингов")
+    parser.add_argument("--answer-words", type=int, default=60, help="Длина ответа консультанта в словах")
+    parser.add_argument("--transcript", default=DEFAULT_TRANSCRIPT, help="Текст расшифровки Whisper")
+    args = parser.parse_args()
+
+    app.state.latency = args.latency
+    app.state.latency_ms = {
+        "chat": args.latency_ms,
+        "embeddings": args.latency_ms if args.embedding_latency_ms is None else args.embedding_latency_ms,
+        "transcriptions": args.latency_ms if args.whisper_latency_ms is None else args.whisper_latency_ms,
+    }
+    app.state.jitter_ms = args.jitter_ms
+    app.state.tokens_per_second = args.tokens_per_second
+    app.state.rate_limit = args.rate_limit
+    app.state.retry_after_s = args.retry_after_s
+    app.state.rng = random.Random(args.seed)
+    app.state.dimensions = args.dimensions
+    app.state.answer_words = args.answer_words
+    app.state.transcript = args.transcript
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,28 +14,26 @@ def check_vector_db():
         vector_db = VectorDB()
         vector_db.get_or_create_vector_store()
         
-        # Получаем все документы
-        results = vector_db.vector_store.get()
+        # Число документов и разбивка по файлам - из каталога, без загрузки всей коллекции
+        total = len(vector_db.get_ids())
+        catalog = vector_db.get_catalog()
         
-        print(f"Всего документов в базе: {len(results['ids']) if results['ids'] else 0}")
+        print(f"Всего документов в базе: {total}")
         
-        if results['metadatas']:
-            # Группируем по файлам
-            files = {}
-            for metadata in results['metadatas']:
-                if metadata and 'filename' in metadata:
-                    filename = metadata['filename']
-                    files[filename] = files.get(filename, 0) + 1
-            
+        if catalog:
             print("\nДокументы по файлам:")
-            for filename, count in files.items():
-                print(f"  - {filename}: {count} документов")
+            for filename, doc_ids in sorted(catalog.items()):
+                print(f"  - {filename}: {len(doc_ids)} документов")
+            cataloged = sum(len(doc_ids) for doc_ids in catalog.values())
+            if cataloged != total:
+                print(f"⚠️ В каталоге {cataloged} документов, в коллекции {total}: перегенерируйте базу знаний")
         
         # Показываем первые несколько документов
-        if results['documents'] and len(results['documents']) > 0:
+        sample = vector_db.vector_store.get(limit=3, include=["documents", "metadatas"])
+        if sample['documents']:
             print(f"\nПример документов:")
-            for i, doc in enumerate(results['documents'][:3]):
-                metadata = results['metadatas'][i] if results['metadatas'] else {}
+            for i, doc in enumerate(sample['documents']):
+                metadata = sample['metadatas'][i] if sample['metadatas'] else {}
                 print(f"  {i+1}. Файл: {metadata.get('filename', 'неизвестно')}")
                 print(f"     Содержимое: {doc[:100]}...")
                 
@@ -7,6 +7,9 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
 # OpenAI API
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# OpenAI-compatible endpoint for the chat, embedding and Whisper clients, None - api.openai.com.
+# Point it at benchmarks/stub_openai_server.py (http://127.0.0.1:8100/v1) for offline benchmarks
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
 
 # Maximum number of messages in the history
 MAX_HISTORY_LENGTH = 10
@@ -17,4 +20,135 @@ BASE_URL_TALKME = os.getenv("BASE_URL_TALKME", "https://api.talkme.ru/")
 # Paths to the data and the chroma_db
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_PATH = os.path.join(BASE_DIR, "data", "knowledge_base")
-CHROMA_PATH = os.path.join(BASE_DIR, "data", "chroma_db")
\ No newline at end of file
+CHROMA_PATH = os.path.join(BASE_DIR, "data", "chroma_db")
+
+# Retrieval settings
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+
+# In-memory LRU cache of top-k documents per rag_search subquery
+RAG_CACHE_SIZE = int(os.getenv("RAG_CACHE_SIZE", "512"))
+
+# Marker file with the current index generation, rewritten on every index change
+INDEX_GENERATION_PATH = os.path.join(BASE_DIR, "data", "index_generation")
+
+# Hybrid retrieval: BM25 lexical index fused with the vector search (reciprocal rank fusion)
+RAG_HYBRID_SEARCH = os.getenv("RAG_HYBRID_SEARCH", "true").lower() == "true"
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+RAG_FUSION_CANDIDATES = int(os.getenv("RAG_FUSION_CANDIDATES", "10"))
+LEXICAL_INDEX_PATH = os.path.join(BASE_DIR, "data", "lexical_index.json")
+# Per-file record of the indexed workbook versions and their document ids (agent/ingest_manifest.py)
+INGEST_MANIFEST_PATH = os.path.join(BASE_DIR, "data", "ingest_manifest.json")
+# Parsed sheets cached as Arrow IPC files keyed by the workbook sha256 (agent/workbook_cache.py)
+WORKBOOK_CACHE_PATH = os.path.join(BASE_DIR, "data", "workbook_cache")
+WORKBOOK_CACHE_ENABLED = os.getenv("WORKBOOK_CACHE_ENABLED", "true").lower() == "true"
+# JSON file with the per-workbook ingestion schema (sheets, content / metadata / filter columns, types),
+# agent/ingest_schema.py DEFAULT_SCHEMA when empty
+INGEST_SCHEMA_PATH = os.getenv("INGEST_SCHEMA_PATH", "")
+
+# Embedding backend: "openai" (OpenAIEmbeddings) or "local" (quantized ONNX model on CPU).
+# Backends produce vectors of different dimensions, rebuild the knowledge base after switching.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+# Hugging Face repo id or a local directory with tokenizer.json and the ONNX file
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+LOCAL_EMBEDDING_ONNX_FILE = os.getenv("LOCAL_EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32"))
+LOCAL_EMBEDDING_MAX_LENGTH = int(os.getenv("LOCAL_EMBEDDING_MAX_LENGTH", "256"))
+# 0 - use all CPU cores
+LOCAL_EMBEDDING_THREADS = int(os.getenv("LOCAL_EMBEDDING_THREADS", "0"))
+# Instruction prefixes for e5-like models ("query: " / "passage: ")
+LOCAL_EMBEDDING_QUERY_PREFIX = os.getenv("LOCAL_EMBEDDING_QUERY_PREFIX", "")
+LOCAL_EMBEDDING_DOCUMENT_PREFIX = os.getenv("LOCAL_EMBEDDING_DOCUMENT_PREFIX", "")
+
+# Vector store backend: "chroma" (ChromaDB) or "numpy" (in-memory matrix, agent/numpy_index.py)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+NUMPY_INDEX_PATH = os.path.join(BASE_DIR, "data", "numpy_index")
+# Storage type of the numpy index matrix: float32 (mmap), float16 or int8
+NUMPY_INDEX_DTYPE = os.getenv("NUMPY_INDEX_DTYPE", "float32")
+
+# Chunking of spreadsheet rows before embedding, sizes in tiktoken tokens (agent/chunking.py)
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "400"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "60"))
+# Consecutive rows of a sheet shorter than this are merged into one document
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", "32"))
+# Columns repeated as a header on every chunk of a split row
+CHUNK_TITLE_COLUMNS = [
+    column.strip()
+    for column in os.getenv(
+        "CHUNK_TITLE_COLUMNS",
+        "Название услуги,Услуга/Препарат,Название оборудования,Направление,Категория услуги,Вопрос"
+    ).split(",")
+    if column.strip()
+]
+
+# Facet-routed retrieval (agent/facet_router.py): every subquery is searched separately in the
+# facets of the knowledge base (metadata "facet" set by the ingestion schema), each with its own k,
+# the merged facet results are cut to RAG_TOP_K.
+# RAG_DEFAULT_FACETS are always searched, the other facets when the query asks about them.
+RAG_FACET_ROUTING = os.getenv("RAG_FACET_ROUTING", "true").lower() == "true"
+RAG_FACET_K = {
+    facet.strip(): int(k)
+    for facet, k in (
+        item.split(":") for item in os.getenv(
+            "RAG_FACET_K", "services:3,faq:1,groups:2,directions:1,equipment:1,general:2"
+        ).split(",") if ":" in item
+    )
+}
+RAG_DEFAULT_FACETS = [
+    facet.strip() for facet in os.getenv("RAG_DEFAULT_FACETS", "services,faq,general").split(",") if facet.strip()
+]
+# Facets of the best BM25 hits of the query are searched too
+RAG_FACET_ROUTE_CANDIDATES = int(os.getenv("RAG_FACET_ROUTE_CANDIDATES", "5"))
+# Metadata fields whose values named in the query narrow the facet search (e.g. a service direction)
+RAG_FACET_FILTER_KEYS = [
+    key.strip() for key in os.getenv("RAG_FACET_FILTER_KEYS", "direction").split(",") if key.strip()
+]
+
+# Reranking of the retrieved documents (agent/reranker.py): "off", "lexical" (query term overlap
+# weighted by idf) or "cross_encoder" (local ONNX cross-encoder on CPU). RAG_RERANK_CANDIDATES
+# documents are retrieved per subquery, rescored and the best RAG_RERANK_TOP_N are kept. Scoring
+# stops at RAG_RERANK_BUDGET_MS, the documents not scored by then keep their retrieval order.
+RAG_RERANK_MODES = ("off", "lexical", "cross_encoder")
+RAG_RERANK = os.getenv("RAG_RERANK", "off").lower()
+if RAG_RERANK not in RAG_RERANK_MODES:
+    # Fail at startup rather than on every rag_search call
+    raise ValueError(f"RAG_RERANK must be one of {', '.join(RAG_RERANK_MODES)}, got {RAG_RERANK!r}")
+RAG_RERANK_CANDIDATES = int(os.getenv("RAG_RERANK_CANDIDATES", "12"))
+RAG_RERANK_TOP_N = int(os.getenv("RAG_RERANK_TOP_N", "3"))
+RAG_RERANK_BUDGET_MS = float(os.getenv("RAG_RERANK_BUDGET_MS", "60"))
+# Hugging Face repository or local directory with tokenizer.json and the ONNX cross-encoder
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+RERANK_ONNX_FILE = os.getenv("RERANK_ONNX_FILE", "onnx/model.onnx")
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "256"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "4"))
+# onnxruntime intra-op threads of the cross-encoder, 0 = all cores
+RERANK_THREADS = int(os.getenv("RERANK_THREADS", "0"))
+
+# Token budget of the retrieved context passed to CONSULTATION_PROMPT
+RAG_CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "3000"))
+
+# Rolling conversation summary: once the dialog exceeds SUMMARY_TRIGGER_TOKENS, the oldest turns
+# are folded into a running summary in the background, the last SUMMARY_KEEP_MESSAGES stay verbatim
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "2500"))
+SUMMARY_KEEP_MESSAGES = int(os.getenv("SUMMARY_KEEP_MESSAGES", "6"))
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "2"))
+# Seconds a finished summary waits for the next message of its session before it is dropped
+# (the session is summarized again if it comes back)
+SUMMARY_PENDING_TTL = int(os.getenv("SUMMARY_PENDING_TTL", "3600"))
+
+# Chat history passed to the prompts: at most MAX_HISTORY_LENGTH messages and HISTORY_TOKEN_BUDGET tokens
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+
+# Knowledge-base uploads: chunk size of the streamed copy to disk, documents embedded per
+# add_documents call while indexing a file (progress of the background job is reported per batch)
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+# Page size of id / metadata-only reads of the vector store (no full-collection get())
+STORE_PAGE_SIZE = int(os.getenv("STORE_PAGE_SIZE", "1000"))
+# Claim files of the files/ entries an API job is uploading or deleting (file_claims.py);
+# the file watcher process leaves claimed files to the job
+FILE_CLAIMS_PATH = os.path.join(BASE_DIR, "data", "file_claims")
+
+# Startup warm-up (agent/warmup.py): tokenizer, embedding model, indexes and the compiled graph are
+# loaded before the first request and WARMUP_QUERY is retrieved once; GET /health reports readiness
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true"
+WARMUP_QUERY = os.getenv("WARMUP_QUERY", "сколько стоит чистка лица")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Захват файлов папки files/ фоновыми задачами API
+
+Пока задача загрузки или удаления работает с файлом (в том числе пока ждет
+в очереди), по нему лежит файл захвата в data/file_claims. Файловый watcher -
+отдельный процесс - не индексирует захваченные файлы, а откладывает их
+до освобождения, чтобы один и тот же файл не индексировался дважды.
+"""
+import os
+import json
+import time
+import hashlib
+import unicodedata
+from uuid import uuid4
+from config import FILE_CLAIMS_PATH
+
+CLAIM_SUFFIX = ".claim"
+
+
+def _file_key(filename):
+    """Ключ файла захвата: имя файла без пути, в NFC (macOS присылает имена в NFD)"""
+    name = unicodedata.normalize("NFC", os.path.basename(filename))
+    return hashlib.md5(name.encode("utf-8")).hexdigest()
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def claim_files(filenames, owner=""):
+    """
+    Захватить файлы до завершения задачи
+
+    Args:
+        filenames: Имена (или пути) файлов
+        owner: Описание владельца для логов
+
+    Returns:
+        str: Токен захвата для release_claim
+    """
+    os.makedirs(FILE_CLAIMS_PATH, exist_ok=True)
+    token = uuid4().hex
+    payload = json.dumps({"pid": os.getpid(), "owner": owner, "created": time.time()})
+    for filename in filenames:
+        path = os.path.join(FILE_CLAIMS_PATH, f"{_file_key(filename)}.{token}{CLAIM_SUFFIX}")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    return token
+
+
+def release_claim(token):
+    """Освободить все файлы, захваченные с этим токеном"""
+    if not token or not os.path.isdir(FILE_CLAIMS_PATH):
+        return
+    suffix = f".{token}{CLAIM_SUFFIX}"
+    for name in os.listdir(FILE_CLAIMS_PATH):
+        if name.endswith(suffix):
+            try:
+                os.remove(os.path.join(FILE_CLAIMS_PATH, name))
+            except FileNotFoundError:
+                pass
+
+
+def is_claimed(filename):
+    """Захвачен ли файл живым процессом (захваты завершившихся процессов удаляются)"""
+    if not os.path.isdir(FILE_CLAIMS_PATH):
+        return False
+    prefix = f"{_file_key(filename)}."
+    for name in os.listdir(FILE_CLAIMS_PATH):
+        if not (name.startswith(prefix) and name.endswith(CLAIM_SUFFIX)):
+            continue
+        path = os.path.join(FILE_CLAIMS_PATH, name)
+        try:
+            with open(path, encoding="utf-8") as f:
+                pid = json.load(f).get("pid")
+        except (OSError, ValueError):
+            # Удален между listdir и open или поврежден
+            continue
+        if pid and _process_alive(pid):
+            return True
+        print(f"🧹 Удален захват файла {os.path.basename(filename)} завершившегося процесса {pid}")
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return False
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 """
-Файловый watcher для автоматической перегенерации базы знаний
-при изменении файлов в папке files/
+Файловый watcher для автоматического обновления базы знаний
+при изменении файлов в папке files/: изменения копятся, после завершения
+записи файлов применяется одно инкрементальное обновление по этим файлам
 """
 import os
 import time
@@ -9,41 +10,108 @@ import threading
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from sync_manager import regen_manager
+from file_claims import is_claimed
 
 class KnowledgeBaseHandler(FileSystemEventHandler):
     """Обработчик событий файловой системы"""
     
     def __init__(self, files_path):
         self.files_path = files_path
-        self.regeneration_delay = 2  # Задержка в секундах перед перегенерацией
-        self.regeneration_timer = None
+        self.update_delay = 2  # Задержка в секундах после последнего события
+        self.stability_interval = 1  # Интервал проверки, что запись файла завершена
+        self.update_timer = None
+        # Накопленные изменения: путь -> "changed" | "removed"
+        self.pending = {}
+        self.pending_lock = threading.Lock()
         
     def should_process_file(self, file_path):
         """Проверяет, нужно ли обрабатывать файл"""
         if not file_path:
             return False
+        
+        # Временные файлы блокировки Excel (~$file.xlsx) не являются данными
+        if os.path.basename(file_path).startswith("~$"):
+            return False
             
         # Обрабатываем только .xlsx и .xls файлы
         return file_path.lower().endswith(('.xlsx', '.xls'))
     
-    def schedule_regeneration(self):
-        """Планирует перегенерацию с задержкой"""
+    def mark_changed(self, file_path, change):
+        """Запоминает изменение файла и откладывает обновление"""
+        with self.pending_lock:
+            self.pending[file_path] = change
+            self.schedule_update()
+    
+    def schedule_update(self):
+        """Планирует обновление с задержкой (вызывается под pending_lock)"""
         # Отменяем предыдущий таймер если он есть
-        if self.regeneration_timer:
-            self.regeneration_timer.cancel()
+        if self.update_timer:
+            self.update_timer.cancel()
         
         # Создаем новый таймер
-        self.regeneration_timer = threading.Timer(
-            self.regeneration_delay, 
-            self.regenerate_knowledge_base
+        self.update_timer = threading.Timer(
+            self.update_delay, 
+            self.process_pending
         )
-        self.regeneration_timer.start()
+        self.update_timer.start()
+    
+    def _file_state(self, file_path):
+        try:
+            stat_result = os.stat(file_path)
+            return stat_result.st_size, stat_result.st_mtime_ns
+        except OSError:
+            return None
+    
+    def _unstable_files(self, file_paths):
+        """Файлы, которые еще записываются (размер или время изменения не устоялись)"""
+        if not file_paths:
+            return []
+        before = {path: self._file_state(path) for path in file_paths}
+        time.sleep(self.stability_interval)
+        return [path for path in file_paths if self._file_state(path) != before[path]]
     
-    def regenerate_knowledge_base(self):
-        """Перегенерирует базу знаний"""
-        result = regen_manager.regenerate(self.files_path, "FileWatcher")
+    def process_pending(self):
+        """Применяет накопленные изменения одним инкрементальным обновлением"""
+        with self.pending_lock:
+            batch = dict(self.pending)
+            self.pending.clear()
+        if not batch:
+            return
+        
+        # Файлы, которые загружает или удаляет задача API, обработает она сама.
+        # Откладываем их до освобождения: после задачи обновление по ним ничего не меняет
+        claimed = [path for path in batch if is_claimed(path)]
+        if claimed:
+            print(f"🔒 Файлы обрабатываются задачей API: {', '.join(os.path.basename(path) for path in claimed)}")
+            with self.pending_lock:
+                for path in claimed:
+                    self.pending.setdefault(path, batch.pop(path))
+                self.schedule_update()
+        
+        changed = [path for path, change in batch.items() if change == "changed" and os.path.exists(path)]
+        removed = [path for path in batch if path not in changed]
+        
+        # Файлы, запись которых еще идет, откладываем до следующей проверки
+        unstable = self._unstable_files(changed)
+        if unstable:
+            print(f"⏳ Файлы еще записываются: {', '.join(os.path.basename(path) for path in unstable)}")
+            with self.pending_lock:
+                for path in unstable:
+                    self.pending.setdefault(path, "changed")
+                self.schedule_update()
+            changed = [path for path in changed if path not in unstable]
+        
+        if not changed and not removed:
+            return
+        
+        result = regen_manager.update_files(
+            self.files_path,
+            changed=[os.path.basename(path) for path in changed],
+            removed=[os.path.basename(path) for path in removed],
+            source="FileWatcher"
+        )
         
-        if result["status"] in ["skipped", "in_progress"]:
+        if result["status"] == "queued":
             print(f"ℹ️ {result['message']}")
         elif result["status"] == "error":
             print(f"❌ {result['message']}")
@@ -53,26 +121,29 @@ class KnowledgeBaseHandler(FileSystemEventHandler):
         """Вызывается при создании файла"""
         if not event.is_directory and self.should_process_file(event.src_path):
             print(f"📁 Добавлен файл: {os.path.basename(event.src_path)}")
-            self.schedule_regeneration()
+            self.mark_changed(event.src_path, "changed")
     
     def on_deleted(self, event):
         """Вызывается при удалении файла"""
         if not event.is_directory and self.should_process_file(event.src_path):
             print(f"🗑️ Удален файл: {os.path.basename(event.src_path)}")
-            self.schedule_regeneration()
+            self.mark_changed(event.src_path, "removed")
     
     def on_modified(self, event):
         """Вызывается при изменении файла"""
         if not event.is_directory and self.should_process_file(event.src_path):
             print(f"✏️ Изменен файл: {os.path.basename(event.src_path)}")
-            self.schedule_regeneration()
+            self.mark_changed(event.src_path, "changed")
     
     def on_moved(self, event):
         """Вызывается при перемещении файла"""
         if not event.is_directory:
             if self.should_process_file(event.src_path) or self.should_process_file(event.dest_path):
                 print(f"📦 Перемещен файл: {os.path.basename(event.src_path)} -> {os.path.basename(event.dest_path)}")
-                self.schedule_regeneration()
+                if self.should_process_file(event.src_path):
+                    self.mark_changed(event.src_path, "removed")
+                if self.should_process_file(event.dest_path):
+                    self.mark_changed(event.dest_path, "changed")
 
 class FileWatcher:
     """Класс для отслеживания изменений в папке files"""
@@ -111,8 +182,8 @@ class FileWatcher:
         self.observer.join()
         
         # Отменяем активный таймер если есть
-        if self.handler.regeneration_timer:
-            self.handler.regeneration_timer.cancel()
+        if self.handler.update_timer:
+            self.handler.update_timer.cancel()
         
         print("✅ Файловый watcher остановлен")
 
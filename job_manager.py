@@ -0,0 +1,210 @@
+import threading
+import time
+import queue
+from collections import OrderedDict
+from uuid import uuid4
+
+
+class JobCancelled(BaseException):
+    """
+    Задача отменена пользователем
+
+    Наследуется от BaseException (как asyncio.CancelledError), чтобы широкие
+    except Exception в VectorDB не превращали отмену в обычную ошибку.
+    """
+
+
+class Job:
+    """Фоновая задача над базой знаний"""
+
+    FINISHED = ("success", "error", "cancelled")
+
+    def __init__(self, kind, func, description="", coalesce_key=None, on_finish=None):
+        self.id = uuid4().hex
+        self.kind = kind
+        self.description = description
+        self.func = func
+        self.coalesce_key = coalesce_key
+        self.on_finish = on_finish
+        self.coalesced = 0
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.processed = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def is_finished(self):
+        return self.status in self.FINISHED
+
+    def update_progress(self, processed, total=None):
+        """
+        Обновить прогресс задачи (вызывается из функции задачи)
+
+        Заодно является точкой отмены: если задачу отменили, бросает JobCancelled.
+        """
+        self.processed = processed
+        if total is not None:
+            self.total = total
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled(f"Задача {self.id} отменена")
+
+    def finish(self):
+        """Вызвать on_finish задачи (один раз, после успеха, ошибки или отмены)"""
+        on_finish, self.on_finish = self.on_finish, None
+        if on_finish is not None:
+            try:
+                on_finish(self)
+            except Exception as e:
+                print(f"⚠️ Ошибка on_finish задачи {self.id} ({self.kind}): {e}")
+
+    def eta_seconds(self):
+        """Оценка оставшегося времени по средней скорости с начала выполнения"""
+        if self.status != "running" or not self.processed or not self.total or self.processed >= self.total:
+            return None
+        elapsed = time.time() - self.started_at
+        return round(elapsed * (self.total - self.processed) / self.processed, 1)
+
+    def to_dict(self):
+        progress = self.processed / self.total if self.total else (1.0 if self.status == "success" else 0.0)
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "description": self.description,
+            "status": self.status,
+            "processed": self.processed,
+            "total": self.total,
+            "progress": round(progress, 4),
+            "eta_seconds": self.eta_seconds(),
+            "coalesced": self.coalesced,
+            "cancel_requested": self.cancel_event.is_set(),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error
+        }
+
+
+class JobManager:
+    """Очередь фоновых задач: один рабочий поток выполняет задачи по порядку"""
+
+    def __init__(self, history_size=100):
+        self.queue = queue.Queue()
+        self.jobs = OrderedDict()
+        self.history_size = history_size
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def _ensure_worker(self):
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self._run, name="kb-jobs", daemon=True)
+            self.worker.start()
+
+    def submit(self, kind, func, description="", coalesce_key=None, on_finish=None):
+        """
+        Поставить задачу в очередь
+
+        Args:
+            kind: Тип задачи (upload, regenerate, ...)
+            func: Функция func(job) -> dict, прогресс сообщает через job.update_progress
+            description: Описание для логов и интерфейса
+            coalesce_key: Ключ объединения: если в очереди уже ждет задача с тем же ключом,
+                новая не создается, возвращается ожидающая
+            on_finish: Функция on_finish(job), вызывается по завершении задачи, в том числе
+                при отмене в очереди (освобождение ресурсов, захваченных при постановке)
+
+        Returns:
+            Job: Поставленная (или уже ожидающая) задача
+        """
+        with self.lock:
+            if coalesce_key is not None:
+                for queued in self.jobs.values():
+                    if queued.status == "queued" and queued.coalesce_key == coalesce_key:
+                        queued.coalesced += 1
+                        print(f"🔗 Задача {kind} объединена с ожидающей задачей {queued.id}")
+                        return queued
+            job = Job(kind, func, description, coalesce_key, on_finish)
+            self.jobs[job.id] = job
+            self._trim_history()
+            self._ensure_worker()
+        self.queue.put(job)
+        print(f"📥 Задача {job.id} ({kind}) поставлена в очередь: {description}")
+        return job
+
+    def cancel(self, job_id):
+        """
+        Отменить задачу: ожидающая снимается сразу, выполняющаяся останавливается
+        в ближайшей точке отмены (между батчами или файлами)
+
+        Returns:
+            Job или None, если задача не найдена
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.is_finished:
+                return job
+            job.cancel_event.set()
+            cancelled_in_queue = job.status == "queued"
+            if cancelled_in_queue:
+                job.status = "cancelled"
+                job.finished_at = time.time()
+        print(f"⛔ Запрошена отмена задачи {job.id} ({job.kind})")
+        if cancelled_in_queue:
+            job.finish()
+        return job
+
+    def get(self, job_id):
+        """Задача по id или None"""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self, active_only=False):
+        """Задачи от новых к старым, active_only - только ожидающие и выполняющиеся"""
+        with self.lock:
+            jobs = list(reversed(self.jobs.values()))
+        return [job.to_dict() for job in jobs if not (active_only and job.is_finished)]
+
+    def _trim_history(self):
+        # Удаляем самые старые завершенные задачи сверх лимита истории
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished]
+        for job_id in finished[:max(0, len(self.jobs) - self.history_size)]:
+            del self.jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                if job.status != "queued":
+                    # Отменена, пока ждала в очереди
+                    self.queue.task_done()
+                    continue
+                job.status = "running"
+                job.started_at = time.time()
+            print(f"▶️ Задача {job.id} ({job.kind}) запущена")
+            try:
+                job.result = job.func(job)
+                job.status = "success"
+                print(f"✅ Задача {job.id} ({job.kind}) выполнена за {time.time() - job.started_at:.1f} с")
+            except JobCancelled:
+                job.status = "cancelled"
+                print(f"⛔ Задача {job.id} ({job.kind}) отменена после {job.processed}/{job.total}")
+            except Exception as e:
+                job.error = str(e)
+                job.status = "error"
+                print(f"❌ Задача {job.id} ({job.kind}) завершилась ошибкой: {e}")
+            finally:
+                job.finished_at = time.time()
+                job.finish()
+                self.queue.task_done()
+
+
+# Глобальный экземпляр очереди задач
+job_manager = JobManager()
@@ -1,12 +1,13 @@
 from aiogram import Bot, Dispatcher
 from aiogram.types import Message, BotCommand, BotCommandScopeDefault
-from config import TELEGRAM_BOT_TOKEN
+from config import TELEGRAM_BOT_TOKEN, WARMUP_ON_STARTUP
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import Command
 from agent.consultation_agent import ConsultationAgent
 from agent.state import ConsultationState
+from agent.warmup import warmup_state
 from utils.audio_transcribition import transcribe_with_whisper
 from langchain_core.messages import HumanMessage
 import asyncio
@@ -127,6 +128,10 @@ async def process_user_message(message: Message, state: FSMContext):
 async def main():
     try:
         await set_bot_commands()
+        if WARMUP_ON_STARTUP:
+            # Index, models and the compiled graph are loaded before the first message is polled
+            ready = await asyncio.to_thread(warmup_state.run, consultation_agent)
+            print(f"Warm-up {'finished' if ready else 'failed: ' + str(warmup_state.error)}")
         print("Telegram Bot is running")
         await dp.start_polling(bot)
     except Exception as e:
@@ -6,7 +6,7 @@
 import threading
 import time
 import os
-from agent.vector_db import VectorDB
+from agent.vector_db import get_vector_db
 
 class RegenerationManager:
     """Менеджер для синхронизации перегенерации базы знаний"""
@@ -24,78 +24,189 @@ class RegenerationManager:
     def __init__(self):
         if not hasattr(self, 'initialized'):
             self.regeneration_lock = threading.Lock()
+            # Защищает флаг выполнения и отложенные запросы
+            self.state_lock = threading.Lock()
             self.is_regenerating = False
             self.last_regeneration = 0
-            self.min_interval = 2  # Минимальный интервал между перегенерациями в секундах
-            self.vector_db = VectorDB()
+            # Запросы, пришедшие во время сборки: выполняются следом, а не отбрасываются
+            self.pending_full = False
+            self.pending_files = {}  # имя файла -> "changed" | "removed"
+            self.vector_db = get_vector_db()
             self.initialized = True
     
-    def regenerate(self, files_path, source="Unknown"):
+    def regenerate(self, files_path, source="Unknown", progress_callback=None, wait=False):
         """
         Безопасная перегенерация базы знаний с синхронизацией
         
         Args:
             files_path: Путь к папке с файлами
             source: Источник запроса перегенерации (для логирования)
+            progress_callback: Необязательная функция (processed, total) по добавленным документам
+            wait: Дождаться выполнения, даже если сейчас идет другая сборка
+                (без wait такой запрос ставится в очередь и выполняется следом)
         
         Returns:
             dict: Результат операции
         """
-        current_time = time.time()
+        with self.state_lock:
+            self.pending_full = True
+            # Полная перегенерация покрывает все отложенные изменения файлов
+            self.pending_files.clear()
+            if self.is_regenerating and not wait:
+                return {
+                    "status": "queued", 
+                    "message": f"Перегенерация уже выполняется, запрос от {source} будет выполнен следом"
+                }
+        return self._run_pending(files_path, source, progress_callback)
+    
+    def update_files(self, files_path, changed=(), removed=(), source="Unknown", progress_callback=None, wait=False):
+        """
+        Инкрементальное обновление базы знаний по отдельным файлам
+        
+        Args:
+            files_path: Путь к папке с файлами
+            changed: Имена добавленных или измененных файлов (документы пересоздаются)
+            removed: Имена удаленных файлов
+            source: Источник запроса (для логирования)
+            progress_callback: Необязательная функция (processed, total) по обработанным файлам
+            wait: Дождаться выполнения, даже если сейчас идет другая сборка
         
-        # Проверяем минимальный интервал
-        if current_time - self.last_regeneration < self.min_interval:
+        Returns:
+            dict: Результат операции
+        """
+        with self.state_lock:
+            if not self.pending_full:
+                for filename in removed:
+                    self.pending_files[filename] = "removed"
+                for filename in changed:
+                    self.pending_files[filename] = "changed"
+            if self.is_regenerating and not wait:
+                return {
+                    "status": "queued", 
+                    "message": f"База знаний уже обновляется, изменения от {source} будут применены следом"
+                }
+        return self._run_pending(files_path, source, progress_callback)
+    
+    def _run_pending(self, files_path, source, progress_callback=None):
+        """Выполняет отложенные запросы, пока они есть (в том числе пришедшие во время выполнения)"""
+        with self.regeneration_lock:
+            result = {"status": "success", "message": "Изменения уже применены"}
+            errors = []
+            while True:
+                with self.state_lock:
+                    if not self.pending_full and not self.pending_files:
+                        self.is_regenerating = False
+                        break
+                    full, files = self.pending_full, dict(self.pending_files)
+                    self.pending_full = False
+                    self.pending_files.clear()
+                    self.is_regenerating = True
+                try:
+                    if full:
+                        result = self._regenerate(files_path, source, progress_callback)
+                    else:
+                        result = self._apply_file_changes(files_path, files, source, progress_callback)
+                except BaseException:
+                    # Отмена фоновой задачи: ее изменения отбрасываются, а запросы других
+                    # источников, пришедшие во время выполнения, выполняет новый поток
+                    with self.state_lock:
+                        self.is_regenerating = False
+                        has_pending = self.pending_full or bool(self.pending_files)
+                    if has_pending:
+                        threading.Thread(
+                            target=self._run_pending_in_background, args=(files_path,),
+                            name="kb-pending", daemon=True
+                        ).start()
+                    raise
+                if result["status"] == "error":
+                    errors.append(result["message"])
+                # Прогресс относится к первому запуску, повторные идут без него
+                progress_callback = None
+            if errors:
+                return {"status": "error", "message": "; ".join(errors)}
+            return result
+    
+    def _run_pending_in_background(self, files_path):
+        """Выполняет запросы, оставшиеся после отмены задачи (поток ждет освобождения regeneration_lock)"""
+        try:
+            result = self._run_pending(files_path, "отложенные запросы")
+            if result["status"] == "error":
+                print(f"❌ {result['message']}")
+        except BaseException as e:
+            print(f"❌ Ошибка при выполнении отложенных запросов: {e}")
+    
+    def _regenerate(self, files_path, source, progress_callback=None):
+        try:
+            print(f"🔄 Начинаем перегенерацию базы знаний (источник: {source})")
+            
+            # Проверяем существование папки с файлами
+            if not os.path.exists(files_path):
+                os.makedirs(files_path, exist_ok=True)
+            
+            # Обеспечиваем правильные права доступа
+            self._ensure_permissions(files_path)
+            
+            # Выполняем мягкую перегенерацию (без удаления директории)
+            self.vector_db.soft_regenerate_vector_store(files_path, progress_callback=progress_callback)
+            self.last_regeneration = time.time()
+            
+            print(f"✅ База знаний успешно обновлена в {time.strftime('%H:%M:%S')} (источник: {source})")
+            
             return {
-                "status": "skipped", 
-                "message": f"Перегенерация пропущена (слишком частые запросы от {source})"
+                "status": "success", 
+                "message": "База знаний успешно обновлена"
             }
-        
-        # Проверяем, не идет ли уже перегенерация
-        if self.is_regenerating:
+            
+        except Exception as e:
+            error_msg = f"Ошибка при перегенерации базы знаний (источник: {source}): {str(e)}"
+            print(f"❌ {error_msg}")
             return {
-                "status": "in_progress", 
-                "message": f"Перегенерация уже выполняется, запрос от {source} пропущен"
+                "status": "error", 
+                "message": error_msg
             }
+    
+    def _apply_file_changes(self, files_path, files, source, progress_callback=None):
+        """Пересоздает документы измененных файлов и удаляет документы удаленных"""
+        print(f"🔄 Инкрементальное обновление {len(files)} файлов (источник: {source})")
+        self._ensure_permissions(files_path)
         
-        with self.regeneration_lock:
-            # Двойная проверка после получения лока
-            if self.is_regenerating:
-                return {
-                    "status": "in_progress", 
-                    "message": f"Перегенерация уже выполняется, запрос от {source} пропущен"
-                }
-            
-            self.is_regenerating = True
-            try:
-                print(f"🔄 Начинаем перегенерацию базы знаний (источник: {source})")
-                
-                # Проверяем существование папки с файлами
-                if not os.path.exists(files_path):
-                    os.makedirs(files_path, exist_ok=True)
-                
-                # Обеспечиваем правильные права доступа
-                self._ensure_permissions(files_path)
-                
-                # Выполняем мягкую перегенерацию (без удаления директории)
-                self.vector_db.soft_regenerate_vector_store(files_path)
-                self.last_regeneration = current_time
-                
-                print(f"✅ База знаний успешно обновлена в {time.strftime('%H:%M:%S')} (источник: {source})")
-                
-                return {
-                    "status": "success", 
-                    "message": "База знаний успешно обновлена"
-                }
-                
-            except Exception as e:
-                error_msg = f"Ошибка при перегенерации базы знаний (источник: {source}): {str(e)}"
-                print(f"❌ {error_msg}")
-                return {
-                    "status": "error", 
-                    "message": error_msg
-                }
-            finally:
-                self.is_regenerating = False
+        updated, unchanged, removed, errors = [], [], [], []
+        if progress_callback:
+            progress_callback(0, len(files))
+        for i, (filename, change) in enumerate(sorted(files.items())):
+            file_path = os.path.join(files_path, filename)
+            if change == "changed" and os.path.exists(file_path):
+                # Документы прежней версии заменяются, неизмененный файл пропускается по манифесту
+                result = self.vector_db.add_file_to_knowledge_base(file_path)
+                if result["status"] == "error":
+                    errors.append(f"{filename}: {result['message']}")
+                elif result.get("skipped"):
+                    unchanged.append(filename)
+                else:
+                    updated.append(filename)
+            else:
+                result = self.vector_db.remove_file_from_knowledge_base(filename)
+                if result["status"] == "error":
+                    errors.append(f"{filename}: {result['message']}")
+                else:
+                    removed.append(filename)
+            if progress_callback:
+                progress_callback(i + 1, len(files))
+        self.last_regeneration = time.time()
+        
+        if errors:
+            error_msg = f"Ошибка при обновлении файлов (источник: {source}): {'; '.join(errors)}"
+            print(f"❌ {error_msg}")
+            return {"status": "error", "message": error_msg, "updated_files": updated, "removed_files": removed}
+        
+        print(f"✅ Обновлено файлов: {len(updated)}, без изменений: {len(unchanged)}, удалено: {len(removed)} (источник: {source})")
+        return {
+            "status": "success",
+            "message": f"Обновлено файлов: {len(updated)}, без изменений: {len(unchanged)}, удалено: {len(removed)}",
+            "updated_files": updated,
+            "unchanged_files": unchanged,
+            "removed_files": removed
+        }
     
     def is_busy(self):
         """Проверяет, выполняется ли сейчас перегенерация"""
@@ -125,8 +236,13 @@ class RegenerationManager:
     
     def get_status(self):
         """Возвращает текущий статус менеджера"""
+        with self.state_lock:
+            pending_full = self.pending_full
+            pending_files = dict(self.pending_files)
         return {
             "is_regenerating": self.is_regenerating,
+            "pending_full": pending_full,
+            "pending_files": pending_files,
             "last_regeneration": self.last_regeneration,
             "last_regeneration_time": time.strftime('%H:%M:%S', time.localtime(self.last_regeneration)) if self.last_regeneration > 0 else "Никогда"
         }
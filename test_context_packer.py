@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Тесты сборки контекста rag_search: порядок документов разных подзапросов
+"""
+
+import sys
+import os
+
+# Добавляем путь к проекту
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from langchain_core.documents import Document
+
+import agent.context_packer as context_packer
+from agent.context_packer import pack_context, rank_hits
+
+
+def _hits(prefix, scores):
+    return [
+        (Document(page_content=f"{prefix} {rank}", metadata={"row_id": f"{prefix}:{rank}"}, id=f"{prefix}-{rank}"), score)
+        for rank, score in enumerate(scores)
+    ]
+
+
+def test_rank_hits_interleaves_subqueries_with_different_score_scales():
+    """Точное совпадение (1.0), RRF (~0.02) и векторный поиск (косинус) чередуются по позиции, а не по score"""
+    hits = {
+        "exact": _hits("exact", [1.0, 1.0, 1.0]),
+        "hybrid": _hits("hybrid", [0.033, 0.032, 0.016]),
+        "vector": _hits("vector", [0.81, 0.79, 0.62]),
+    }
+    ranked = [doc.id for doc, _ in rank_hits(hits)]
+    assert ranked == [
+        "exact-0", "hybrid-0", "vector-0",
+        "exact-1", "hybrid-1", "vector-1",
+        "exact-2", "hybrid-2", "vector-2",
+    ]
+
+
+def test_rank_hits_keeps_shared_document_once_at_its_best_rank():
+    shared = Document(page_content="shared", metadata={"row_id": "shared"}, id="shared")
+    hits = {
+        "first": [(Document(page_content="a", metadata={"row_id": "a"}, id="a"), 1.0), (shared, 1.0)],
+        "second": [(shared, 0.02)],
+    }
+    assert [doc.id for doc, _ in rank_hits(hits)] == ["a", "shared"]
+
+
+def test_pack_context_shares_tight_budget_between_subqueries(monkeypatch):
+    """Под маленьким бюджетом вторые документы гибридного подзапроса не вытесняются подзапросом с большими score"""
+    monkeypatch.setattr(context_packer, "count_tokens", lambda text: len(text.split()))
+    hits = {
+        "exact": _hits("exact", [1.0, 1.0, 1.0]),
+        "hybrid": _hits("hybrid", [0.033, 0.032, 0.016]),
+    }
+    document_tokens = len(context_packer.format_document(hits["exact"][0][0]).split())
+    context, documents_count = pack_context(hits, token_budget=document_tokens * 4)
+    assert documents_count == 4
+    assert "hybrid 1" in context
+    assert "exact 2" not in context
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Тесты менеджера синхронизации: запросы, пришедшие во время отмененной задачи
+"""
+
+import sys
+import os
+import threading
+
+import pytest
+
+# Добавляем путь к проекту
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from job_manager import JobCancelled
+from sync_manager import regen_manager
+
+
+def test_update_queued_during_cancelled_run_is_applied(monkeypatch, tmp_path):
+    """Изменение от watcher, пришедшее во время отмененной задачи, применяется без нового триггера"""
+    calls = []
+    applied = threading.Event()
+
+    class FakeVectorDB:
+        def add_file_to_knowledge_base(self, file_path):
+            filename = os.path.basename(file_path)
+            calls.append(filename)
+            if filename == "a.xlsx":
+                # Пока задача индексирует a.xlsx, watcher сообщает об изменении b.xlsx
+                queued = regen_manager.update_files(str(tmp_path), changed=["b.xlsx"], source="FileWatcher")
+                assert queued["status"] == "queued"
+                raise JobCancelled("задача отменена")
+            applied.set()
+            return {"status": "success", "added_docs": 1}
+
+    monkeypatch.setattr(regen_manager, "vector_db", FakeVectorDB())
+    monkeypatch.setattr(regen_manager, "_ensure_permissions", lambda files_path: None)
+    (tmp_path / "a.xlsx").write_bytes(b"")
+    (tmp_path / "b.xlsx").write_bytes(b"")
+
+    with pytest.raises(JobCancelled):
+        regen_manager.update_files(str(tmp_path), changed=["a.xlsx"], source="API", wait=True)
+
+    assert applied.wait(5)
+    assert calls == ["a.xlsx", "b.xlsx"]
+    assert regen_manager.get_status()["pending_files"] == {}
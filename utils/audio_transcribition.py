@@ -3,9 +3,9 @@ import os
 from aiogram import Bot
 from aiogram.types import Voice
 import openai
-from config import OPENAI_API_KEY
+from config import OPENAI_API_KEY, OPENAI_BASE_URL
 
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
+client = openai.OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
 
 
 async def transcribe_with_whisper(bot: Bot, voice: Voice) -> str: